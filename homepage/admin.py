@@ -1,3 +1,9 @@
 from django.contrib import admin
 
+from .models import RenderJob
+
 # Register your models here.
+@admin.register(RenderJob)
+class RenderJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'progress', 'inputFile', 'preset', 'leader', 'createdAt', 'finishedAt')
+    list_filter = ('status',)
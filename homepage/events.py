@@ -0,0 +1,143 @@
+'''
+Waiting on jobs without holding a server thread: server-sent progress events and awaiting a job's end, both polling the database from the event loop.
+
+Django 4.0 iterates streaming responses synchronously even under ASGI, so an event stream served through a view would block the event loop
+for as long as the job runs. megafy/asgi.py therefore serves GET /homepage/jobs/<id>/events/ with jobEventsApp, a plain ASGI app, and the
+matching view (views.jobEvents) only runs under WSGI, where every stream has a thread of its own anyway.
+
+Every process caps how many clients may wait at once (RENDER_MAX_WAITERS); past that, clients get 503 with Retry-After instead of queueing up.
+'''
+import asyncio
+import json
+from threading import BoundedSemaphore
+from time import sleep
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import RenderJob
+
+FINISHED = (RenderJob.DONE, RenderJob.FAILED)
+#Seconds a client should wait before reconnecting to a dropped event stream, or retrying once the process has room for more waiters
+RETRY_SECONDS = 5
+
+waiters = BoundedSemaphore(settings.RENDER_MAX_WAITERS)
+
+def acquireWaiter():
+    '''
+    Takes one of this process's RENDER_MAX_WAITERS waiting slots without blocking. Returns False if they're all taken.
+    '''
+    return waiters.acquire(blocking=False)
+
+def releaseWaiter():
+    waiters.release()
+
+def jobSnapshot(jobId):
+    '''
+    What a waiting client is told about a job: its id, status and progress (its leader's while it follows one), or None if there's no such job
+    '''
+    from .views import jobInfo
+
+    job = RenderJob.objects.select_related('leader').filter(pk=jobId).first()
+    return jobInfo(job) if job is not None else None
+
+def formatEvent(event, data):
+    '''
+    One server-sent event as bytes
+    '''
+    return ('event: %s\ndata: %s\n\n' % (event, json.dumps(data, cls=DjangoJSONEncoder))).encode()
+
+def nextEvent(info, last):
+    '''
+    The event to send for snapshot info given the previously sent snapshot last, or None when nothing a client shows has changed
+    '''
+    if info['status'] in FINISHED:
+        return info['status']
+    if last is None or (info['status'], info['progress']) != (last['status'], last['progress']):
+        return 'progress'
+    return None
+
+def iterJobEvents(jobId, poll=None):
+    '''
+    The event stream of a job as a blocking generator: a progress event whenever the status or progress changes, then a 'done' or 'failed' event
+    '''
+    poll = poll or settings.RENDER_EVENTS_POLL_INTERVAL
+    yield ('retry: %d\n\n' % (RETRY_SECONDS*1000)).encode()
+    last = None
+    while True:
+        info = jobSnapshot(jobId)
+        if info is None:
+            yield formatEvent('failed', {'id': jobId, 'error': 'No such job'})
+            return
+        event = nextEvent(info, last)
+        if event is not None:
+            yield formatEvent(event, info)
+            last = info
+        if info['status'] in FINISHED:
+            return
+        sleep(poll)
+
+async def awaitJob(jobId, timeout, poll=None):
+    '''
+    Waits without blocking the event loop until the job is done or failed, or timeout seconds have passed. Returns its last snapshot (None if there's no such job).
+    '''
+    poll = poll or settings.RENDER_EVENTS_POLL_INTERVAL
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        info = await sync_to_async(jobSnapshot)(jobId)
+        if info is None or info['status'] in FINISHED or loop.time() >= deadline:
+            return info
+        await asyncio.sleep(min(poll, max(0.0, deadline - loop.time())))
+
+async def sendResponse(send, status, headers, body=b''):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(name.encode(), value.encode()) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def jobEventsApp(scope, receive, send, jobId):
+    '''
+    ASGI app streaming iterJobEvents' events for jobId, sleeping on the event loop between polls instead of in a thread.
+    Stops as soon as the client disconnects.
+    '''
+    if scope['method'] != 'GET':
+        await sendResponse(send, 405, [('Allow', 'GET')])
+        return
+    if not acquireWaiter():
+        await sendResponse(send, 503, [('Content-Type', 'application/json'), ('Retry-After', str(RETRY_SECONDS))], json.dumps({'error': 'Too many clients waiting, try again later'}).encode())
+        return
+
+    disconnected = asyncio.Event()
+
+    async def watchDisconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watchDisconnect())
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': ('retry: %d\n\n' % (RETRY_SECONDS*1000)).encode(), 'more_body': True})
+        last = None
+        while not disconnected.is_set():
+            info = await sync_to_async(jobSnapshot)(jobId)
+            if info is None:
+                await send({'type': 'http.response.body', 'body': formatEvent('failed', {'id': jobId, 'error': 'No such job'})})
+                return
+            event = nextEvent(info, last)
+            if event is not None:
+                last = info
+                finished = info['status'] in FINISHED
+                await send({'type': 'http.response.body', 'body': formatEvent(event, info), 'more_body': not finished})
+                if finished:
+                    return
+            try:
+                await asyncio.wait_for(disconnected.wait(), settings.RENDER_EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watcher.cancel()
+        releaseWaiter()
+        #What Django does at the end of every request it handles itself
+        await sync_to_async(close_old_connections)()
@@ -0,0 +1,46 @@
+from time import sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from homepage.workers import failOrphanedJobs, getMemoryBudget, requeueInterruptedJobs, startWorker
+
+
+class Command(BaseCommand):
+    help = 'Starts the pool of long-lived render worker processes that run queued megafy jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.RENDER_WORKERS, help='Number of worker processes (defaults to RENDER_WORKERS)')
+        parser.add_argument('--poll-interval', type=float, default=settings.RENDER_POLL_INTERVAL, help='Seconds an idle worker waits before checking the queue again')
+
+    def handle(self, *args, **options):
+        from megafy.shared_audio import sweepOrphans
+
+        #Shared audio buffers left by workers that were killed since the last run
+        sweepOrphans()
+        requeued = requeueInterruptedJobs()
+        if requeued:
+            self.stdout.write('Requeued %d interrupted job(s)' % requeued)
+
+        #Shared by every worker, each reserving in the slot matching its index
+        budget = getMemoryBudget(options['workers'])
+        workers = [startWorker(options['poll_interval'], budget, slot) for slot in range(options['workers'])]
+        self.stdout.write('Started %d render worker(s)' % len(workers))
+
+        try:
+            while True:
+                #Replace any worker that died (e.g. killed by the OS) so the pool stays at full size
+                for index, worker in enumerate(workers):
+                    if not worker.is_alive():
+                        self.stderr.write('Render worker %s exited with code %s, restarting it' % (worker.pid, worker.exitcode))
+                        failOrphanedJobs(worker.pid, worker.exitcode)
+                        sweepOrphans()
+                        if budget is not None:
+                            budget.releaseDead(index)
+                        workers[index] = startWorker(options['poll_interval'], budget, index)
+                sleep(1)
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.6 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16)),
+                ('inputFile', models.CharField(max_length=1024)),
+                ('preset', models.CharField(blank=True, max_length=255)),
+                ('stages', models.JSONField(default=dict)),
+                ('outputFile', models.CharField(blank=True, max_length=1024)),
+                ('workerPid', models.IntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('createdAt', models.DateTimeField(auto_now_add=True)),
+                ('startedAt', models.DateTimeField(blank=True, null=True)),
+                ('finishedAt', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['createdAt'],
+            },
+        ),
+    ]
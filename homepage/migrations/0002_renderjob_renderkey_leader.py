@@ -0,0 +1,24 @@
+# Generated by Django 4.0.6 on 2026-10-16 23:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='renderKey',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='renderjob',
+            name='leader',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='followers', to='homepage.renderjob'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.6 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0002_renderjob_renderkey_leader'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='progress',
+            field=models.FloatField(default=0.0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.6 on 2026-10-16 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('homepage', '0003_renderjob_progress'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='renderjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('leader', None), ('status__in', ['queued', 'running']), models.Q(('renderKey', ''), _negated=True)), fields=('renderKey',), name='one_leader_per_render_key'),
+        ),
+    ]
@@ -1,3 +1,45 @@
 from django.db import models
 
 # Create your models here.
+class RenderJob(models.Model):
+    '''
+    A megafy render waiting for, or handled by, one of the render workers (see homepage/workers.py)
+    '''
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    inputFile = models.CharField(max_length=1024)
+    preset = models.CharField(max_length=255, blank=True)
+    #Stage choices exactly as megafyFile takes them, e.g. {"pitchShift": [-2], "bassBoost": [0.65, 0.235, 0.8, 0.5], "reverb": false, "softClipper": false}
+    stages = models.JSONField(default=dict)
+    outputFile = models.CharField(max_length=1024, blank=True)
+    #Identifies identical renders (input hash + normalized stages + render settings, see workers.getJobRenderKey)
+    renderKey = models.CharField(max_length=64, blank=True, db_index=True)
+    #Set on a job that was submitted while an identical one was in flight: it isn't rendered itself but gets the leader's result (see workers.finishFollowers)
+    leader = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='followers')
+    workerPid = models.IntegerField(null=True, blank=True)
+    #Fraction of the result encoded so far (0 to 1), updated by the worker while it renders (see workers.trackProgress)
+    progress = models.FloatField(default=0.0)
+    error = models.TextField(blank=True)
+    createdAt = models.DateTimeField(auto_now_add=True)
+    startedAt = models.DateTimeField(null=True, blank=True)
+    finishedAt = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['createdAt']
+        constraints = [
+            #At most one job renders each render key at a time, so two identical submissions can't both become leaders (see workers.submitRender)
+            models.UniqueConstraint(fields=['renderKey'], condition=models.Q(leader=None, status__in=['queued', 'running']) & ~models.Q(renderKey=''), name='one_leader_per_render_key'),
+        ]
+
+    def __str__(self):
+        return 'RenderJob %s (%s)' % (self.pk, self.status)
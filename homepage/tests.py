@@ -1,3 +1,559 @@
-from django.test import TestCase
+from multiprocessing import Process
+from os import _exit, path, unlink, utime
+from tempfile import TemporaryDirectory
+from time import time
+from unittest import mock
+import struct
 
-# Create your tests here.
+import numpy as np
+import soundfile as sf
+from django.db import IntegrityError
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from megafy import batch, preview, segments, streaming
+from megafy.buffer_pool import MIN_CLASS_SAMPLES, BufferPool, getSizeClass
+from megafy.encoder import UNKNOWN_WAV_SIZE, openEndedWavHeader
+from megafy.ingest import sniffAudioType
+from megafy.megafy_script import makeSession, megafyFile, normalizeStages
+from megafy.memory_budget import MemoryBudget
+from megafy.peaks import PEAK_FRAMES, PEAK_SCALE, PeakBuilder, halvePeaks, readPeaksIndex, readPeaksLevel
+from megafy.presets import PRESET_EXTENSION, PresetError, PresetRegistry, parsePreset
+from megafy.render_cache import RenderCache
+from megafy.segments import planSegments
+from megafy.streaming import measureDifference, megafyFileStreaming
+from megafy.variants import megafyVariants
+
+from .models import RenderJob
+from .views import parseRange, parseStages
+from .workers import submitRender
+
+def dieHoldingBudget(budget, slot):
+    #Killed in the middle of a reservation, lock and all
+    budget.acquire(slot, 60)
+    with budget.locked(slot):
+        _exit(1)
+
+class StageParsingTests(SimpleTestCase):
+    def test_parseStages_accepts_lists_and_a_bare_pitch_shift(self):
+        stages = parseStages({'pitchShift': -3, 'bassBoost': [0.5, 0.3, 0.7, 0.5]})
+        self.assertEqual(stages, {'pitchShift': [-3.0], 'bassBoost': [0.5, 0.3, 0.7, 0.5], 'reverb': False, 'softClipper': False})
+
+    def test_parseStages_rejects_wrong_arity_and_non_numbers(self):
+        for payload in ({'bassBoost': [0.5, 0.3]}, {'reverb': 'loud'}, {'softClipper': [1, 0.5, 0, 0, True]}):
+            with self.assertRaises(ValueError):
+                parseStages(payload)
+
+    def test_normalizeStages_makes_equal_settings_equal(self):
+        self.assertEqual(normalizeStages([5], False, None, False), normalizeStages(5.0000001, False, False, False))
+        self.assertEqual(normalizeStages((5,), [0.5, 0.3, 0.7, 0.5]), ((5.0,), (0.5, 0.3, 0.7, 0.5), False, False))
+
+#Every stage on, with the pitch shift, so renders exercise the whole chain
+MEGAFY_STAGES = ([-2.0], [0.525, 0.272, 0.7, 0.5], [0.3, 0.333333, 0.0, 1.0], [1.0, 0.5, 0.0, 0.0, 1.0])
+
+def writeTestSong(file, seconds, sampleRate=44100, channels=2):
+    '''
+    Writes a float WAV of a chord plus a little noise, so every stage has something to change. Returns the (channels, frames) audio.
+    '''
+    times = np.arange(int(seconds*sampleRate))/sampleRate
+    audio = np.stack([0.3*np.sin(2*np.pi*(55 + 110*channel)*times) + 0.2*np.sin(2*np.pi*440*times) for channel in range(channels)])
+    audio += 0.01*np.random.default_rng(channels).standard_normal(audio.shape)
+    audio = audio.astype(np.float32)
+    sf.write(file, audio.T, sampleRate, subtype='FLOAT')
+    return audio
+
+def readTestSong(file):
+    audio, _ = sf.read(file, dtype='float32', always_2d=True)
+    return audio.T
+
+class StreamingTests(SimpleTestCase):
+    def test_streamed_render_matches_the_full_one(self):
+        with TemporaryDirectory() as directory:
+            file = path.join(directory, 'song.wav')
+            writeTestSong(file, 25)
+            megafyFile(file, *MEGAFY_STAGES, outputFile=path.join(directory, 'full.wav'), backend='native')
+            #Short blocks, so the song crosses several block edges
+            megafyFileStreaming(file, *MEGAFY_STAGES, outputFile=path.join(directory, 'streamed.wav'), blockSeconds=4.0, backend='native')
+            difference = measureDifference(readTestSong(path.join(directory, 'full.wav')), readTestSong(path.join(directory, 'streamed.wav')))
+
+        self.assertGreater(difference['frames'], 24*44100)
+        self.assertLess(difference['maxAbs'], 1e-4)
+
+    def test_streamed_render_resamples_like_the_full_one(self):
+        for quality in ('fast', 'best'):
+            with TemporaryDirectory() as directory:
+                file = path.join(directory, 'song.wav')
+                writeTestSong(file, 10, sampleRate=48000)
+                options = {'backend': 'native', 'sampleRate': 44100, 'resampleQuality': quality}
+                megafyFile(file, *MEGAFY_STAGES, outputFile=path.join(directory, 'full.wav'), **options)
+                megafyFileStreaming(file, *MEGAFY_STAGES, outputFile=path.join(directory, 'streamed.wav'), blockSeconds=4.0, bufferPool=BufferPool(1 << 24), **options)
+                difference = measureDifference(readTestSong(path.join(directory, 'full.wav')), readTestSong(path.join(directory, 'streamed.wav')))
+            self.assertLess(difference['maxAbs'], 1e-4, quality)
+
+def sine(frequency, seconds=1.0, amplitude=0.1, sampleRate=44100, channels=2):
+    times = np.arange(int(seconds*sampleRate))/sampleRate
+    return np.tile(amplitude*np.sin(2*np.pi*frequency*times), (channels, 1)).astype(np.float32)
+
+def levelDb(audio):
+    #RMS of the middle of the audio, away from filter and reverb start-up
+    frames = audio.shape[-1]
+    middle = np.asarray(audio[..., frames//4:3*frames//4], dtype=np.float64)
+    return 10*np.log10(np.mean(middle**2))
+
+class NativeBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.session = makeSession('native')
+
+    def test_shapes(self):
+        mono = sine(440, channels=1)
+        #Upmixed to stereo like the plugins, and untouched with every stage off
+        np.testing.assert_array_equal(self.session.render(mono), np.repeat(mono, 2, axis=0))
+        self.assertEqual(self.session.render(mono, [12.0]).shape, (2, 22050))
+        self.assertEqual(self.session.render(mono, [-12.0]).shape, (2, 88200))
+        self.assertAlmostEqual(self.session.render(sine(440), *MEGAFY_STAGES).shape[1], 44100*self.session.timeRatio(MEGAFY_STAGES[0]), delta=1)
+
+    def test_pitch_shift_moves_the_pitch(self):
+        shifted = self.session.render(sine(440), [12.0])
+        spectrum = np.abs(np.fft.rfft(shifted[0]))
+        self.assertAlmostEqual(np.argmax(spectrum)*44100/shifted.shape[1], 880, delta=2)
+
+    def test_bass_boost_levels(self):
+        boost = [0.5, 0.272, 0.7, 0.5]
+        #A +12.6 dB shelf around 50 Hz lifts the lows and leaves the highs alone
+        self.assertGreater(levelDb(self.session.render(sine(25), False, boost)) - levelDb(sine(25)), 10)
+        self.assertAlmostEqual(levelDb(self.session.render(sine(2000), False, boost)), levelDb(sine(2000)), delta=0.5)
+        #Output gain 0.0 is -20 dB
+        self.assertAlmostEqual(levelDb(self.session.render(sine(2000), False, [0.0, 0.272, 0.0, 0.5])) - levelDb(sine(2000)), -20, delta=0.1)
+
+    def test_reverb_and_soft_clipper_levels(self):
+        #Fully dry reverb at unchanged width leaves the audio alone
+        np.testing.assert_allclose(self.session.render(sine(440), False, False, [0.0, 0.333333, 0.0, 1.0]), sine(440), atol=1e-5)
+        #A 0 dB threshold keeps a sine twice as loud as full scale under full scale
+        clipped = self.session.render(sine(440, amplitude=2.0), False, False, False, [1.0, 0.5, 0.0, 0.0, 0.0])
+        self.assertLessEqual(np.max(np.abs(clipped)), 1.0)
+        self.assertGreater(np.max(np.abs(clipped)), 0.9)
+
+    def test_chain_in_blocks_matches_one_go(self):
+        audio = sine(55, seconds=3.0, amplitude=0.5) + sine(440, seconds=3.0)
+        whole = self.session.makeChain(2, *MEGAFY_STAGES[1:]).process(audio)
+        chain = self.session.makeChain(2, *MEGAFY_STAGES[1:])
+        blocks = np.concatenate([chain.process(audio[:, start:start + 30000]) for start in range(0, audio.shape[1], 30000)], axis=1)
+        np.testing.assert_allclose(blocks, whole, atol=1e-5)
+
+    def test_file_rates(self):
+        with TemporaryDirectory() as directory:
+            file = path.join(directory, 'song.wav')
+            writeTestSong(file, 2, sampleRate=48000)
+            for sampleRate, expected in ((44100, 44100), (None, 48000)):
+                output = path.join(directory, 'out.wav')
+                megafyFile(file, *MEGAFY_STAGES, outputFile=output, backend='native', sampleRate=sampleRate)
+                info = sf.info(output)
+                self.assertEqual((info.samplerate, info.channels), (expected, 2))
+                self.assertAlmostEqual(info.frames, 2*expected*self.session.timeRatio(MEGAFY_STAGES[0]), delta=1)
+
+    def test_pitch_shifted_streams_read_in_blocks(self):
+        with TemporaryDirectory() as directory:
+            file = path.join(directory, 'song.wav')
+            writeTestSong(file, 12)
+            with mock.patch.object(streaming.BlockReader, 'read', autospec=True, side_effect=streaming.BlockReader.read) as read:
+                megafyFileStreaming(file, *MEGAFY_STAGES, outputFile=path.join(directory, 'out.wav'), blockSeconds=4.0, backend='native')
+        self.assertLess(max(call.args[1] for call in read.call_args_list), 6*44100)
+
+class PreviewTests(SimpleTestCase):
+    def test_tiers_render_only_the_window_at_their_rate(self):
+        with TemporaryDirectory() as directory:
+            file = path.join(directory, 'song.wav')
+            writeTestSong(file, 6, sampleRate=48000)
+            for quality, tier in preview.QUALITY_TIERS.items():
+                audio, sampleRate = preview.renderPreview(file, False, *MEGAFY_STAGES[1:], offset=1.0, duration=2.0, quality=quality, backend='native')
+                self.assertEqual((audio.shape, sampleRate), ((2, 2*tier['sampleRate']), tier['sampleRate']))
+
+    def test_lower_tiers_use_the_fast_resampler(self):
+        self.assertEqual({preview.RESAMPLE_QUALITIES[quality] for quality in ('draft', 'balanced')}, {'fast'})
+
+    def test_warm_up_makes_every_tier_session(self):
+        with mock.patch.dict(preview.previewSessions, clear=True):
+            preview.warmUpPreviews('native')
+            self.assertEqual(set(preview.previewSessions), {('native', quality) for quality in preview.QUALITY_TIERS})
+
+class SegmentTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(segments.shutdownSegmentPools)
+
+    def test_kept_parts_tile_the_track(self):
+        frames, segmentFrames, prerollFrames, lookaheadFrames = 1000, 300, 50, 20
+        plan = planSegments(frames, segmentFrames, prerollFrames, lookaheadFrames)
+        self.assertEqual([(keepStart, keepEnd) for _, keepStart, keepEnd, _ in plan], [(0, 300), (300, 600), (600, 900), (900, 1000)])
+
+    def test_render_windows_stay_inside_the_track_and_cover_the_crossfade(self):
+        frames, prerollFrames, lookaheadFrames = 1000, 50, 20
+        for renderStart, keepStart, keepEnd, renderEnd in planSegments(frames, 300, prerollFrames, lookaheadFrames):
+            self.assertGreaterEqual(renderStart, 0)
+            self.assertLessEqual(renderEnd, frames)
+            #Every segment but the first renders a full preroll, which the crossfade into it comes out of
+            self.assertEqual(keepStart - renderStart, min(keepStart, prerollFrames))
+            self.assertEqual(renderEnd - keepEnd, min(frames - keepEnd, lookaheadFrames))
+
+    def test_empty_track(self):
+        self.assertEqual(planSegments(0, 300, 50, 20), [])
+
+    def assertSegmentedMatchesSerial(self, song, **options):
+        serial = makeSession('native').render(song, *MEGAFY_STAGES)
+        segmented = segments.renderSegmented(song, *MEGAFY_STAGES, workers=2, backend='native', **options)
+        self.assertEqual(segmented.shape, serial.shape)
+        self.assertLess(measureDifference(serial, segmented)['maxAbs'], 1e-4)
+
+    def test_segmented_render_matches_the_serial_one(self):
+        #Four segments, so there are crossfades on both sides of the middle ones
+        self.assertSegmentedMatchesSerial(sine(55, seconds=16, amplitude=0.5) + sine(440, seconds=16), segmentSeconds=4.0)
+
+    def test_mono_track(self):
+        #Every slice of a single row is already contiguous, so the workers must still copy it out of the shared track
+        self.assertSegmentedMatchesSerial(sine(55, seconds=8, amplitude=0.5, channels=1), segmentSeconds=4.0)
+
+    def test_track_shorter_than_one_segment(self):
+        self.assertSegmentedMatchesSerial(sine(55, seconds=5, amplitude=0.5) + sine(440, seconds=5))
+
+class VariantTests(SimpleTestCase):
+    def test_every_variant_matches_its_own_render(self):
+        variants = [
+            list(MEGAFY_STAGES),
+            #Same up to the soft clipper, so it shares the first three stages with the one above
+            list(MEGAFY_STAGES[:3]) + [[0.8, 0.6, 0.2, 0.2, 0.0]],
+            list(MEGAFY_STAGES),
+            [False, MEGAFY_STAGES[1], False, False],
+            [False, False, False, False],
+        ]
+        with TemporaryDirectory() as directory:
+            file = path.join(directory, 'song.wav')
+            writeTestSong(file, 4)
+            outputFiles = [path.join(directory, 'variant%d.wav' % index) for index in range(len(variants))]
+            megafyVariants(file, variants, outputFiles, backend='native')
+            for variant, outputFile in zip(variants, outputFiles):
+                single = path.join(directory, 'single.wav')
+                megafyFile(file, *variant, outputFile=single, backend='native')
+                difference = measureDifference(readTestSong(single), readTestSong(outputFile))
+                self.assertEqual(sf.info(outputFile).frames, sf.info(single).frames)
+                self.assertLess(difference['maxAbs'], 1e-4, variant)
+
+    def test_output_files_must_match_the_variants(self):
+        with self.assertRaises(ValueError):
+            megafyVariants('song.wav', [list(MEGAFY_STAGES)], ['a.wav', 'b.wav'])
+
+class BatchTests(SimpleTestCase):
+    def test_renderOne_reports_the_decoded_duration(self):
+        with TemporaryDirectory() as directory:
+            file = path.join(directory, 'song.wav')
+            writeTestSong(file, 3, sampleRate=48000)
+            with mock.patch.object(batch, 'workerSession', makeSession('native')), mock.patch('megafy.ingest.probeAudio') as probeAudio:
+                inputFile, seconds, _ = batch.renderOne(file, path.join(directory, 'out.wav'), MEGAFY_STAGES)
+            self.assertTrue(path.exists(path.join(directory, 'out.wav')))
+        self.assertEqual((inputFile, seconds), (file, 3.0))
+        probeAudio.assert_not_called()
+
+class RenderCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.song = path.join(self.directory, 'song.wav')
+        with open(self.song, 'wb') as song:
+            song.write(b'not really audio')
+        self.cache = RenderCache(path.join(self.directory, 'cache'), 1 << 20)
+        self.renders = []
+
+    def render(self, file, *stages, outputFile=None, backend=None, **options):
+        '''
+        Stands in for megafyFile: writes the stages it was asked for instead of audio
+        '''
+        self.renders.append(stages)
+        with open(outputFile, 'w') as output:
+            output.write(repr(stages))
+
+    def renderFile(self, outputName, *stages):
+        return self.cache.renderFile(self.song, *stages, outputFile=path.join(self.directory, outputName), render=self.render, backend='native')
+
+    def test_hit_and_miss(self):
+        self.assertFalse(self.renderFile('first.wav', [-3]))
+        self.assertTrue(self.renderFile('second.wav', [-3.0]))
+        self.assertFalse(self.renderFile('third.wav', [5]))
+        self.assertEqual(len(self.renders), 2)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0})
+        with open(path.join(self.directory, 'second.wav')) as second:
+            self.assertEqual(second.read(), repr(([-3], False, False, False)))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = RenderCache(path.join(self.directory, 'small'), 250)
+
+        def put(key):
+            rendered = path.join(self.directory, key + '.wav')
+            with open(rendered, 'wb') as output:
+                output.write(bytes(100))
+            return cache.put(key, rendered)
+
+        #a is older than b, but is then used, which leaves b as the least recently used
+        for age, key in ((120, 'a'), (60, 'b')):
+            utime(put(key), (time() - age, time() - age))
+        self.assertIsNotNone(cache.get('a'))
+        put('c')
+        self.assertEqual([cache.get(key) is not None for key in ('a', 'b', 'c')], [True, False, True])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_rendering_over_a_cached_output_leaves_the_entry_alone(self):
+        self.renderFile('first.wav', [-3])
+        #A hit hard links the entry to second.wav, which the next render then writes to
+        self.renderFile('second.wav', [-3])
+        self.renderFile('second.wav', [5])
+        self.renders.clear()
+        self.assertTrue(self.renderFile('third.wav', [-3]))
+        with open(path.join(self.directory, 'third.wav')) as third:
+            self.assertEqual(third.read(), repr(([-3], False, False, False)))
+        with open(path.join(self.directory, 'second.wav')) as second:
+            self.assertEqual(second.read(), repr(([5], False, False, False)))
+
+def makeWavHeader(extraChunk=b''):
+    '''
+    The start of a 16-bit stereo WAV: RIFF header, fmt chunk, optionally another chunk, then the data chunk's header
+    '''
+    fmt = b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 2, 44100, 44100*4, 4, 16)
+    return b'RIFF' + struct.pack('<I', 1000) + b'WAVE' + fmt + extraChunk + b'data' + struct.pack('<I', 960)
+
+class RangeTests(SimpleTestCase):
+    def test_plain_and_open_ended_ranges(self):
+        self.assertEqual(parseRange('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parseRange('bytes=500-', 1000), (500, 999))
+        self.assertEqual(parseRange('bytes=500-', None), (500, None))
+        #An end past the file is cut down to its last byte
+        self.assertEqual(parseRange('bytes=900-5000', 1000), (900, 999))
+
+    def test_suffix_ranges(self):
+        self.assertEqual(parseRange('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parseRange('bytes=-5000', 1000), (0, 999))
+        #Can't be answered while the file is still growing
+        self.assertIsNone(parseRange('bytes=-100', None))
+
+    def test_unsatisfiable_ranges(self):
+        with self.assertRaises(ValueError):
+            parseRange('bytes=1000-', 1000)
+        with self.assertRaises(ValueError):
+            parseRange('bytes=50-10', 1000)
+
+    def test_missing_or_malformed_ranges_mean_the_whole_file(self):
+        for header in (None, '', 'bytes=0-10,20-30', 'items=0-10', 'bytes=-'):
+            self.assertIsNone(parseRange(header, 1000))
+
+class WavHeaderTests(SimpleTestCase):
+    def test_sizes_are_opened_up(self):
+        patched = openEndedWavHeader(makeWavHeader())
+        self.assertEqual(struct.unpack_from('<I', patched, 4)[0], UNKNOWN_WAV_SIZE)
+        self.assertEqual(struct.unpack_from('<I', patched, len(patched) - 4)[0], UNKNOWN_WAV_SIZE)
+
+    def test_chunks_before_data_are_skipped_with_padding(self):
+        #An odd-sized chunk is followed by a pad byte
+        header = makeWavHeader(b'LIST' + struct.pack('<I', 3) + b'abc\x00')
+        patched = openEndedWavHeader(header)
+        self.assertEqual(struct.unpack_from('<I', patched, len(patched) - 4)[0], UNKNOWN_WAV_SIZE)
+        self.assertEqual(patched[:-4], header[:4] + struct.pack('<I', UNKNOWN_WAV_SIZE) + header[8:-4])
+
+    def test_other_files_and_incomplete_headers_are_untouched(self):
+        header = makeWavHeader()
+        self.assertEqual(openEndedWavHeader(b'ID3\x04' + bytes(40)), b'ID3\x04' + bytes(40))
+        self.assertEqual(openEndedWavHeader(header[:-8]), header[:-8])
+
+class SniffTests(SimpleTestCase):
+    def test_known_types(self):
+        self.assertEqual(sniffAudioType(makeWavHeader()[:12]), '.wav')
+        self.assertEqual(sniffAudioType(b'ID3\x03\x00' + bytes(7)), '.mp3')
+        #MPEG-1 layer III frame sync
+        self.assertEqual(sniffAudioType(b'\xff\xfb\x90\x00' + bytes(8)), '.mp3')
+
+    def test_unknown_types(self):
+        for header in (b'', b'fLaC' + bytes(8), b'OggS' + bytes(8), b'\xff\xf9' + bytes(10), b'RIFF\x00\x00\x00\x00AVI '):
+            self.assertIsNone(sniffAudioType(header))
+
+class PresetTests(SimpleTestCase):
+    def test_valid_preset(self):
+        preset = parsePreset('Default', 'False\n0.525 0.24 0.7 0.5\nFalse\n1.0 0.5 0.0 0.0 1.0\n')
+        self.assertEqual(preset.stages, [False, [0.525, 0.24, 0.7, 0.5], False, [1.0, 0.5, 0.0, 0.0, 1.0]])
+        #The key only depends on the values
+        self.assertEqual(preset.key, parsePreset('Other', 'False\n0.525 0.24 0.7 0.5\n\nFalse\n1 0.5 0 0 1').key)
+
+    def test_errors(self):
+        for text in (
+            'False\nFalse\nFalse',
+            'False\nloud\nFalse\nFalse',
+            'False\n0.5 0.5 0.5\nFalse\nFalse',
+            '13\nFalse\nFalse\nFalse',
+            '2.5\nFalse\nFalse\nFalse',
+            'False\n0.5 0.5 0.5 0.25\nFalse\nFalse',
+            'False\nFalse\nFalse\n1 0.5 0 0 0.5',
+            'False\nFalse\n0.5 0.5 0.5 1.5\nFalse',
+        ):
+            with self.assertRaises(PresetError, msg=text):
+                parsePreset('Broken', text)
+
+    def test_reload_keeps_the_last_good_version(self):
+        with TemporaryDirectory() as directory:
+            presetFile = path.join(directory, 'Loud' + PRESET_EXTENSION)
+            with open(presetFile, 'w') as output:
+                output.write('False\n0.525 0.24 0.7 0.5\nFalse\nFalse\n')
+            registry = PresetRegistry(directory)
+            good = registry.get('Loud')
+
+            with open(presetFile, 'w') as output:
+                output.write('False\nloud\nFalse\nFalse\n')
+            #mtimes can be too coarse to tell two quick writes apart
+            utime(presetFile, (time() + 10, time() + 10))
+            self.assertEqual(registry.refresh(), ['Loud'])
+            self.assertIs(registry.get('Loud'), good)
+            self.assertIn('Loud', registry.errors)
+
+            unlink(presetFile)
+            self.assertEqual(registry.refresh(), ['Loud'])
+            with self.assertRaises(PresetError):
+                registry.get('Loud')
+
+class BufferPoolTests(SimpleTestCase):
+    def test_size_classes(self):
+        self.assertEqual(getSizeClass(1), MIN_CLASS_SAMPLES)
+        self.assertEqual(getSizeClass(MIN_CLASS_SAMPLES), MIN_CLASS_SAMPLES)
+        self.assertEqual(getSizeClass(MIN_CLASS_SAMPLES + 1), MIN_CLASS_SAMPLES*2)
+        self.assertEqual(getSizeClass(3*MIN_CLASS_SAMPLES), MIN_CLASS_SAMPLES*4)
+
+    def test_buffers_are_reused(self):
+        pool = BufferPool(64 * 1024**2)
+        first = pool.take(2, 1000)
+        self.assertEqual(first.shape, (2, 1000))
+        self.assertTrue(first.flags['C_CONTIGUOUS'])
+        base = first.base
+        pool.give(first[:, 10:])
+        second = pool.take(2, 900)
+        self.assertIs(second.base, base)
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+    def test_foreign_arrays_and_overflow_are_dropped(self):
+        pool = BufferPool(0)
+        pool.give(np.zeros((2, 10), dtype=np.float32))
+        pool.give(pool.take(2, 10))
+        self.assertEqual((pool.freeBytes, pool.free), (0, {}))
+
+class MemoryBudgetTests(SimpleTestCase):
+    def test_acquire_and_release(self):
+        budget = MemoryBudget(100, 3)
+        self.assertTrue(budget.acquire(0, 60, timeout=0))
+        self.assertFalse(budget.acquire(1, 50, timeout=0))
+        self.assertTrue(budget.acquire(1, 40, timeout=0))
+        self.assertEqual(budget.used(), 100)
+        budget.release(0)
+        self.assertEqual(budget.used(), 40)
+        self.assertTrue(budget.acquire(2, 50, timeout=0))
+
+    def test_a_job_bigger_than_the_budget_runs_alone(self):
+        budget = MemoryBudget(100, 2)
+        self.assertTrue(budget.acquire(0, 500, timeout=0))
+        self.assertFalse(budget.acquire(1, 1, timeout=0))
+        budget.release(0)
+        self.assertTrue(budget.acquire(1, 500, timeout=0))
+
+    def test_a_worker_that_dies_holding_the_lock_is_cleaned_up(self):
+        budget = MemoryBudget(100, 2)
+        worker = Process(target=dieHoldingBudget, args=(budget, 0))
+        worker.start()
+        worker.join()
+        self.assertEqual((budget.used(), budget.holder.value), (60, 0))
+        budget.releaseDead(0)
+        self.assertTrue(budget.acquire(1, 100, timeout=1))
+
+class PeaksTests(SimpleTestCase):
+    def test_round_trip(self):
+        channels = 2
+        frames = PEAK_FRAMES*1030 + 10
+        audio = np.zeros((frames, channels), dtype=np.float32)
+        audio[5, 0] = 0.5
+        audio[PEAK_FRAMES + 7, 1] = -0.25
+        audio[-1, 0] = -1.0
+
+        builder = PeakBuilder(channels, 44100)
+        #In uneven blocks, so windows straddle block edges
+        for start in range(0, frames, 10000):
+            builder.add(audio[start:start + 10000])
+
+        with TemporaryDirectory() as directory:
+            peaksFile = path.join(directory, 'song.wav.peaks')
+            builder.write(peaksFile)
+            index = readPeaksIndex(peaksFile)
+            levels = [np.frombuffer(readPeaksLevel(peaksFile, entry['level']), dtype=np.int8).reshape(-1, channels, 2) for entry in index['levels']]
+
+        self.assertEqual((index['channels'], index['sampleRate'], index['frames']), (channels, 44100, frames))
+        self.assertEqual([entry['peaks'] for entry in index['levels']], [1031, 516, 258])
+        self.assertEqual([entry['framesPerPeak'] for entry in index['levels']], [PEAK_FRAMES, PEAK_FRAMES*2, PEAK_FRAMES*4])
+        #Rounded outwards: 0.5 and -0.25 of full scale are 63.5 and -31.75
+        self.assertEqual(tuple(levels[0][0, 0]), (0, 64))
+        self.assertEqual(tuple(levels[0][1, 1]), (-32, 0))
+        #The 10 frames past the last whole window get a peak of their own
+        self.assertEqual(tuple(levels[0][-1, 0]), (-PEAK_SCALE, 0))
+        np.testing.assert_array_equal(levels[1], halvePeaks(levels[0]))
+        np.testing.assert_array_equal(levels[2], halvePeaks(levels[1]))
+
+    def test_levels_out_of_range(self):
+        builder = PeakBuilder(1, 44100)
+        builder.add(np.zeros((PEAK_FRAMES, 1), dtype=np.float32))
+        with TemporaryDirectory() as directory:
+            peaksFile = path.join(directory, 'song.wav.peaks')
+            builder.write(peaksFile)
+            with self.assertRaises(ValueError):
+                readPeaksLevel(peaksFile, 1)
+
+class SubmitRenderTests(TestCase):
+    stages = {'pitchShift': False, 'bassBoost': [0.5, 0.3, 0.7, 0.5], 'reverb': False, 'softClipper': False}
+
+    def submit(self):
+        with mock.patch('homepage.workers.getJobRenderKey', return_value='key'):
+            return submitRender('song.wav', '', self.stages)
+
+    def test_identical_render_follows_the_one_in_flight(self):
+        leader = self.submit()
+        follower = self.submit()
+        self.assertIsNone(leader.leader_id)
+        self.assertEqual(follower.leader_id, leader.pk)
+        self.assertEqual(follower.status, RenderJob.QUEUED)
+
+    def test_leader_finishing_between_lookup_and_create_still_finishes_the_follower(self):
+        leader = self.submit()
+        create = RenderJob.objects.create
+
+        def finishLeaderFirst(**fields):
+            #The leader finishes (and passes its result on to its followers, of which there are none yet) just before the follower is created
+            RenderJob.objects.filter(pk=leader.pk).update(status=RenderJob.DONE, outputFile='out.wav', progress=1.0, finishedAt=timezone.now())
+            return create(**fields)
+
+        with mock.patch.object(RenderJob.objects, 'create', side_effect=finishLeaderFirst):
+            follower = self.submit()
+        self.assertEqual(follower.leader_id, leader.pk)
+        self.assertEqual((follower.status, follower.outputFile, follower.progress), (RenderJob.DONE, 'out.wav', 1.0))
+
+    def test_finished_renders_are_not_followed(self):
+        leader = self.submit()
+        RenderJob.objects.filter(pk=leader.pk).update(status=RenderJob.FAILED)
+        self.assertIsNone(self.submit().leader_id)
+
+    def test_a_second_leader_for_the_same_render_is_refused(self):
+        self.submit()
+        with self.assertRaises(IntegrityError):
+            RenderJob.objects.create(inputFile='song.wav', stages=self.stages, renderKey='key')
+
+    def test_losing_the_race_to_lead_makes_a_follower(self):
+        rival = self.submit()
+        first = QuerySet.first
+        lookups = []
+
+        def missTheRival(queryset):
+            #The rival became the leader just after this submission's first lookup
+            lookups.append(queryset)
+            return None if len(lookups) == 1 else first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', autospec=True, side_effect=missTheRival):
+            job = self.submit()
+        self.assertEqual(job.leader_id, rival.pk)
+        self.assertEqual(RenderJob.objects.filter(renderKey='key', leader=None).count(), 1)
@@ -2,5 +2,17 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('', views.homepageCode)
+    path('', views.homepageCode),
+    path('jobs/', views.submitJob),
+    path('jobs/<int:jobId>/', views.jobStatus),
+    path('jobs/<int:jobId>/result/', views.jobResult),
+    path('jobs/<int:jobId>/stream/', views.jobStream),
+    path('jobs/<int:jobId>/peaks/', views.jobPeaks),
+    path('jobs/<int:jobId>/events/', views.jobEvents),
+    path('jobs/<int:jobId>/wait/', views.jobWait),
+    path('presets/', views.presetList),
+    path('presets/<str:name>/', views.presetDetail),
+    path('preview/', views.previewRender),
+    path('metrics/', views.metrics),
+    path('uploads/', views.uploadFile),
 ]
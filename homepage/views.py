@@ -1,6 +1,522 @@
-from django.shortcuts import render
-from django.http import HttpResponse
+import json
+from os import makedirs, path, replace, unlink
+import re
+from secrets import token_hex
+from time import sleep
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from . import events
+from .models import RenderJob
+from .workers import getPartialFile, submitRender
+
+#How many values each stage takes when it's enabled (see the megafyFile docstring)
+STAGE_ARITY = {'pitchShift': 1, 'bassBoost': 4, 'reverb': 4, 'softClipper': 5}
+STREAM_CHUNK_BYTES = 64 * 1024
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+#Enough of a file's start to tell what it is (see ingest.sniffAudioType)
+UPLOAD_SNIFF_BYTES = 12
+#How long an upload slot is held if the process handling it dies without giving it back
+UPLOAD_SLOT_SECONDS = 60 * 60
+UPLOAD_NAME_PATTERN = re.compile(r'[^A-Za-z0-9 ._()-]+')
 
 # Create your views here.
 def homepageCode(request):
-    return render(request, 'interface.html')
\ No newline at end of file
+    return render(request, 'interface.html')
+
+def jsonError(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+def getRenderingJob(job):
+    '''
+    The job actually rendering job's audio: its leader while job is an unfinished follower (see workers.submitRender), otherwise job itself
+    '''
+    if job.leader_id is not None and job.status in (RenderJob.QUEUED, RenderJob.RUNNING):
+        return job.leader
+    return job
+
+def jobInfo(job):
+    renderingJob = getRenderingJob(job)
+    return {
+        'id': job.pk,
+        'status': renderingJob.status,
+        'progress': renderingJob.progress,
+        'leader': job.leader_id,
+        'preset': job.preset,
+        'stages': job.stages,
+        'error': job.error,
+        'createdAt': job.createdAt,
+        'startedAt': job.startedAt,
+        'finishedAt': job.finishedAt,
+        'result': '/homepage/jobs/%d/result/' % job.pk if renderingJob.status == RenderJob.DONE else None,
+        'stream': '/homepage/jobs/%d/stream/' % job.pk if renderingJob.status in (RenderJob.RUNNING, RenderJob.DONE) else None,
+        'peaks': '/homepage/jobs/%d/peaks/' % job.pk if renderingJob.status == RenderJob.DONE else None,
+        'events': '/homepage/jobs/%d/events/' % job.pk,
+    }
+
+def parseStages(payload):
+    '''
+    Validates explicit stage parameters from a submit payload. Raises ValueError with a message for the client.
+    '''
+    stages = {}
+    for name, arity in STAGE_ARITY.items():
+        value = payload.get(name, False)
+        if value is False or value is None:
+            stages[name] = False
+            continue
+        if name == 'pitchShift' and isinstance(value, (int, float)):
+            value = [value]
+        if not isinstance(value, list) or len(value) != arity or not all(isinstance(number, (int, float)) and not isinstance(number, bool) for number in value):
+            raise ValueError('%s must be false or a list of %d numbers' % (name, arity))
+        stages[name] = [float(number) for number in value]
+    return stages
+
+def resolveInputFile(fileName, validFiletypes):
+    inputDir = path.realpath(settings.RENDER_INPUT_DIR)
+    inputFile = path.realpath(path.join(inputDir, fileName))
+    if path.commonpath([inputDir, inputFile]) != inputDir or not path.isfile(inputFile):
+        raise ValueError('Unknown input file %r' % fileName)
+    if path.splitext(inputFile)[1].lower() not in validFiletypes:
+        raise ValueError('Input file must be one of %s' % ', '.join(validFiletypes))
+    return inputFile
+
+def parseRenderRequest(request):
+    '''
+    Reads a render request's JSON body: {"file": name inside RENDER_INPUT_DIR, "preset": preset name} or {"file": ..., "pitchShift": [...], "bassBoost": [...], "reverb": [...], "softClipper": [...]}.
+    Returns (payload, inputFile, preset, stages) or raises ValueError with a message for the client.
+    '''
+    from megafy import megafy_script
+    from megafy.presets import getRegistry
+
+    try:
+        payload = json.loads(request.body or b'{}')
+    except ValueError:
+        raise ValueError('Body must be JSON')
+    if not isinstance(payload, dict) or not isinstance(payload.get('file'), str):
+        raise ValueError('"file" is required')
+
+    inputFile = resolveInputFile(payload['file'], megafy_script.VALID_FILETYPES)
+    preset = payload.get('preset') or ''
+    if preset:
+        if not isinstance(preset, str):
+            raise ValueError('Unknown preset %r' % preset)
+        #Raises presets.PresetError, a ValueError, for unknown or broken presets
+        stages = getRegistry().get(preset).stageDict
+    else:
+        stages = parseStages(payload)
+    return payload, inputFile, preset, stages
+
+@csrf_exempt
+@require_POST
+def submitJob(request):
+    '''
+    Queues a render (body as described in parseRenderRequest). A render identical to one already in flight attaches to it instead of rendering again
+    '''
+    try:
+        _, inputFile, preset, stages = parseRenderRequest(request)
+    except ValueError as error:
+        return jsonError(str(error), 400)
+
+    if RenderJob.objects.filter(status=RenderJob.QUEUED, leader=None).count() >= settings.RENDER_QUEUE_LIMIT:
+        response = jsonError('Render queue is full, try again later', 429)
+        response['Retry-After'] = '10'
+        return response
+
+    job = submitRender(inputFile, preset, stages)
+    return JsonResponse(jobInfo(job), status=202 if job.status in (RenderJob.QUEUED, RenderJob.RUNNING) else 200)
+
+@csrf_exempt
+@require_POST
+def previewRender(request):
+    '''
+    Renders a short window straight away and returns it as a 16-bit WAV. Body is a render request (see parseRenderRequest) plus optional
+    "offset" and "duration" in seconds (duration at most PREVIEW_MAX_SECONDS) and "quality" ("draft", "balanced" or "full").
+    '''
+    from megafy import preview
+
+    try:
+        payload, inputFile, _, stages = parseRenderRequest(request)
+        offset = float(payload.get('offset', 0.0))
+        duration = float(payload.get('duration', preview.PREVIEW_SECONDS))
+        quality = payload.get('quality', 'draft')
+        if offset < 0 or not 0 < duration <= settings.PREVIEW_MAX_SECONDS:
+            raise ValueError('offset must be >= 0 and duration between 0 and %s seconds' % settings.PREVIEW_MAX_SECONDS)
+        if quality not in preview.QUALITY_TIERS:
+            raise ValueError('quality must be one of %s' % ', '.join(preview.QUALITY_TIERS))
+    except (TypeError, ValueError) as error:
+        return jsonError(str(error), 400)
+
+    wav = preview.previewWav(inputFile, *[stages[name] for name in STAGE_ARITY], offset=offset, duration=duration, quality=quality, backend=settings.RENDER_BACKEND)
+    return HttpResponse(wav, content_type='audio/wav')
+
+@require_GET
+def jobStatus(request, jobId):
+    job = get_object_or_404(RenderJob, pk=jobId)
+    return JsonResponse(jobInfo(job))
+
+@require_GET
+def presetList(request):
+    from megafy.presets import getRegistry
+
+    return JsonResponse({'presets': [preset.info() for preset in getRegistry().list()]})
+
+@require_GET
+def presetDetail(request, name):
+    from megafy.presets import PresetError, getRegistry
+
+    try:
+        return JsonResponse(getRegistry().get(name).info())
+    except PresetError as error:
+        return jsonError(str(error), 404)
+
+def tooManyWaiters():
+    response = jsonError('Too many clients waiting, try again later', 503)
+    response['Retry-After'] = str(events.RETRY_SECONDS)
+    return response
+
+@require_GET
+def jobEvents(request, jobId):
+    '''
+    The job's progress as server-sent events (see events.iterJobEvents). Only reached under WSGI: megafy/asgi.py serves this path with
+    events.jobEventsApp, which waits on the event loop instead of holding a thread per client.
+    '''
+    get_object_or_404(RenderJob, pk=jobId)
+    if not events.acquireWaiter():
+        return tooManyWaiters()
+
+    def stream():
+        try:
+            yield from events.iterJobEvents(jobId)
+        finally:
+            events.releaseWaiter()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def jobWait(request, jobId):
+    '''
+    Long poll: answers once the job is done or failed (200), or after ?timeout= seconds (capped at RENDER_WAIT_MAX_SECONDS) with the job still going (202).
+    Async, so under ASGI a waiting client costs no thread.
+    '''
+    #require_GET can't wrap a coroutine in this Django version
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        timeout = min(float(request.GET.get('timeout', settings.RENDER_WAIT_MAX_SECONDS)), settings.RENDER_WAIT_MAX_SECONDS)
+    except ValueError:
+        return jsonError('timeout must be a number', 400)
+    if not events.acquireWaiter():
+        return tooManyWaiters()
+    try:
+        info = await events.awaitJob(jobId, max(0.0, timeout))
+    finally:
+        events.releaseWaiter()
+    if info is None:
+        return jsonError('No such job', 404)
+    return JsonResponse(info, status=200 if info['status'] in events.FINISHED else 202)
+
+@require_GET
+def jobResult(request, jobId):
+    job = getRenderingJob(get_object_or_404(RenderJob, pk=jobId))
+    if job.status == RenderJob.FAILED:
+        return jsonError('Render failed', 410)
+    if job.status != RenderJob.DONE:
+        return jsonError('Render is still %s' % job.status, 409)
+    if not path.isfile(job.outputFile):
+        return HttpResponse(status=404)
+    return FileResponse(open(job.outputFile, 'rb'), as_attachment=True, filename=path.basename(job.outputFile), content_type=contentTypeFor(job.outputFile))
+
+def contentTypeFor(outputFile):
+    from megafy.megafy_script import OUTPUT_FORMATS
+
+    extension = path.splitext(outputFile)[1].lower()
+    return next((settings['contentType'] for settings in OUTPUT_FORMATS.values() if settings['extension'] == extension), 'application/octet-stream')
+
+def parseRange(header, size=None):
+    '''
+    Reads a single "bytes=start-end" Range header into an inclusive (start, end) pair, end None meaning to the end of the file.
+    size is the file's size, or None while it's still growing. Returns None when there's no usable Range (the whole file is sent)
+    and raises ValueError when the range can't be satisfied.
+    '''
+    match = RANGE_PATTERN.match(header or '')
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        #Suffix range (the last n bytes) needs the final size
+        if not end or size is None:
+            return None
+        return max(0, size - int(end)), size - 1
+    start, end = int(start), int(end) if end else None
+    if (end is not None and end < start) or (size is not None and start >= size):
+        raise ValueError('Unsatisfiable range')
+    if size is not None and (end is None or end >= size):
+        end = size - 1
+    return start, end
+
+def followOutput(job, start=0, end=None):
+    '''
+    Yields a job's output bytes from start up to end (inclusive, None meaning to the end). While the job renders this reads its partial file
+    (see workers.getPartialFile) and waits for each new block to be written, so a client can start playing long before the render is done.
+    '''
+    from megafy.encoder import openEndedWavHeader
+
+    source = None
+    growing = False
+    position = start
+    try:
+        while end is None or position <= end:
+            if source is None:
+                for candidate, isPartial in ((getPartialFile(job), True), (job.outputFile, False)):
+                    #While the job runs only its partial file is current; outputFile may still hold an earlier render of the same input
+                    if isPartial != (job.status == RenderJob.RUNNING) or not path.isfile(candidate):
+                        continue
+                    try:
+                        source = open(candidate, 'rb')
+                    except FileNotFoundError:
+                        #Renamed into place between the check and the open
+                        continue
+                    growing = isPartial
+                    source.seek(position)
+                    break
+
+            chunk = source.read(STREAM_CHUNK_BYTES if end is None else min(STREAM_CHUNK_BYTES, end + 1 - position)) if source is not None else b''
+            if chunk:
+                #The header of a file that's still growing says the audio stops where it currently does
+                if growing and position == 0:
+                    chunk = openEndedWavHeader(chunk)
+                position += len(chunk)
+                yield chunk
+                continue
+
+            if source is not None and not growing:
+                return
+            job.refresh_from_db(fields=['status', 'outputFile'])
+            if job.status == RenderJob.FAILED:
+                return
+            if job.status == RenderJob.DONE:
+                #One more pass reads whatever was written after the last check (the renamed partial file, or the finished file from the cache)
+                growing = False
+                continue
+            sleep(settings.RENDER_STREAM_POLL_INTERVAL)
+    finally:
+        if source is not None:
+            source.close()
+
+@require_GET
+def jobStream(request, jobId):
+    '''
+    Streams a job's audio for playback, starting while the job is still rendering. Single byte Range requests are honoured once the job is done,
+    and while it renders for ranges that have already been written; anything else gets the whole stream from the start.
+    '''
+    job = getRenderingJob(get_object_or_404(RenderJob, pk=jobId))
+    if job.status == RenderJob.FAILED:
+        return jsonError('Render failed', 410)
+    if job.status == RenderJob.QUEUED or not job.outputFile:
+        return jsonError('Render hasn\'t started yet', 409)
+
+    if job.status == RenderJob.DONE:
+        if not path.isfile(job.outputFile):
+            return HttpResponse(status=404)
+        size = path.getsize(job.outputFile)
+    else:
+        size = None
+
+    try:
+        byteRange = parseRange(request.headers.get('Range'), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%s' % (size if size is not None else '*')
+        return response
+
+    #A range of a file that's still growing can only be promised if every byte of it has been written
+    if byteRange is not None and size is None:
+        partialFile = getPartialFile(job)
+        written = path.getsize(partialFile) if path.isfile(partialFile) else 0
+        if byteRange[1] is None or byteRange[1] >= written:
+            byteRange = None
+
+    if byteRange is None:
+        response = StreamingHttpResponse(followOutput(job), content_type=contentTypeFor(job.outputFile))
+        if size is not None:
+            response['Content-Length'] = str(size)
+    else:
+        start, end = byteRange
+        response = StreamingHttpResponse(followOutput(job, start, end), status=206, content_type=contentTypeFor(job.outputFile))
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = 'bytes %d-%d/%s' % (start, end, size if size is not None else '*')
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+def choosePeaksLevel(index, width):
+    '''
+    The coarsest level of a peaks index (see peaks.readPeaksIndex) that still has at least width peaks, so a waveform width pixels wide gets one or more per pixel
+    '''
+    candidates = [entry['level'] for entry in index['levels'] if entry['peaks'] >= width]
+    return max(candidates) if candidates else 0
+
+@require_GET
+def jobPeaks(request, jobId):
+    '''
+    Waveform peaks of a finished job's result (or its input with ?source=input), so a waveform can be drawn without the audio.
+    With no other parameters this returns the levels available as JSON. ?level=n (or ?width=pixels, which picks the level) returns that level
+    as raw int8 (min, max) pairs per channel, see megafy/peaks.py, with its layout in X-Peaks-* headers.
+    Both are built by the worker as part of the job (see workers.runJob), never here, so until the job is done there are none.
+    '''
+    from megafy.peaks import getInputPeaksFile, getPeaksFile, readPeaksIndex, readPeaksLevel
+
+    job = getRenderingJob(get_object_or_404(RenderJob, pk=jobId))
+    source = request.GET.get('source', 'output')
+    if source not in ('input', 'output'):
+        return jsonError('source must be "input" or "output"', 400)
+    if job.status == RenderJob.FAILED:
+        return jsonError('Render failed', 410)
+    if job.status != RenderJob.DONE:
+        return jsonError('Render is still %s' % job.status, 409)
+
+    peaksFile = getInputPeaksFile(job.outputFile) if source == 'input' else getPeaksFile(job.outputFile)
+    if not path.isfile(peaksFile):
+        return jsonError('No peaks for this job', 404)
+    index = readPeaksIndex(peaksFile)
+
+    try:
+        if 'level' in request.GET:
+            level = int(request.GET['level'])
+        elif 'width' in request.GET:
+            level = choosePeaksLevel(index, int(request.GET['width']))
+        else:
+            return JsonResponse(index)
+        data = readPeaksLevel(peaksFile, level)
+    except ValueError as error:
+        return jsonError(str(error), 400)
+
+    response = HttpResponse(data, content_type='application/octet-stream')
+    response['X-Peaks-Level'] = str(level)
+    response['X-Peaks-Channels'] = str(index['channels'])
+    response['X-Peaks-Frames-Per-Peak'] = str(index['levels'][level]['framesPerPeak'])
+    response['X-Peaks-Sample-Rate'] = str(index['sampleRate'])
+    return response
+
+@require_GET
+def metrics(request):
+    '''
+    Render metrics in Prometheus' text format: every worker's saved snapshot and this process's own (previews) added up (see megafy/metrics.py),
+    plus the job queue's depth and how busy the render workers are right now
+    '''
+    from megafy.metrics import mergeSnapshots, registry, renderPrometheus
+
+    counters, histograms = mergeSnapshots(settings.RENDER_METRICS_DIR, [registry.snapshot()])
+    running = RenderJob.objects.filter(status=RenderJob.RUNNING, leader=None).count()
+    gauges = [
+        ('megafy_queue_depth', 'Render jobs waiting for a worker', {}, RenderJob.objects.filter(status=RenderJob.QUEUED, leader=None).count()),
+        ('megafy_queue_followers', 'Unfinished jobs waiting on an identical render', {}, RenderJob.objects.filter(status__in=[RenderJob.QUEUED, RenderJob.RUNNING]).exclude(leader=None).count()),
+        ('megafy_jobs_running', 'Render jobs being rendered', {}, running),
+        ('megafy_workers', 'Render worker processes configured', {}, settings.RENDER_WORKERS),
+        ('megafy_worker_utilization', 'Fraction of render workers rendering a job', {}, running/settings.RENDER_WORKERS if settings.RENDER_WORKERS else 0.0),
+    ]
+    return HttpResponse(renderPrometheus(counters, histograms, gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class UploadRejected(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def acquireUploadSlot(client):
+    '''
+    Counts an upload against client's UPLOAD_MAX_CONCURRENT in the cache. Returns False (and counts nothing) if client is at the limit.
+    '''
+    key = 'megafy-uploads-%s' % client
+    cache.add(key, 0, UPLOAD_SLOT_SECONDS)
+    try:
+        running = cache.incr(key)
+    except ValueError:
+        #Expired between the add and the incr
+        cache.set(key, 1, UPLOAD_SLOT_SECONDS)
+        running = 1
+    if running > settings.UPLOAD_MAX_CONCURRENT:
+        releaseUploadSlot(client)
+        return False
+    return True
+
+def releaseUploadSlot(client):
+    try:
+        cache.decr('megafy-uploads-%s' % client)
+    except ValueError:
+        pass
+
+def getUploadFile(fileName):
+    '''
+    Where an upload named fileName is stored in RENDER_INPUT_DIR: its cleaned up name with a random suffix, so uploads never overwrite each other
+    '''
+    root, extension = path.splitext(path.basename(fileName))
+    root = UPLOAD_NAME_PATTERN.sub('', root).strip(' .') or 'upload'
+    return path.join(settings.RENDER_INPUT_DIR, '%s-%s%s' % (root[:100], token_hex(4), extension.lower()))
+
+@csrf_exempt
+@require_POST
+def uploadFile(request):
+    '''
+    Stores the raw request body (the audio file itself, not a form) in RENDER_INPUT_DIR as it arrives, chunk by chunk, and returns
+    {"file": name} for submitting jobs with. ?name= gives the original file name, whose extension must be in VALID_FILETYPES and match the content.
+    '''
+    from megafy import megafy_script
+    from megafy.ingest import sniffAudioType
+
+    fileName = request.GET.get('name', '')
+    extension = path.splitext(fileName)[1].lower()
+    if extension not in megafy_script.VALID_FILETYPES:
+        return jsonError('?name= must be a file name ending in one of %s' % ', '.join(megafy_script.VALID_FILETYPES), 400)
+    try:
+        size = int(request.headers.get('Content-Length') or '')
+    except ValueError:
+        return jsonError('Content-Length is required', 411)
+    if size > settings.UPLOAD_MAX_BYTES:
+        return jsonError('Uploads are limited to %d bytes' % settings.UPLOAD_MAX_BYTES, 413)
+
+    client = request.META.get('REMOTE_ADDR', '')
+    if not acquireUploadSlot(client):
+        response = jsonError('Too many uploads in progress', 429)
+        response['Retry-After'] = '10'
+        return response
+
+    storedFile = getUploadFile(fileName)
+    partialFile = storedFile + '.part'
+    try:
+        makedirs(settings.RENDER_INPUT_DIR, exist_ok=True)
+        received = 0
+        with open(partialFile, 'wb') as output:
+            header = b''
+            while True:
+                #Read from the request stream directly so the body is never held in memory (request.body would load all of it)
+                chunk = request.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if received > settings.UPLOAD_MAX_BYTES:
+                    raise UploadRejected('Uploads are limited to %d bytes' % settings.UPLOAD_MAX_BYTES, 413)
+                if len(header) < UPLOAD_SNIFF_BYTES:
+                    header += chunk[:UPLOAD_SNIFF_BYTES - len(header)]
+                    if len(header) == UPLOAD_SNIFF_BYTES and sniffAudioType(header) != extension:
+                        raise UploadRejected('Content isn\'t a %s file' % extension[1:], 415)
+                output.write(chunk)
+        if received < size:
+            raise UploadRejected('Upload ended after %d of %d bytes' % (received, size), 400)
+        if sniffAudioType(header) != extension:
+            raise UploadRejected('Content isn\'t a %s file' % extension[1:], 415)
+        replace(partialFile, storedFile)
+    except UploadRejected as error:
+        return jsonError(str(error), error.status)
+    finally:
+        releaseUploadSlot(client)
+        if path.exists(partialFile):
+            unlink(partialFile)
+
+    return JsonResponse({'file': path.basename(storedFile), 'bytes': received}, status=201)
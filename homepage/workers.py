@@ -0,0 +1,360 @@
+from functools import partial
+from multiprocessing import Process
+from os import getpid, path
+from signal import SIG_IGN, SIGTERM, signal
+from time import perf_counter, sleep
+import traceback
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.utils import timezone
+
+from .models import RenderJob
+
+STAGE_NAMES = ['pitchShift', 'bassBoost', 'reverb', 'softClipper']
+
+def claimNextJob():
+    '''
+    Atomically moves the oldest queued job to running and returns it (or None if the queue is empty).
+    The conditional update means two workers can never claim the same job. Followers are never claimed, their leader renders for them.
+    '''
+    for jobId in RenderJob.objects.filter(status=RenderJob.QUEUED, leader=None).values_list('id', flat=True)[:8]:
+        claimed = RenderJob.objects.filter(id=jobId, status=RenderJob.QUEUED).update(status=RenderJob.RUNNING, startedAt=timezone.now(), workerPid=getpid())
+        if claimed:
+            return RenderJob.objects.get(id=jobId)
+    return None
+
+renderCache = None
+
+def getRenderCache():
+    '''
+    This process's handle on the render cache shared by all workers
+    '''
+    global renderCache
+    if renderCache is None:
+        from megafy.render_cache import RenderCache
+        renderCache = RenderCache(settings.RENDER_CACHE_DIR, settings.RENDER_CACHE_BYTES)
+    return renderCache
+
+stageCache = None
+renderSessions = {}
+bufferPool = None
+
+def getBufferPool():
+    '''
+    Buffers this worker decodes whole tracks into (every render path but streaming, which never holds one), reused from job to job
+    '''
+    global bufferPool
+    if bufferPool is None:
+        from megafy.buffer_pool import BufferPool
+        bufferPool = BufferPool(settings.RENDER_BUFFER_POOL_BYTES)
+    return bufferPool
+
+def getRenderSession(sampleRate=None):
+    '''
+    The engine (and loaded plugins) this worker reuses for every job rendered at sampleRate (SAMPLE_RATE if None), whatever the render path
+    '''
+    from megafy.megafy_script import SAMPLE_RATE, makeSession
+
+    sampleRate = sampleRate or SAMPLE_RATE
+    if sampleRate not in renderSessions:
+        renderSessions[sampleRate] = makeSession(settings.RENDER_BACKEND, sampleRate=sampleRate)
+    return renderSessions[sampleRate]
+
+def chooseRender(info):
+    '''
+    Picks the render path for a job whose input info (an ingest.AudioInfo) describes and returns it with the options (sample rate, resampler) to pass it. With RENDER_INCREMENTAL_MAX_SECONDS set, tracks short enough to keep stage outputs for are rendered incrementally so parameter tweaks only redo the changed stages.
+    Everything else is split across RENDER_SEGMENT_WORKERS processes when that's set, or streamed so a worker's memory stays flat however long the track is.
+    '''
+    global stageCache
+    from megafy import megafy_script, streaming
+    from megafy.incremental import StageCache, megafyFileIncremental
+
+    options = {'sampleRate': settings.RENDER_SAMPLE_RATE, 'resampleQuality': settings.RENDER_RESAMPLE_QUALITY, 'outputFormat': settings.RENDER_OUTPUT_FORMAT}
+    #The rate the render path will settle on (see megafy_script.getProcessingRate), worked out from info so nothing probes the file again
+    sampleRate = settings.RENDER_SAMPLE_RATE or (info.sampleRate if info.sampleRate in megafy_script.PROCESSING_RATES else megafy_script.SAMPLE_RATE)
+    session = getRenderSession(sampleRate)
+
+    if settings.RENDER_INCREMENTAL_MAX_SECONDS and info.duration <= settings.RENDER_INCREMENTAL_MAX_SECONDS:
+        if stageCache is None:
+            stageCache = StageCache(settings.RENDER_STAGE_CACHE_DIR, settings.RENDER_STAGE_CACHE_BYTES)
+        return partial(megafyFileIncremental, stageCache=stageCache, session=session, bufferPool=getBufferPool()), options
+    if settings.RENDER_SEGMENT_WORKERS:
+        from megafy.segments import megafyFileSegmented
+        return partial(megafyFileSegmented, workers=settings.RENDER_SEGMENT_WORKERS, bufferPool=getBufferPool()), options
+    if settings.RENDER_STREAMING:
+        return partial(streaming.megafyFileStreaming, session=session, bufferPool=getBufferPool()), options
+    return partial(megafy_script.megafyFile, session=session, bufferPool=getBufferPool()), options
+
+def getJobRenderKey(inputFile, stages):
+    '''
+    What makes two submitted renders identical: the input's content, the normalized stage choices (stages as stored on a job) and the render settings
+    '''
+    from megafy.megafy_script import normalizeStages
+    from megafy.render_cache import hashFileCached, renderKey
+
+    options = {'sampleRate': settings.RENDER_SAMPLE_RATE, 'resampleQuality': settings.RENDER_RESAMPLE_QUALITY, 'outputFormat': settings.RENDER_OUTPUT_FORMAT}
+    return renderKey(hashFileCached(inputFile), normalizeStages(*[stages.get(name, False) for name in STAGE_NAMES]), settings.RENDER_BACKEND, options)
+
+def submitRender(inputFile, preset, stages):
+    '''
+    Queues a render and returns its job. If an identical render is already queued or running the new job becomes its follower instead
+    of being rendered again, and finishes with the leader's result.
+    '''
+    key = getJobRenderKey(inputFile, stages)
+    while True:
+        leader = RenderJob.objects.filter(renderKey=key, leader=None, status__in=[RenderJob.QUEUED, RenderJob.RUNNING]).first()
+        try:
+            with transaction.atomic():
+                job = RenderJob.objects.create(inputFile=inputFile, preset=preset, stages=stages, renderKey=key, leader=leader)
+            break
+        except IntegrityError:
+            #An identical submission became the leader between the lookup and the create (the model allows one per key), so look again and follow it
+            continue
+
+    #The leader may have finished between the lookup and the create, after it passed its result on to its followers. Whichever of the two checks second catches it
+    if leader is not None:
+        leader.refresh_from_db()
+        if leader.status in (RenderJob.DONE, RenderJob.FAILED):
+            finishFollowers(leader)
+            job.refresh_from_db()
+    return job
+
+def finishFollowers(leader):
+    '''
+    Gives every unfinished follower of a finished leader the leader's outcome. Returns how many followers were finished.
+    '''
+    return RenderJob.objects.filter(leader=leader, status__in=[RenderJob.QUEUED, RenderJob.RUNNING]).update(
+        status=leader.status,
+        progress=leader.progress,
+        outputFile=leader.outputFile,
+        error=leader.error,
+        finishedAt=leader.finishedAt or timezone.now(),
+    )
+
+def getJobOutputFile(job):
+    '''
+    Where a job's result goes: the usual Output name (see getOutputFile) with the job's id appended, so concurrent jobs on the same input never write the same file
+    '''
+    from megafy import megafy_script
+
+    root, extension = path.splitext(megafy_script.getOutputFile(job.inputFile, settings.RENDER_OUTPUT_FORMAT))
+    return '%s-%d%s' % (root, job.pk, extension)
+
+def getPartialFile(job):
+    '''
+    Where a running job's output is written until it's complete (next to its outputFile)
+    '''
+    root, extension = path.splitext(job.outputFile)
+    return '%s.part%s' % (root, extension)
+
+def getRenderName(render):
+    '''
+    Short name of a render path from chooseRender, for metric labels (e.g. 'megafyFileStreaming')
+    '''
+    return getattr(render, 'func', render).__name__
+
+def estimateJobBytes(job, info, render):
+    '''
+    How much memory rendering job (its input described by info) along render (from chooseRender) may take at its peak, see memory_budget.estimatePeakBytes
+    '''
+    from megafy.memory_budget import estimatePeakBytes
+
+    mode = {'megafyFileStreaming': 'streaming', 'megafyFileSegmented': 'segmented'}.get(getRenderName(render), 'full')
+    return estimatePeakBytes(info, [job.stages.get(name, False) for name in STAGE_NAMES], mode, settings.RENDER_SAMPLE_RATE, settings.RENDER_SEGMENT_WORKERS)
+
+def trackProgress(job, info):
+    '''
+    A metrics hook (see metrics.addHook) that keeps job.progress up to date from the frames the encoder writes, at most every RENDER_PROGRESS_INTERVAL seconds.
+    Stays below 1 until the job is done, since the expected length is only an estimate. info describes the job's input.
+    '''
+    from megafy.megafy_script import getTimeRatio
+
+    expectedFrames = max(1.0, info.duration*(settings.RENDER_SAMPLE_RATE or info.sampleRate)*getTimeRatio(job.stages.get('pitchShift', False)))
+    state = {'frames': 0, 'savedAt': 0.0}
+
+    def hook(kind, name, value, labels):
+        if name != 'megafy_output_frames_total':
+            return
+        state['frames'] += value
+        if perf_counter() - state['savedAt'] >= settings.RENDER_PROGRESS_INTERVAL:
+            state['savedAt'] = perf_counter()
+            RenderJob.objects.filter(pk=job.pk).update(progress=min(0.99, state['frames']/expectedFrames))
+
+    return hook
+
+def recordJobMetrics(job, info, renderName, seconds):
+    '''
+    Adds a finished job to this worker's metrics: its wall time, how much audio it covered (from info, None if the input couldn't be probed) and how many times real time it took
+    '''
+    from megafy import metrics
+
+    metrics.increment('megafy_jobs_total', status=job.status)
+    metrics.increment('megafy_worker_busy_seconds_total', seconds)
+    metrics.observe('megafy_job_seconds', seconds, render=renderName)
+    if job.status == RenderJob.DONE and info is not None:
+        duration = info.duration
+        metrics.increment('megafy_audio_seconds_total', duration)
+        if duration > 0:
+            metrics.observe('megafy_realtime_factor', seconds/duration, render=renderName)
+
+def runJob(job, budget=None, slot=0):
+    '''
+    Renders a claimed job with megafyFile and records the outcome on the job and its followers.
+    The output path is saved before rendering starts so the job's partial output can be streamed while it renders (see views.jobStream).
+    With budget (a memory_budget.MemoryBudget shared by the workers, slot being this worker's) rendering waits until the job's estimated memory fits.
+    Render cache hits need next to no memory, so they never wait for the budget.
+    '''
+    from megafy.ingest import probeAudio
+    from megafy.metrics import addHook, removeHook, timer
+    from megafy.peaks import getInputPeaksFile, getPeaksFile
+
+    started = perf_counter()
+    renderName = 'unknown'
+    admitted = False
+    progressHook = None
+    info = None
+    try:
+        #Probed once for everything below: probing an MP3 starts a decoder process
+        info = probeAudio(job.inputFile)
+        render, renderOptions = chooseRender(info)
+        renderName = getRenderName(render)
+        job.outputFile = getJobOutputFile(job)
+        job.save(update_fields=['outputFile'])
+
+        def admit():
+            nonlocal admitted
+            if budget is not None:
+                with timer('admission'):
+                    admitted = budget.acquire(slot, estimateJobBytes(job, info, render))
+
+        progressHook = trackProgress(job, info)
+        addHook(progressHook)
+        if getRenderCache().renderFile(job.inputFile, *[job.stages.get(name, False) for name in STAGE_NAMES], outputFile=job.outputFile, render=render, backend=settings.RENDER_BACKEND, partialFile=getPartialFile(job), peaksFile=getPeaksFile(job.outputFile), beforeRender=admit, **renderOptions):
+            renderName = 'cache'
+        #The input's waveform too, so views.jobPeaks never has to decode anything. The result is fine without it, so a failure only gets printed
+        try:
+            getRenderCache().placeInputPeaks(job.inputFile, getInputPeaksFile(job.outputFile))
+        except Exception:
+            traceback.print_exc()
+    except Exception:
+        job.status = RenderJob.FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = RenderJob.DONE
+        job.progress = 1.0
+    finally:
+        if progressHook is not None:
+            removeHook(progressHook)
+        if admitted:
+            budget.release(slot)
+    job.finishedAt = timezone.now()
+    job.save(update_fields=['status', 'progress', 'outputFile', 'error', 'finishedAt'])
+    finishFollowers(job)
+    recordJobMetrics(job, info, renderName, perf_counter() - started)
+
+def saveMetrics():
+    '''
+    Publishes this worker's metrics for views.metrics. Losing a snapshot only delays the numbers, so failures are just printed.
+    '''
+    from megafy.metrics import writeSnapshot
+
+    try:
+        writeSnapshot(settings.RENDER_METRICS_DIR)
+    except OSError:
+        traceback.print_exc()
+
+def warmUpWorker():
+    '''
+    Does before the first job what it would otherwise pay for: warms the session jobs render with at RENDER_SAMPLE_RATE (see chooseRender),
+    imports the render paths and, with RENDER_SEGMENT_WORKERS, starts the segment workers and loads their plugins
+    '''
+    from importlib import import_module
+
+    from megafy.megafy_script import SAMPLE_RATE, warmUp
+
+    warmUp(getRenderSession(settings.RENDER_SAMPLE_RATE))
+    for module in ('megafy.streaming', 'megafy.incremental', 'megafy.render_cache'):
+        import_module(module)
+    if settings.RENDER_SEGMENT_WORKERS:
+        from megafy.segments import getSegmentPool
+        #Pool processes warm up in their initializer as they start, and the pool starts one for every task that finds none idle
+        pool = getSegmentPool(settings.RENDER_SEGMENT_WORKERS, settings.RENDER_BACKEND, settings.RENDER_SAMPLE_RATE or SAMPLE_RATE)
+        for future in [pool.submit(int) for _ in range(settings.RENDER_SEGMENT_WORKERS)]:
+            future.result()
+
+def workerLoop(pollInterval, budget=None, slot=0):
+    '''
+    Body of a long-lived render worker process: claims and renders jobs until killed. budget and slot are passed on to runJob.
+    '''
+    from megafy.presets import watchPresets
+
+    #Started here rather than in the parent, whose threads don't survive the fork
+    watchPresets(settings.PRESET_RELOAD_INTERVAL)
+    #A broken setup still leaves the worker running so its jobs fail with the error
+    try:
+        warmUpWorker()
+    except Exception:
+        traceback.print_exc()
+    saveMetrics()
+
+    #terminate() would otherwise kill this process on the spot and leave its segment workers running
+    signal(SIGTERM, stopWorker)
+    try:
+        while True:
+            close_old_connections()
+            job = claimNextJob()
+            if job is None:
+                sleep(pollInterval)
+            else:
+                runJob(job, budget, slot)
+                saveMetrics()
+    finally:
+        #Not interrupted by a second terminate() partway through
+        signal(SIGTERM, SIG_IGN)
+        if settings.RENDER_SEGMENT_WORKERS:
+            from megafy.segments import shutdownSegmentPools
+            shutdownSegmentPools()
+
+def stopWorker(signalNumber, frame):
+    raise SystemExit(0)
+
+def requeueInterruptedJobs():
+    '''
+    Puts jobs that were running when the worker tier last stopped back in the queue
+    '''
+    return RenderJob.objects.filter(status=RenderJob.RUNNING).update(status=RenderJob.QUEUED, startedAt=None, workerPid=None, progress=0.0)
+
+def failOrphanedJobs(workerPid, exitCode):
+    '''
+    Fails the job a dead worker was rendering, and its followers. It isn't requeued since a job that crashes its worker would otherwise crash every worker in turn.
+    '''
+    orphans = list(RenderJob.objects.filter(status=RenderJob.RUNNING, workerPid=workerPid))
+    failed = RenderJob.objects.filter(pk__in=[job.pk for job in orphans], status=RenderJob.RUNNING).update(
+        status=RenderJob.FAILED,
+        error='Render worker %s died with exit code %s' % (workerPid, exitCode),
+        finishedAt=timezone.now(),
+    )
+    for job in orphans:
+        job.refresh_from_db()
+        finishFollowers(job)
+    return failed
+
+def getMemoryBudget(workers):
+    '''
+    The admission budget shared by a tier of workers render worker processes (see memory_budget.py), or None when RENDER_MEMORY_BUDGET is 0
+    '''
+    if not settings.RENDER_MEMORY_BUDGET:
+        return None
+    from megafy.memory_budget import MemoryBudget
+    return MemoryBudget(settings.RENDER_MEMORY_BUDGET, workers)
+
+def startWorker(pollInterval=None, budget=None, slot=0):
+    if pollInterval is None:
+        pollInterval = settings.RENDER_POLL_INTERVAL
+    #Forked children must not share the parent's database connection
+    connections.close_all()
+    #Daemon processes can't start the segment worker pool of their own, so segmented workers are left non-daemon (renderworkers still terminates them)
+    worker = Process(target=workerLoop, args=(pollInterval, budget, slot), daemon=not settings.RENDER_SEGMENT_WORKERS)
+    worker.start()
+    return worker
@@ -8,9 +8,31 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 """
 
 import os
+import re
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'megafy.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+#Imported once Django is set up, since they touch models and settings
+from django.conf import settings
+from homepage.events import jobEventsApp
+from megafy.preview import startPreviewWarmUp
+from megafy.presets import watchPresets
+
+#Presets are read now, and re-read off the request path when their files change, so requests never wait on the Presets folder
+watchPresets(settings.PRESET_RELOAD_INTERVAL)
+#Previews render in this process, so their sessions and audio libraries are loaded in the background now rather than by the first preview
+startPreviewWarmUp(settings.RENDER_BACKEND)
+
+#Django 4.0 runs streaming responses synchronously inside the event loop, so job event streams bypass it (see homepage/events.py)
+JOB_EVENTS_PATH = re.compile(r'^/homepage/jobs/(\d+)/events/$')
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        match = JOB_EVENTS_PATH.match(scope['path'])
+        if match:
+            return await jobEventsApp(scope, receive, send, int(match.group(1)))
+    return await django_application(scope, receive, send)
@@ -0,0 +1,141 @@
+'''
+Megafies a whole directory (or glob) of files with one preset, spread across every core.
+
+    python -m megafy.batch "D:\\Catalogue" --preset Default --output "D:\\Megafied"
+    python -m megafy.batch "catalogue/**/*.mp3" --preset "Default - Copy" --workers 8
+
+Finished files are recorded in a manifest inside the output directory, so re-running the same command resumes an interrupted batch
+and skips every file whose output is already up to date (same input size/mtime and same preset values). Pass --force to redo everything.
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import escape, glob
+from os import cpu_count, listdir, makedirs, path, replace, stat
+from time import monotonic, perf_counter
+import json
+
+from .megafy_script import BACKENDS, DEFAULT_BACKEND, DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, VALID_FILETYPES, makeSession, megafyFile, normalizeStages, readPreset, warmUp
+
+MANIFEST_NAME = '.megafy-batch.json'
+#How often (at most) the manifest is rewritten while files are finishing
+MANIFEST_SAVE_SECONDS = 2.0
+
+#Each pool process keeps one engine (and its loaded plugins) for every file it renders
+workerSession = None
+
+def initWorker(backend=None):
+    global workerSession
+    workerSession = warmUp(makeSession(backend))
+
+def renderOne(inputFile, outputFile, stages, outputFormat=None):
+    '''
+    Runs in a pool process. Returns (inputFile, audio seconds, wall seconds).
+    '''
+    started = perf_counter()
+    info = megafyFile(inputFile, *stages, outputFile=outputFile, session=workerSession, outputFormat=outputFormat)
+    return inputFile, info.duration, perf_counter() - started
+
+def findInputs(source, recursive=False):
+    '''
+    Every megafiable file in a directory (or matching a glob), sorted so batches always run in the same order
+    '''
+    if path.isdir(source):
+        if recursive:
+            candidates = glob(path.join(escape(source), '**', '*'), recursive=True)
+        else:
+            candidates = [path.join(source, name) for name in listdir(source)]
+    else:
+        candidates = glob(source, recursive=True)
+    return sorted(path.abspath(file) for file in candidates if path.isfile(file) and path.splitext(file)[1].lower() in VALID_FILETYPES)
+
+def loadManifest(outputDir):
+    try:
+        with open(path.join(outputDir, MANIFEST_NAME)) as manifestFile:
+            return json.load(manifestFile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def saveManifest(outputDir, manifest):
+    manifestPath = path.join(outputDir, MANIFEST_NAME)
+    with open(manifestPath+'.part', 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1, sort_keys=True)
+    replace(manifestPath+'.part', manifestPath)
+
+def fingerprint(inputFile, signature):
+    status = stat(inputFile)
+    return {'size': status.st_size, 'mtime': status.st_mtime_ns, 'stages': signature}
+
+def megafyBatch(source, presetOption, outputDir, workers=None, recursive=False, force=False, backend=None, outputFormat=None, log=print):
+    '''
+    Megafies every file found by findInputs(source) with the given preset into outputDir (one file per input, encoded in outputFormat), using a pool of workers processes.
+    Returns (files rendered, audio seconds rendered, wall seconds).
+    '''
+    stages = readPreset(presetOption)
+    outputFormat = outputFormat or DEFAULT_OUTPUT_FORMAT
+    signature = json.dumps([normalizeStages(*stages), backend or DEFAULT_BACKEND, outputFormat])
+    makedirs(outputDir, exist_ok=True)
+    manifest = {} if force else loadManifest(outputDir)
+
+    jobs = {}
+    claimedOutputs = set()
+    skipped = 0
+    for inputFile in findInputs(source, recursive):
+        outputFile = path.join(outputDir, path.splitext(path.basename(inputFile))[0]+OUTPUT_FORMATS[outputFormat]['extension'])
+        if outputFile in claimedOutputs:
+            log('SKIP %s: another input already renders to %s' % (inputFile, outputFile))
+            continue
+        claimedOutputs.add(outputFile)
+        if manifest.get(inputFile) == fingerprint(inputFile, signature) and path.isfile(outputFile):
+            skipped += 1
+            continue
+        jobs[inputFile] = outputFile
+    log('%d file(s) to megafy, %d already up to date' % (len(jobs), skipped))
+
+    rendered = 0
+    audioSeconds = 0.0
+    started = perf_counter()
+    lastSave = monotonic()
+    with ProcessPoolExecutor(max_workers=workers or cpu_count(), initializer=initWorker, initargs=(backend,)) as pool:
+        futures = {pool.submit(renderOne, inputFile, outputFile, stages, outputFormat): inputFile for inputFile, outputFile in jobs.items()}
+        try:
+            for future in as_completed(futures):
+                try:
+                    inputFile, seconds, wallSeconds = future.result()
+                except Exception as error:
+                    log('FAILED %s: %s' % (futures[future], error))
+                    continue
+
+                rendered += 1
+                audioSeconds += seconds
+                manifest[inputFile] = fingerprint(inputFile, signature)
+                log('[%d/%d] %s: %.1fs of audio in %.1fs (%.1fx real time)' % (rendered, len(jobs), path.basename(inputFile), seconds, wallSeconds, seconds/wallSeconds if wallSeconds else 0))
+
+                if monotonic() - lastSave >= MANIFEST_SAVE_SECONDS:
+                    saveManifest(outputDir, manifest)
+                    lastSave = monotonic()
+        finally:
+            #Also runs on Ctrl+C, so everything finished so far is skipped next time
+            for future in futures:
+                future.cancel()
+            saveManifest(outputDir, manifest)
+
+    wallSeconds = perf_counter() - started
+    log('Megafied %d file(s): %.1fs of audio in %.1fs (%.2f audio-seconds per wall-second)' % (rendered, audioSeconds, wallSeconds, audioSeconds/wallSeconds if wallSeconds else 0))
+    return rendered, audioSeconds, wallSeconds
+
+def main(argv=None):
+    parser = ArgumentParser(description='Megafy every file in a directory or glob with one preset, across all cores.')
+    parser.add_argument('source', help='Directory or glob of .mp3/.wav files')
+    parser.add_argument('--preset', default='Default', help='Preset name from megafy/Presets (default: Default)')
+    parser.add_argument('--output', default=path.join(path.dirname(__file__), 'Output'), help='Directory the results are written to (default: megafy/Output)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per core)')
+    parser.add_argument('--recursive', action='store_true', help='Include subdirectories when source is a directory')
+    parser.add_argument('--force', action='store_true', help='Ignore the manifest and re-render everything')
+    parser.add_argument('--backend', choices=BACKENDS, default=None, help='Render backend (default: MEGAFY_BACKEND or dawdreamer)')
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default=None, help='How results are encoded (default: MEGAFY_OUTPUT_FORMAT or wav24)')
+    arguments = parser.parse_args(argv)
+
+    megafyBatch(arguments.source, arguments.preset, arguments.output, workers=arguments.workers, recursive=arguments.recursive, force=arguments.force, backend=arguments.backend, outputFormat=arguments.format)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''
+Benchmarks the render pipeline stage by stage on synthetic input, and checks it against a saved baseline.
+
+    python -m megafy.benchmark                      #Run and print the results
+    python -m megafy.benchmark --update-baseline    #Run and save the results as the baseline
+    python -m megafy.benchmark --check              #Run and exit with status 1 if any stage regressed past the tolerance (2 without a baseline)
+
+Inputs are stereo WAVs (tones, a kick pattern and noise) generated into a temporary directory for every case in CASES, so no files are needed.
+Each case is decoded, run through every stage of megafyFile one at a time and encoded, and for every step the benchmark reports
+wall time (fastest of --runs), real-time factor (wall time / audio length, below 1 is faster than real time), peak RSS and peak traced allocations.
+'''
+from argparse import ArgumentParser
+from os import cpu_count, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import platform
+import sys
+import tracemalloc
+
+import numpy as np
+import soundfile as sf
+
+from .encoder import encodeAudio
+from .incremental import STAGE_NAMES, renderStage
+from .ingest import decodeAudio
+from .megafy_script import DEFAULT_BACKEND, SAMPLE_RATE, makeSession, warmUp
+
+#(seconds, sample rate) of each synthetic input. 48 kHz cases include resampling in their decode
+CASES = [(10, 44100), (60, 44100), (60, 48000), (300, 44100)]
+QUICK_CASES = [(10, 44100), (10, 48000)]
+#Every stage enabled, with settings close to the Default preset
+BENCHMARK_STAGES = ([-2.0], [0.525, 0.272, 0.7, 0.5], [0.2, 0.333333, 0.0, 1.0], [1.0, 0.5, 0.0, 0.0, 1.0])
+BASELINE_FILE = path.join(path.dirname(__file__), 'benchmark_baseline.json')
+RUNS = 3
+#How much slower (wall time) or bigger (peak allocations) than the baseline a step may get before --check fails
+TOLERANCE = 0.25
+#Steps faster than this are too noisy to compare
+MIN_COMPARED_SECONDS = 0.05
+SEED = 1984
+
+def makeSyntheticInput(file, seconds, sampleRate, seed=SEED):
+    '''
+    Writes a reproducible stereo 16-bit WAV: a bass line and a chord (slightly detuned per channel), a kick every half second and quiet noise
+    '''
+    random = np.random.default_rng(seed)
+    time = np.arange(int(seconds*sampleRate))/sampleRate
+    channels = []
+    for detune in (1.0, 1.003):
+        signal = 0.25*np.sin(2*np.pi*55*detune*time)
+        signal += sum(0.08*np.sin(2*np.pi*frequency*detune*time) for frequency in (261.6, 329.6, 392.0))
+        beat = time % 0.5
+        signal += 0.4*np.sin(2*np.pi*(50 + 100*np.exp(-beat*30))*beat)*np.exp(-beat*12)
+        signal += 0.02*random.standard_normal(time.shape[0])
+        channels.append(signal)
+    sf.write(file, np.clip(np.stack(channels, axis=1), -1, 1), sampleRate, subtype='PCM_16')
+
+def readPeakRss():
+    '''
+    Peak resident memory in bytes since the last resetPeakRss (Linux), or since the process started (elsewhere). None if it can't be read.
+    '''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    #ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+def resetPeakRss():
+    '''
+    Restarts peak RSS tracking so readPeakRss covers only what follows. Only possible on Linux; elsewhere peaks are for the whole process.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clearRefs:
+            clearRefs.write('5')
+    except OSError:
+        pass
+
+def measure(step, runs):
+    '''
+    Runs step() runs times untraced for the fastest wall time, then once under tracemalloc for peak allocations.
+    Returns (result of the last run, measurements).
+    '''
+    wall = None
+    resetPeakRss()
+    for _ in range(runs):
+        started = perf_counter()
+        result = step()
+        elapsed = perf_counter() - started
+        wall = elapsed if wall is None else min(wall, elapsed)
+    peakRss = readPeakRss()
+
+    tracemalloc.start()
+    try:
+        step()
+        _, peakAllocated = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {'seconds': wall, 'peakRss': peakRss, 'peakAllocated': peakAllocated}
+
+def benchmarkCase(directory, seconds, sampleRate, session, runs=RUNS, log=print):
+    '''
+    Benchmarks decode, every stage and encode on one synthetic input. Returns {step name: measurements}.
+    '''
+    inputFile = path.join(directory, 'input-%ds-%d.wav' % (seconds, sampleRate))
+    makeSyntheticInput(inputFile, seconds, sampleRate)
+
+    results = {}
+    def record(name, step):
+        result, measurements = measure(step, runs)
+        measurements['rtf'] = measurements['seconds']/seconds
+        results[name] = measurements
+        log('  %-12s %8.3fs  rtf %.4f  peak rss %s  peak alloc %s' % (name, measurements['seconds'], measurements['rtf'], formatBytes(measurements['peakRss']), formatBytes(measurements['peakAllocated'])))
+        return result
+
+    audio = record('decode', lambda: np.ascontiguousarray(decodeAudio(inputFile, SAMPLE_RATE)[0], dtype=np.float32))
+    for index, choice in enumerate(BENCHMARK_STAGES):
+        stageInput = audio
+        audio = record(STAGE_NAMES[index], lambda: np.ascontiguousarray(renderStage(session, index, stageInput, choice), dtype=np.float32))
+    record('encode', lambda: encodeAudio(path.join(directory, 'output.wav'), audio, SAMPLE_RATE))
+    return results
+
+def formatBytes(count):
+    if count is None:
+        return '-'
+    return '%.1f MiB' % (count/2**20)
+
+def machineInfo(backend):
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': cpu_count(), 'backend': backend}
+
+def runBenchmarks(cases=CASES, backend=None, runs=RUNS, log=print):
+    '''
+    Benchmarks every (seconds, sample rate) case. Returns {'machine': ..., 'cases': {case name: {step name: measurements}}}.
+    '''
+    backend = backend or DEFAULT_BACKEND
+    session = warmUp(makeSession(backend))
+    report = {'machine': machineInfo(backend), 'cases': {}}
+    with TemporaryDirectory() as directory:
+        for seconds, sampleRate in cases:
+            name = '%ds@%d' % (seconds, sampleRate)
+            log(name)
+            report['cases'][name] = benchmarkCase(directory, seconds, sampleRate, session, runs, log)
+    return report
+
+def compareWithBaseline(report, baseline, tolerance=TOLERANCE):
+    '''
+    Returns a message for every step that got slower or allocated more than tolerance past the baseline
+    '''
+    regressions = []
+    for caseName, steps in report['cases'].items():
+        for stepName, measurements in steps.items():
+            reference = baseline.get('cases', {}).get(caseName, {}).get(stepName)
+            if reference is None:
+                continue
+            if reference['seconds'] >= MIN_COMPARED_SECONDS and measurements['seconds'] > reference['seconds']*(1 + tolerance):
+                regressions.append('%s %s: %.3fs vs %.3fs baseline' % (caseName, stepName, measurements['seconds'], reference['seconds']))
+            if measurements['peakAllocated'] > reference['peakAllocated']*(1 + tolerance):
+                regressions.append('%s %s: %s allocated vs %s baseline' % (caseName, stepName, formatBytes(measurements['peakAllocated']), formatBytes(reference['peakAllocated'])))
+    return regressions
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark the render pipeline stage by stage on synthetic input.')
+    parser.add_argument('--backend', default=None, help='Render backend (default: MEGAFY_BACKEND or dawdreamer)')
+    parser.add_argument('--runs', type=int, default=RUNS, help='Timed runs per step, the fastest counts (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true', help='Only run the short cases')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline JSON file (default: megafy/benchmark_baseline.json)')
+    parser.add_argument('--update-baseline', action='store_true', help='Save this run as the baseline')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if any step regressed against the baseline, 2 if there is no baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Allowed slowdown/growth as a fraction (default: %(default)s)')
+    arguments = parser.parse_args(argv)
+
+    #Looked for before anything runs, since a check that can't compare anything must not pass
+    if arguments.check and not arguments.update_baseline and not path.exists(arguments.baseline):
+        print('No baseline at %s. Record one with --update-baseline' % arguments.baseline)
+        return 2
+
+    report = runBenchmarks(QUICK_CASES if arguments.quick else CASES, arguments.backend, max(1, arguments.runs))
+
+    if arguments.update_baseline:
+        with open(arguments.baseline, 'w') as baselineFile:
+            json.dump(report, baselineFile, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % arguments.baseline)
+
+    if arguments.check:
+        with open(arguments.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline.get('machine') != report['machine']:
+            print('Warning: the baseline was recorded on %s' % baseline.get('machine'))
+        regressions = compareWithBaseline(report, baseline, arguments.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+        print('No regressions against %s' % arguments.baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
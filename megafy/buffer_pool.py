@@ -0,0 +1,70 @@
+'''
+Reusable audio buffers, so a worker rendering one track after another doesn't allocate (and fault in) fresh arrays for every one.
+
+Buffers come in power-of-two size classes. take hands out a C-contiguous (channels, frames) view of the smallest free buffer that fits, and give
+puts it back once nothing uses it any more. Up to maxBytes of free buffers are kept; past that, given back buffers are simply dropped.
+'''
+from threading import Lock
+from weakref import WeakValueDictionary
+
+import numpy as np
+
+#Smallest size class in samples (channels x frames), so short clips share a few small buffers
+MIN_CLASS_SAMPLES = 1 << 16
+
+def getSizeClass(samples):
+    return max(MIN_CLASS_SAMPLES, 1 << (int(samples) - 1).bit_length())
+
+class BufferPool:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.freeBytes = 0
+        self.free = {}
+        #Buffers currently handed out, by id. Weak, so a buffer that's never given back is just freed
+        self.lent = WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def take(self, channels, frames, dtype=np.float32):
+        '''
+        An uninitialized C-contiguous (channels, frames) array of dtype. Hand it back with give once it (and every view of it) is no longer used.
+        '''
+        dtype = np.dtype(dtype)
+        key = (getSizeClass(channels*frames), dtype.str)
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                buffer = buffers.pop()
+                self.freeBytes -= buffer.nbytes
+                self.hits += 1
+            else:
+                buffer = None
+                self.misses += 1
+        if buffer is None:
+            buffer = np.empty(key[0], dtype=dtype)
+        with self.lock:
+            self.lent[id(buffer)] = buffer
+        return buffer[:channels*frames].reshape(channels, frames)
+
+    def give(self, view):
+        '''
+        Returns an array from take to the pool. Anything else is ignored, so callers can give back whatever they ended up with.
+        '''
+        buffer = view
+        with self.lock:
+            #Views of views keep pointing at the array that owns the memory
+            while buffer is not None and self.lent.get(id(buffer)) is not buffer:
+                buffer = buffer.base if isinstance(buffer, np.ndarray) else None
+            if buffer is None:
+                return
+            del self.lent[id(buffer)]
+            if self.freeBytes + buffer.nbytes > self.maxBytes:
+                return
+            self.free.setdefault((buffer.shape[0], buffer.dtype.str), []).append(buffer)
+            self.freeBytes += buffer.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.free.clear()
+            self.freeBytes = 0
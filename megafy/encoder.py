@@ -0,0 +1,94 @@
+from os import makedirs, path
+import struct
+
+import numpy as np
+import soundfile as sf
+
+from .megafy_script import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS
+from .metrics import increment, timer
+from .peaks import PeakBuilder
+
+#Frames encoded per write when a whole buffer is handed over at once, so converting to integer samples never copies the full track
+ENCODE_BLOCK_FRAMES = 1 << 16
+#Stands in for the RIFF and data chunk sizes of a WAV that is still being written, meaning "read until the stream ends"
+UNKNOWN_WAV_SIZE = 0xFFFFFFFF
+
+class AudioEncoder:
+    '''
+    Encodes (channels, frames) float blocks to outputFile in one of OUTPUT_FORMATS as they're rendered.
+    The file is flushed after every block, so anything reading it while the render runs (see homepage.views.jobStream) always sees everything written so far.
+    With peaksFile the waveform peaks of everything written are built in the same pass and saved there on close (see peaks.py).
+    '''
+    def __init__(self, outputFile, sampleRate, channels, outputFormat=None, peaksFile=None):
+        outputFormat = outputFormat or DEFAULT_OUTPUT_FORMAT
+        if outputFormat not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format %r (choose from %s)' % (outputFormat, ', '.join(OUTPUT_FORMATS)))
+        settings = OUTPUT_FORMATS[outputFormat]
+
+        if path.dirname(outputFile):
+            makedirs(path.dirname(outputFile), exist_ok=True)
+        self.outputFile = outputFile
+        self.outputFormat = outputFormat
+        self.frames = 0
+        #Every block is clipped into this, already interleaved (frames, channels) the way libsndfile takes it, so nothing is allocated or transposed per block
+        self.scratch = np.empty((ENCODE_BLOCK_FRAMES, channels), dtype=np.float32)
+        self.peaksFile = peaksFile
+        self.peaks = PeakBuilder(channels, sampleRate) if peaksFile else None
+        self.soundFile = sf.SoundFile(outputFile, 'w', sampleRate, channels, subtype=settings['subtype'], format=settings['format'])
+
+    def write(self, block):
+        '''
+        Encodes block (channels, frames). Samples past full scale are clipped, since integer formats would otherwise wrap them around.
+        '''
+        with timer('encode'):
+            for start in range(0, block.shape[-1], ENCODE_BLOCK_FRAMES):
+                piece = block[:, start:start + ENCODE_BLOCK_FRAMES]
+                clipped = np.clip(piece.T, -1.0, 1.0, out=self.scratch[:piece.shape[1]], casting='unsafe')
+                self.soundFile.write(clipped)
+                if self.peaks is not None:
+                    self.peaks.add(clipped)
+            self.soundFile.flush()
+        self.frames += block.shape[-1]
+        increment('megafy_output_frames_total', block.shape[-1])
+
+    def close(self):
+        if self.soundFile.closed:
+            return
+        self.soundFile.close()
+        if self.peaks is not None:
+            self.peaks.write(self.peaksFile)
+        increment('megafy_output_bytes_total', path.getsize(self.outputFile), format=self.outputFormat)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def encodeAudio(outputFile, audio, sampleRate, outputFormat=None, peaksFile=None):
+    '''
+    Writes a whole (channels, frames) buffer to outputFile in outputFormat, and its peaks to peaksFile if given (see AudioEncoder)
+    '''
+    with AudioEncoder(outputFile, sampleRate, audio.shape[0], outputFormat, peaksFile) as encoder:
+        encoder.write(audio)
+
+def openEndedWavHeader(header):
+    '''
+    Takes the start of a WAV that is still being written (at least up to its data chunk's header) and returns it with the RIFF and data sizes
+    set to UNKNOWN_WAV_SIZE, so players keep reading while the file grows instead of stopping where the header said the audio ended.
+    Returns header unchanged if it isn't a WAV or the data chunk isn't in it yet.
+    '''
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return header
+
+    patched = bytearray(header)
+    position = 12
+    while position + 8 <= len(patched):
+        chunkId, chunkSize = struct.unpack_from('<4sI', patched, position)
+        if chunkId == b'data':
+            struct.pack_into('<I', patched, 4, UNKNOWN_WAV_SIZE)
+            struct.pack_into('<I', patched, position + 4, UNKNOWN_WAV_SIZE)
+            break
+        #Chunks are padded to an even length
+        position += 8 + chunkSize + (chunkSize & 1)
+    return bytes(patched)
@@ -0,0 +1,85 @@
+'''
+Checks that importing megafy's modules stays cheap, so Django and render workers start quickly.
+
+    python -m megafy.import_time
+    python -m megafy.import_time --budget 0.25 --runs 10 megafy.megafy_script homepage.views
+
+Every module is imported in a fresh interpreter (so nothing is already cached in sys.modules) several times and the fastest run is compared
+against the budget. The command exits with status 1 if a module goes over budget or pulls in one of HEAVY_MODULES at import time, and
+prints python -X importtime's slowest imports to show where the time went.
+'''
+from argparse import ArgumentParser
+from os import environ
+from subprocess import run
+import sys
+
+#Modules checked when none are named on the command line
+MODULES = ['megafy.megafy_script']
+#Seconds a module may take to import (fastest of the runs, interpreter startup not included)
+IMPORT_BUDGET_SECONDS = float(environ.get('MEGAFY_IMPORT_BUDGET', 0.5))
+RUNS = 5
+#Libraries that must only be imported once something is rendered
+HEAVY_MODULES = ['dawdreamer', 'librosa', 'moviepy', 'numpy', 'scipy', 'soundfile', 'audioread']
+
+PROBE = '''
+import sys
+from time import perf_counter
+started = perf_counter()
+import %s
+print(perf_counter() - started)
+print(' '.join(sorted(name for name in %r if name in sys.modules)))
+'''
+
+def timeImport(module):
+    '''
+    Imports module in a fresh interpreter. Returns (seconds, the HEAVY_MODULES it loaded), or raises ImportError with the child's error
+    '''
+    result = run([sys.executable, '-c', PROBE % (module, HEAVY_MODULES)], capture_output=True, text=True)
+    if result.returncode:
+        raise ImportError((result.stderr.strip().splitlines() or ['exit status %d' % result.returncode])[-1])
+    seconds, heavy = (result.stdout.splitlines() + [''])[:2]
+    return float(seconds), heavy.split()
+
+def slowestImports(module, count=10):
+    '''
+    The count slowest imports (cumulative microseconds, module name) under python -X importtime
+    '''
+    result = run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], capture_output=True, text=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            timings.append((int(fields[1]), fields[2].strip()))
+    return sorted(timings, reverse=True)[:count]
+
+def main(argv=None):
+    parser = ArgumentParser(description='Fail if importing megafy modules is slower than the startup budget.')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='Modules to time (default: %s)' % ' '.join(MODULES))
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_SECONDS, help='Seconds allowed per import (default: MEGAFY_IMPORT_BUDGET or %(default)s)')
+    parser.add_argument('--runs', type=int, default=RUNS, help='Imports per module, the fastest counts (default: %(default)s)')
+    arguments = parser.parse_args(argv)
+
+    failed = False
+    for module in arguments.modules:
+        try:
+            timings = [timeImport(module) for _ in range(max(1, arguments.runs))]
+        except ImportError as error:
+            print('FAIL %s: %s' % (module, error))
+            failed = True
+            continue
+        seconds = min(seconds for seconds, _ in timings)
+        heavy = timings[0][1]
+
+        overBudget = seconds > arguments.budget
+        print('%s %s: %.3fs (budget %.3fs)' % ('FAIL' if overBudget or heavy else 'ok  ', module, seconds, arguments.budget))
+        if heavy:
+            print('    imports %s at import time' % ', '.join(heavy))
+        if overBudget or heavy:
+            failed = True
+            for microseconds, name in slowestImports(module):
+                print('    %8.3fs  %s' % (microseconds/1e6, name))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
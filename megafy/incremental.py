@@ -0,0 +1,127 @@
+from hashlib import sha256
+from os import makedirs, path, replace, unlink, utime
+from tempfile import mkstemp
+from threading import Lock
+import json
+
+import numpy as np
+
+from .encoder import encodeAudio
+from .ingest import DEFAULT_RESAMPLE_QUALITY, decodeAudio
+from .megafy_script import DEFAULT_BACKEND, SAMPLE_RATE, getOutputFile, getProcessingRate, makeSession, normalizeStages
+from .metrics import timer
+from .render_cache import CACHE_VERSION, evictLeastRecentlyUsed, hashFileCached
+
+STAGE_NAMES = ('pitchShift', 'bassBoost', 'reverb', 'softClipper')
+
+def stageKey(fileHash, upstreamStages, backend=None, sampleRate=SAMPLE_RATE, resampleQuality=None):
+    '''
+    Key of the audio after decoding the input at sampleRate (with resampleQuality) and running it through upstreamStages (a prefix of the normalized stages) on backend.
+    The decoded input itself is the empty prefix.
+    '''
+    description = json.dumps([CACHE_VERSION, sampleRate, resampleQuality or DEFAULT_RESAMPLE_QUALITY, fileHash, upstreamStages, backend or DEFAULT_BACKEND if upstreamStages else None], separators=(',', ':'))
+    return sha256(description.encode()).hexdigest()
+
+def renderStage(session, stageIndex, audio, choice):
+    '''
+    Runs audio through the single stage STAGE_NAMES[stageIndex] set to choice on session (see makeSession) and returns the result
+    '''
+    stages = [False, False, False, False]
+    stages[stageIndex] = list(choice)
+    with timer(STAGE_NAMES[stageIndex]):
+        return session.render(audio, *stages)
+
+class StageCache:
+    '''
+    Disk store of intermediate stage outputs as .npy files, kept under maxBytes by evicting the least recently used ones.
+    Entries are loaded memory-mapped, so a hit only reads the pages that are actually used. Safe to share between processes like RenderCache.
+    '''
+    def __init__(self, directory, maxBytes):
+        self.directory = str(directory)
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        makedirs(self.directory, exist_ok=True)
+
+    def entryPath(self, key):
+        return path.join(self.directory, key+'.npy')
+
+    def get(self, key):
+        entry = self.entryPath(key)
+        try:
+            utime(entry)
+            audio = np.load(entry, mmap_mode='r')
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return audio
+
+    def put(self, key, audio):
+        handle, temporary = mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with open(handle, 'wb') as destination:
+                np.save(destination, np.asarray(audio, dtype=np.float32))
+            replace(temporary, self.entryPath(key))
+        except BaseException:
+            if path.exists(temporary):
+                unlink(temporary)
+            raise
+        evictLeastRecentlyUsed(self.directory, '.npy', self.maxBytes)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+def megafyFileIncremental(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, outputFile=None, stageCache=None, backend=None, sampleRate=SAMPLE_RATE, resampleQuality=None, outputFormat=None, peaksFile=None, session=None, bufferPool=None):
+    '''
+    Same as megafyFile, but renders the chain one stage at a time and memoizes every stage's output in stageCache (a StageCache)
+    under the input's hash plus all upstream stage choices.
+
+    A re-render starts from the deepest stage output that is still valid, so changing e.g. only SOFT_CLIPPER_CHOICE skips
+    decoding, pitch shifting, bass boosting and reverb entirely. Disabled stages pass audio through untouched and aren't stored.
+    sampleRate, resampleQuality, outputFormat, peaksFile, session and bufferPool work as in megafyFile.
+
+    Returns True if everything works.
+    '''
+    stages = normalizeStages(PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE)
+    fileHash = hashFileCached(file)
+    sampleRate = getProcessingRate(file, sampleRate)
+    keyOptions = {'backend': backend, 'sampleRate': sampleRate, 'resampleQuality': resampleQuality}
+
+    #Level 0 is the decoded input, level n the audio after the first n stages. Only levels produced by an enabled stage are ever stored
+    storedLevels = [0] + [index+1 for index in range(len(stages)) if stages[index] is not False]
+
+    audio = None
+    decoded = None
+    startLevel = 0
+    for level in reversed(storedLevels):
+        audio = stageCache.get(stageKey(fileHash, stages[:level], **keyOptions))
+        if audio is not None:
+            startLevel = level
+            break
+
+    if audio is None:
+        decoded, _ = decodeAudio(file, sampleRate, quality=resampleQuality, pool=bufferPool)
+        audio = decoded
+        stageCache.put(stageKey(fileHash, [], **keyOptions), audio)
+
+    if session is None or session.sampleRate != sampleRate:
+        session = makeSession(backend, sampleRate=sampleRate)
+    for index in range(startLevel, len(stages)):
+        if stages[index] is False:
+            continue
+        audio = renderStage(session, index, np.ascontiguousarray(audio, dtype=np.float32), stages[index])
+        stageCache.put(stageKey(fileHash, stages[:index+1], **keyOptions), audio)
+
+    if outputFile is None:
+        outputFile = getOutputFile(file, outputFormat)
+    encodeAudio(outputFile, audio, sampleRate, outputFormat, peaksFile)
+    #Only now, since with every stage off audio is the decoded input itself
+    if bufferPool is not None and decoded is not None:
+        bufferPool.give(decoded)
+
+    return True
@@ -0,0 +1,171 @@
+from dataclasses import dataclass
+from os import environ, path
+import struct
+
+import audioread
+import numpy as np
+import soundfile as sf
+
+from .metrics import increment, observe, timer
+
+#Resamplers (librosa res_type) from fastest to most accurate. Run python -m megafy.resample_benchmark to see what each costs and how close it gets
+RESAMPLE_QUALITIES = {'fast': 'polyphase', 'balanced': 'kaiser_fast', 'best': 'kaiser_best'}
+#'best' is what librosa.load uses by default, so renders stay exactly as they were unless this is changed
+DEFAULT_RESAMPLE_QUALITY = environ.get('MEGAFY_RESAMPLE_QUALITY', 'best')
+
+#WAV sample formats (format tag, bits per sample) read straight from a memory map, and what full scale is in each
+MAPPED_WAV_FORMATS = {(1, 16): ('<i2', 32768.0), (1, 32): ('<i4', 2147483648.0), (3, 32): ('<f4', 1.0)}
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+@dataclass(frozen=True)
+class AudioInfo:
+    '''
+    What later stages need to know about a piece of audio
+    '''
+    sampleRate: int
+    channels: int
+    frames: int
+    codec: str
+
+    @property
+    def duration(self):
+        return self.frames/self.sampleRate
+
+def probeCodec(file):
+    '''
+    Names the file's container/encoding from its header alone (e.g. "WAV/PCM_16"), or from its extension when libsndfile can't read it
+    '''
+    try:
+        info = sf.info(file)
+    except RuntimeError:
+        return path.splitext(file)[1][1:].upper()
+    return '%s/%s' % (info.format, info.subtype)
+
+def sniffAudioType(header):
+    '''
+    Names the kind of audio the first bytes of a file hold ('.wav' or '.mp3', matching VALID_FILETYPES), or None if they aren't either
+    '''
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return '.wav'
+    #An ID3 tag, or straight into an MPEG audio frame (11 sync bits, then anything but the reserved version and layer)
+    if header[:3] == b'ID3':
+        return '.mp3'
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0 and header[1] & 0x18 != 0x08 and header[1] & 0x06:
+        return '.mp3'
+    return None
+
+def mapWav(file):
+    '''
+    Memory-maps the samples of a 16/32-bit integer or 32-bit float WAV and returns (frames x channels memmap, sample rate, full scale),
+    or None for anything else (other formats, 24-bit WAVs, broken headers). Reading from the map only touches the pages that are used.
+    '''
+    with open(file, 'rb') as wavFile:
+        header = wavFile.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        layout = None
+        while True:
+            chunk = wavFile.read(8)
+            if len(chunk) < 8:
+                return None
+            chunkId, chunkSize = struct.unpack('<4sI', chunk)
+            if chunkId == b'fmt ':
+                fmt = wavFile.read(chunkSize)
+                if len(fmt) < 16:
+                    return None
+                formatTag, channels, sampleRate, _, _, bits = struct.unpack_from('<HHIIHH', fmt)
+                if formatTag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    #The real format tag opens the sub-format GUID
+                    formatTag = struct.unpack_from('<H', fmt, 24)[0]
+                layout = (formatTag, bits, channels, sampleRate)
+                wavFile.seek(chunkSize & 1, 1)
+            elif chunkId == b'data':
+                if layout is None or (layout[0], layout[1]) not in MAPPED_WAV_FORMATS or not layout[2]:
+                    return None
+                dtype, fullScale = MAPPED_WAV_FORMATS[(layout[0], layout[1])]
+                offset = wavFile.tell()
+                #A file cut short (or still being written) maps as much as is really there
+                available = min(chunkSize, path.getsize(file) - offset)
+                frames = available // (np.dtype(dtype).itemsize*layout[2])
+                if frames == 0:
+                    return None
+                return np.memmap(file, dtype=dtype, mode='r', offset=offset, shape=(frames, layout[2])), layout[3], fullScale
+            else:
+                wavFile.seek(chunkSize + (chunkSize & 1), 1)
+
+def readMappedWav(file, duration=None, offset=None, pool=None):
+    '''
+    decodeAudio's reading step for WAVs mapWav can map: returns (float32 (channels, frames), sample rate), or None for any other file.
+    The result goes into a buffer from pool (a buffer_pool.BufferPool) when one is passed.
+    '''
+    if path.splitext(file)[1].lower() != '.wav':
+        return None
+    mapped = mapWav(file)
+    if mapped is None:
+        return None
+    samples, rate, fullScale = mapped
+    start = int(round((offset or 0.0)*rate))
+    stop = None if duration is None else start + int(round(duration*rate))
+    window = samples[start:stop].T
+    #One pass from the mapped samples to the float result, with no whole-file intermediate
+    sig = np.empty(window.shape, dtype=np.float32) if pool is None else pool.take(*window.shape)
+    if fullScale == 1.0:
+        np.copyto(sig, window)
+    else:
+        np.multiply(window, np.float32(1/fullScale), out=sig, casting='unsafe')
+    return sig, rate
+
+def probeAudio(file):
+    '''
+    Reads a file's metadata without decoding it. libsndfile only reads the header; anything it can't open goes through audioread, which has to start a decoder but stops before reading any audio.
+    '''
+    with timer('probe'):
+        try:
+            info = sf.info(file)
+        except RuntimeError:
+            with audioread.audio_open(file) as decoder:
+                return AudioInfo(decoder.samplerate, decoder.channels, round(decoder.duration*decoder.samplerate), path.splitext(file)[1][1:].upper())
+        return AudioInfo(info.samplerate, info.channels, info.frames, '%s/%s' % (info.format, info.subtype))
+
+def resampleAudio(sig, fromRate, toRate, quality=None):
+    '''
+    Resamples sig (channels, frames) from fromRate to toRate with one of the RESAMPLE_QUALITIES (DEFAULT_RESAMPLE_QUALITY if None). Matching rates return sig untouched.
+    '''
+    quality = quality or DEFAULT_RESAMPLE_QUALITY
+    if quality not in RESAMPLE_QUALITIES:
+        raise ValueError('Unknown resample quality %r (choose from %s)' % (quality, ', '.join(RESAMPLE_QUALITIES)))
+    if fromRate == toRate:
+        return sig
+
+    from librosa import resample
+
+    with timer('resample'):
+        return resample(sig, orig_sr=fromRate, target_sr=toRate, res_type=RESAMPLE_QUALITIES[quality], axis=-1).astype(np.float32, copy=False)
+
+def decodeAudio(file, sampleRate, duration=None, offset=None, quality=None, pool=None):
+    '''
+    Decodes a file once at sampleRate and returns (signal, AudioInfo). signal is always (channels, frames), and the info (duration included) comes from the decoded samples, so nothing has to open the file a second time.
+    offset and duration (seconds) decode only part of the file; the decoder seeks to offset instead of decoding everything before it where the format allows.
+
+    sampleRate None keeps the file's own rate. Otherwise the file is only resampled when its rate differs, with the quality tier from RESAMPLE_QUALITIES.
+    Plain 16/32-bit and float WAVs are read through a memory map (see mapWav) instead of librosa, so only the window asked for is ever read.
+    With pool (a buffer_pool.BufferPool) they're decoded into a reused buffer, which the caller gives back to pool once it's done with signal.
+    '''
+    with timer('decode'):
+        mapped = readMappedWav(file, duration, offset, pool)
+        if mapped is not None:
+            sig, rate = mapped
+        else:
+            #librosa is only imported once something is decoded since importing it takes seconds
+            from librosa import load
+
+            sig, rate = load(file, offset=offset or 0.0, duration=duration, mono=False, sr=None)
+    sig = np.atleast_2d(sig)
+    increment('megafy_input_bytes_total', path.getsize(file))
+    observe('megafy_input_duration_seconds', sig.shape[1]/rate)
+    if sampleRate is not None and sampleRate != rate:
+        decoded, sig = sig, resampleAudio(sig, rate, sampleRate, quality)
+        if pool is not None:
+            pool.give(decoded)
+        rate = sampleRate
+    return sig, AudioInfo(rate, sig.shape[0], sig.shape[1], probeCodec(file))
@@ -1,12 +1,26 @@
-from librosa import load
-from moviepy.editor import AudioFileClip
-from os import path
-from scipy.io.wavfile import write
-import dawdreamer as daw
+from os import environ, path
+
+#dawdreamer, librosa and scipy take seconds to import, so they're only imported by the functions that render (see warmUp).
+#Importing this module does no work, which keeps Django and worker startup fast
 
 VALID_FILETYPES = ['.mp3', '.wav'] #These are the only filetypes that I know work for sure
 SAMPLE_RATE = 44100
 BUFFER_SIZE = 512
+#'dawdreamer' runs the VST plugins in Plugins (Windows only), 'native' runs the NumPy/SciPy versions in native_dsp.py
+BACKENDS = ['dawdreamer', 'native']
+DEFAULT_BACKEND = environ.get('MEGAFY_BACKEND', 'dawdreamer')
+#Formats results can be written in (libsndfile format and subtype). Output is encoded as it's rendered, so none of them are ever held whole
+OUTPUT_FORMATS = {
+    'wav16': {'format': 'WAV', 'subtype': 'PCM_16', 'extension': '.wav', 'contentType': 'audio/wav'},
+    'wav24': {'format': 'WAV', 'subtype': 'PCM_24', 'extension': '.wav', 'contentType': 'audio/wav'},
+    'flac': {'format': 'FLAC', 'subtype': 'PCM_24', 'extension': '.flac', 'contentType': 'audio/flac'},
+    'ogg': {'format': 'OGG', 'subtype': 'VORBIS', 'extension': '.ogg', 'contentType': 'audio/ogg'},
+}
+DEFAULT_OUTPUT_FORMAT = environ.get('MEGAFY_OUTPUT_FORMAT', 'wav24')
+#Rates the stages can run at directly (with sampleRate=None). Files at any other rate are resampled to SAMPLE_RATE
+PROCESSING_RATES = (44100, 48000, 88200, 96000)
+#How the pitch shifter trades speed for quality (rubberband's OptionPitchHigh* flags). Full renders always use 'quality'
+PITCH_QUALITIES = {'speed': 'OptionPitchHighSpeed', 'consistency': 'OptionPitchHighConsistency', 'quality': 'OptionPitchHighQuality'}
 
 def getConjoiner():
     currentDir = path.dirname(__file__)
@@ -16,60 +30,239 @@ def getConjoiner():
         conjoiner = '/'
     return conjoiner
 
-def loadAudioFile(file_path, duration=None):
+def loadAudioFile(file_path, duration=None, offset=None, sampleRate=SAMPLE_RATE, quality=None):
     '''
-    Loads a .wav or .mp3 file and translates it into data that dawdreamer (the digital audio workspace we're using) can understand
+    Loads a .wav or .mp3 file and translates it into data that dawdreamer (the digital audio workspace we're using) can understand.
+    offset (seconds) skips the start of the file and duration (seconds) stops reading after that much audio.
+    sampleRate None keeps the file's own rate, and quality picks the resampler used otherwise (see ingest.RESAMPLE_QUALITIES).
     '''
-    sig, rate = load(file_path, duration=duration, mono=False, sr=SAMPLE_RATE)
-    assert(rate == SAMPLE_RATE)
+    from .ingest import decodeAudio
+
+    sig, info = decodeAudio(file_path, sampleRate, duration=duration, offset=offset, quality=quality)
+    assert(sampleRate is None or info.sampleRate == sampleRate)
     return sig
 
-def loadPreset(file, presetOption):
+def getProcessingRate(file, sampleRate=SAMPLE_RATE):
     '''
-    Loads a preset from a textfile.
-
-    Textfile syntax should be as follows:
-    
-        FIRST LINE:
-            Name: Pitch Shift
-            Value: False or any integer from -12 to 12
-        
-        SECOND LINE:
-            Name: Bass Boost
-            Value: False or list of four floats from 0.0 to 1.0
-        
-        THIRD LINE:
-            Name: Reverb
-            Value: False or list of four floats from 0.0 to 1.0
-        
-        FOURTH LINE:
-            Name: Soft Clipper
-            Value: False or list of five floats from 0.0 to 1.0
-        
-        EXAMPLE PRESET AS TEXTFILE:
-
-            False
-            0.0 1.0 1.0 1.0
-            False
-            0.1 0.1 0.1 0.1 0.2
+    Returns the rate file gets rendered at: sampleRate, or with sampleRate None the file's own rate when it's one of PROCESSING_RATES
+    (so it isn't resampled at all) and SAMPLE_RATE when it isn't. Only the file's header is read.
     '''
-    conjoiner = getConjoiner()
-    presetInput = open(path.dirname(__file__)+conjoiner+'Presets'+conjoiner+presetOption+'.txt').readlines()
+    if sampleRate is not None:
+        return sampleRate
+
+    from .ingest import probeAudio
+
+    fileRate = probeAudio(file).sampleRate
+    return fileRate if fileRate in PROCESSING_RATES else SAMPLE_RATE
+
+def readPreset(presetOption):
+    '''
+    Returns the four stage choices of a preset in megafy/Presets as a list (in the order megafyFile takes them).
+    Presets are parsed and validated once per process (see presets.py for the file syntax), and a malformed one raises presets.PresetError.
+    '''
+    from .presets import getRegistry
+
+    return getRegistry().get(presetOption).stages
+
+def loadPreset(file, presetOption, outputFile=None):
+    '''
+    Loads a preset from a textfile (see readPreset for the syntax) and megafies the given file with it.
+    '''
+    presetInput = readPreset(presetOption)
+
+    return megafyFile(file, presetInput[0], presetInput[1], presetInput[2], presetInput[3], outputFile=outputFile)
 
-    for counter in range(len(presetInput)):
-        presetInput[counter] = presetInput[counter].strip()
+def getOutputFile(file, outputFormat=None):
+    '''
+    Returns the default path megafyFile writes to for a given input file (the uppercased input name inside Output, with outputFormat's extension)
+    '''
+    conjoiner = getConjoiner()
+    return path.dirname(__file__)+conjoiner+'Output'+conjoiner+str(file[file.rfind(conjoiner)+1:]).upper()[:-4]+OUTPUT_FORMATS[outputFormat or DEFAULT_OUTPUT_FORMAT]['extension']
 
-        if presetInput[counter] == 'False':
-            presetInput[counter] = False
+def normalizeStages(PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False):
+    '''
+    Returns the four stage choices in one canonical form: a tuple holding False or a tuple of floats per stage.
+    Equal settings normalize equal however they were written ([5], [5.0], (5,), 5.0000001), which is what cache keys are built from.
+    '''
+    stages = []
+    for choice in (PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE):
+        if choice is False or choice is None:
+            stages.append(False)
         else:
-            presetInput[counter] = presetInput[counter].split(' ')
+            if isinstance(choice, (int, float)):
+                choice = [choice]
+            stages.append(tuple(round(float(value), 6) for value in choice))
+    return tuple(stages)
+
+def getTimeRatio(PITCH_SHIFT_CHOICE=False):
+    '''
+    Returns how much pitch shifting stretches the audio's length (shifting down makes it longer, like slowing down a record)
+    '''
+    if PITCH_SHIFT_CHOICE != False:
+        return 2**(-PITCH_SHIFT_CHOICE[0]/12)
+    return 1.0
+
+def reuseProcessor(processors, name, kind, song, make):
+    '''
+    Returns the processor called name from processors if one of the same kind was made before (handing it song, if given), otherwise makes and remembers a new one
+    '''
+    if processors is None:
+        return make()
+    if name in processors and processors[name][0] == kind:
+        processor = processors[name][1]
+        if song is not None:
+            processor.set_data(song)
+        return processor
+    processor = make()
+    processors[name] = (kind, processor)
+    return processor
+
+def buildGraph(engine, song, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, processors=None, pitchQuality='quality'):
+    '''
+    Adds a playback processor for song and every chosen effect to engine and returns the graph (in processing order) ready for engine.load_graph.
+    The playback processor is always OUR_GRAPH[0][0], so callers can swap its audio with set_data. Stage choices are documented in megafyFile.
+
+    processors is an optional dict that keeps the processors made on this engine between calls, so plugins are only loaded the first time (see RenderSession).
+    pitchQuality picks the pitch shifter's mode from PITCH_QUALITIES.
+    '''
+    import dawdreamer as daw
+
+    conjoiner = getConjoiner()
+
+    #Graph is the order in which we add different effects. Reverbed is just a status to see if the audio's been reverbed yet or not
+    OUR_GRAPH = []
+    reverbed = False
+
+    #Set pitch shift and its parameters
+    if PITCH_SHIFT_CHOICE != False:
+        tranposeValue = PITCH_SHIFT_CHOICE[0]
+        playback_processor = reuseProcessor(processors, "my_playback", "warp", song, lambda: engine.make_playbackwarp_processor("my_playback", song))
+        playback_processor.transpose = tranposeValue
+        playback_processor.time_ratio = getTimeRatio(PITCH_SHIFT_CHOICE)
+
+        playback_processor.set_options(
+            daw.PlaybackWarpProcessor.option.OptionTransientsSmooth |
+            getattr(daw.PlaybackWarpProcessor.option, PITCH_QUALITIES[pitchQuality]) |
+            daw.PlaybackWarpProcessor.option.OptionChannelsTogether
+        )
+
+        OUR_GRAPH.append((playback_processor, []))
+    else:
+        playback_processor = reuseProcessor(processors, "my_playback", "plain", song, lambda: engine.make_playback_processor("my_playback", song))
+        OUR_GRAPH.append((playback_processor, []))
+
+    #Set bass booster and its parameters
+    if BASS_BOOST_CHOICE != False:
+        bass_boost = reuseProcessor(processors, "my_bass_boost", "plugin", None, lambda: engine.make_plugin_processor("my_bass_boost", path.dirname(__file__)+conjoiner+'Plugins'+conjoiner+'BarkOfDog2.dll'))
+        bass_boost.set_parameter(2, BASS_BOOST_CHOICE[0]) #Output gain (dB)
+        bass_boost.set_parameter(3, BASS_BOOST_CHOICE[1]) #Freq. (Hz)
+        bass_boost.set_parameter(4, BASS_BOOST_CHOICE[2]) #Boost (dB)
+        bass_boost.set_parameter(5, BASS_BOOST_CHOICE[3]) #Mode (0.0==Classic, 0.5==Passive, 1.0==Combo)
+        OUR_GRAPH.append((bass_boost, ["my_playback"]))
+
+    #Set reverb levels and its parameters
+    if REVERB_CHOICE != False:           
+        reverb = reuseProcessor(processors, "my_reverb", "plugin", None, lambda: engine.make_plugin_processor("my_reverb", path.dirname(__file__)+conjoiner+'Plugins'+conjoiner+'MConvolutionEZ.dll'))
+        reverb.set_parameter(0, REVERB_CHOICE[0]) #Reverb (0==Super Dry, 1==Super Wet)
+        reverb.set_parameter(1, REVERB_CHOICE[1]) #Wide (0.333333==Off, 0==Mono, 1==200%)
+        reverb.set_parameter(2, REVERB_CHOICE[2]) #High-pass (0==Off)
+        reverb.set_parameter(3, REVERB_CHOICE[3]) #Low-pass (1==Off)
+
+        reverbed = True
+
+        if len(OUR_GRAPH) == 2:
+            OUR_GRAPH.append((reverb, ["my_bass_boost"]))
+        elif len(OUR_GRAPH) == 1:
+            OUR_GRAPH.append((reverb, ["my_playback"]))
+
+    #Set soft clipper and its parameters
+    if SOFT_CLIPPER_CHOICE != False:
+        soft_clipper = reuseProcessor(processors, "my_soft_clipper", "plugin", None, lambda: engine.make_plugin_processor("my_soft_clipper", path.dirname(__file__)+conjoiner+'Plugins'+conjoiner+'Initial Clipper.dll'))
+        soft_clipper.set_parameter(0, SOFT_CLIPPER_CHOICE[0]) #Threshold
+        soft_clipper.set_parameter(1, SOFT_CLIPPER_CHOICE[1]) #Input gain
+        soft_clipper.set_parameter(2, SOFT_CLIPPER_CHOICE[2]) #Positive saturation
+        soft_clipper.set_parameter(3, SOFT_CLIPPER_CHOICE[3]) #Negative saturation
+        soft_clipper.set_parameter(4, SOFT_CLIPPER_CHOICE[4]) #Saturate (0.0==False, 1.0==True)
+
+        if len(OUR_GRAPH) == 3:
+            OUR_GRAPH.append((soft_clipper, ["my_reverb"]))
+        elif len(OUR_GRAPH) == 2 and reverbed == True:
+            OUR_GRAPH.append((soft_clipper, ["my_reverb"]))
+        elif len(OUR_GRAPH) == 2 and reverbed != True:
+            OUR_GRAPH.append((soft_clipper, ["my_bass_boost"]))
+        elif len(OUR_GRAPH) == 1:
+            OUR_GRAPH.append((soft_clipper, ["my_playback"]))
+
+    return OUR_GRAPH
+
+class RenderSession:
+    '''
+    A RenderEngine plus every processor made on it. Rendering many songs through one session builds the engine and loads each plugin once instead of once per song.
+    Songs handed to render must already be at sampleRate.
+    '''
+    def __init__(self, sampleRate=SAMPLE_RATE, pitchQuality='quality'):
+        import dawdreamer as daw
+
+        self.sampleRate = sampleRate
+        self.pitchQuality = pitchQuality
+        self.engine = daw.RenderEngine(sampleRate, BUFFER_SIZE)
+        self.processors = {}
+
+    def timeRatio(self, PITCH_SHIFT_CHOICE=False):
+        return getTimeRatio(PITCH_SHIFT_CHOICE)
+
+    def render(self, song, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False):
+        '''
+        Runs song (channels, frames) through the chosen stages and returns the result. Stage choices are documented in megafyFile.
+        '''
+        OUR_GRAPH = buildGraph(self.engine, song, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, processors=self.processors, pitchQuality=self.pitchQuality)
+
+        #Load graph onto engine
+        self.engine.load_graph(OUR_GRAPH)
+
+        #Render clip
+        durationOfClip = song.shape[-1]/self.sampleRate*getTimeRatio(PITCH_SHIFT_CHOICE)
+        self.engine.render(durationOfClip)
+
+        #Extract audio from engine
+        return self.engine.get_audio()
+
+def makeSession(backend=None, sampleRate=SAMPLE_RATE, pitchQuality='quality', reverbSeconds=None):
+    '''
+    Returns a fresh session for backend (DEFAULT_BACKEND if None): a RenderSession for 'dawdreamer' or a native_dsp.NativeSession for 'native'.
+    pitchQuality only applies to dawdreamer's pitch shifter and reverbSeconds (the reverb tail length) only to the native reverb, since the reverb plugin's impulse is fixed.
+    '''
+    backend = backend or DEFAULT_BACKEND
+    if backend == 'dawdreamer':
+        return RenderSession(sampleRate, pitchQuality)
+    if backend == 'native':
+        from .native_dsp import REVERB_SECONDS, NativeSession
+        return NativeSession(sampleRate, reverbSeconds or REVERB_SECONDS)
+    raise ValueError('Unknown render backend %r (choose from %s)' % (backend, ', '.join(BACKENDS)))
+
+#Stage choices warmUp renders a moment of silence with, so every stage's processor (and plugin) gets made
+WARM_UP_STAGES = ([0.0], [0.5, 0.327654, 0.0, 0.5], [0.0, 0.333333, 0.0, 1.0], [1.0, 0.5, 0.0, 0.0, 1.0])
+
+def warmUp(session=None, backend=None):
+    '''
+    Does everything a first render would otherwise pay for: imports the audio libraries and, through session (a new one from makeSession(backend)
+    if None), makes every stage's processor and loads its plugin by rendering a tenth of a second of silence.
+    Call it in a pool or worker process before it takes work. Returns the warmed session.
+    '''
+    from importlib import import_module
+
+    import numpy as np
 
-            for number in range(len(presetInput[counter])):
-                presetInput[counter][number] = float(presetInput[counter][number])
+    #Loaded now rather than during the first job, though nothing here uses them
+    for module in ('librosa', 'soundfile'):
+        import_module(module)
 
-    megafyFile(file, presetInput[0], presetInput[1], presetInput[2], presetInput[3])
+    if session is None:
+        session = makeSession(backend)
+    session.render(np.zeros((2, session.sampleRate//10), dtype=np.float32), *WARM_UP_STAGES)
+    return session
 
-def megafyFile(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False):
+def megafyFile(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, outputFile=None, session=None, backend=None, sampleRate=SAMPLE_RATE, resampleQuality=None, outputFormat=None, bufferPool=None, peaksFile=None):
     '''
         DESCRIPTION:
 
@@ -80,12 +273,53 @@ def megafyFile(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_C
 
         RETURNS:
 
-            Returns True if everything works.
+            Returns the ingest.AudioInfo of the decoded input (at the rate it was rendered at) if everything works, so callers never have to probe the file again.
 
         PARAMETERS:
 
             file : str
                 Absolute path of the file (.wav or .mp3) that will be Megafied
+
+            outputFile : str
+
+                outputFile is None by default.
+                Absolute path of the file the result is written to. When None, the result goes to Output under the uppercased input name (see getOutputFile).
+
+            outputFormat : str
+
+                outputFormat is None by default (meaning DEFAULT_OUTPUT_FORMAT, set through the MEGAFY_OUTPUT_FORMAT environment variable).
+                How the result is encoded: 'wav16', 'wav24', 'flac' or 'ogg' (see OUTPUT_FORMATS). Samples past full scale are clipped.
+
+            session : RenderSession
+
+                session is None by default.
+                Engine and processors to render with. Pass the same session for every file when rendering many files in one process.
+
+            backend : str
+
+                backend is None by default (meaning DEFAULT_BACKEND, set through the MEGAFY_BACKEND environment variable).
+                Which implementation of the stages to use when no session is passed: 'dawdreamer' (the VST plugins) or 'native' (NumPy/SciPy, runs anywhere).
+
+            sampleRate : int
+
+                sampleRate is SAMPLE_RATE by default.
+                Rate the file is rendered and written at. None renders at the file's own rate when the stages can (see getProcessingRate), which skips resampling entirely.
+                A passed session is only used when it runs at that rate; otherwise a new one is made with backend.
+
+            resampleQuality : str
+
+                resampleQuality is None by default (meaning ingest.DEFAULT_RESAMPLE_QUALITY, set through the MEGAFY_RESAMPLE_QUALITY environment variable).
+                Resampler used when the file's rate differs from the render rate: 'fast', 'balanced' or 'best' (see ingest.RESAMPLE_QUALITIES).
+
+            bufferPool : buffer_pool.BufferPool
+
+                bufferPool is None by default.
+                Pool the decoded song is read into and given back to after the render, so a process rendering many files reuses one buffer.
+
+            peaksFile : str
+
+                peaksFile is None by default.
+                Where to save the result's waveform peaks (see peaks.py), computed while the result is encoded. None skips them.
             
             PITCH_SHIFT_CHOICE : int
 
@@ -219,99 +453,32 @@ def megafyFile(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_C
                         Recommended Value: For a good megafy effect, I'd suggest 1.0 (True)
 
     '''
-    conjoiner = getConjoiner()
-
-    #What's running everything
-    engine = daw.RenderEngine(SAMPLE_RATE, BUFFER_SIZE)
-
-    #Graph is the order in which we add different effects. Reverbed is just a status to see if the audio's been reverbed yet or not
-    OUR_GRAPH = []
-    reverbed = False
-    lowered = False
-
-    #Turn song into understandable language
-    song = loadAudioFile(file)
-
-    #Set pitch shift and its parameters
-    if PITCH_SHIFT_CHOICE != False:
-        lowered = True
-        PITCH_SHIFT_CHOICE = PITCH_SHIFT_CHOICE[0]
-        tranposeValue = PITCH_SHIFT_CHOICE
-        playback_processor = engine.make_playbackwarp_processor("my_playback", song)
-        playback_processor.transpose = tranposeValue
-        playback_processor.time_ratio = 2**(-tranposeValue/12)
-
-        playback_processor.set_options(
-            daw.PlaybackWarpProcessor.option.OptionTransientsSmooth |
-            daw.PlaybackWarpProcessor.option.OptionPitchHighQuality |
-            daw.PlaybackWarpProcessor.option.OptionChannelsTogether
-        )
-
-        OUR_GRAPH.append((playback_processor, []))
-    else:
-        playback_processor = engine.make_playback_processor("my_playback", song)
-        OUR_GRAPH.append((playback_processor, []))
-
-    #Set bass booster and its parameters
-    if BASS_BOOST_CHOICE != False:
-        bass_boost = engine.make_plugin_processor("my_bass_boost", path.dirname(__file__)+conjoiner+'Plugins'+conjoiner+'BarkOfDog2.dll')
-        bass_boost.set_parameter(2, BASS_BOOST_CHOICE[0]) #Output gain (dB)
-        bass_boost.set_parameter(3, BASS_BOOST_CHOICE[1]) #Freq. (Hz)
-        bass_boost.set_parameter(4, BASS_BOOST_CHOICE[2]) #Boost (dB)
-        bass_boost.set_parameter(5, BASS_BOOST_CHOICE[3]) #Mode (0.0==Classic, 0.5==Passive, 1.0==Combo)
-        OUR_GRAPH.append((bass_boost, ["my_playback"]))
-
-    #Set reverb levels and its parameters
-    if REVERB_CHOICE != False:           
-        reverb = engine.make_plugin_processor("my_reverb", path.dirname(__file__)+conjoiner+'Plugins'+conjoiner+'MConvolutionEZ.dll')
-        reverb.set_parameter(0, REVERB_CHOICE[0]) #Reverb (0==Super Dry, 1==Super Wet)
-        reverb.set_parameter(1, REVERB_CHOICE[1]) #Wide (0.333333==Off, 0==Mono, 1==200%)
-        reverb.set_parameter(2, REVERB_CHOICE[2]) #High-pass (0==Off)
-        reverb.set_parameter(3, REVERB_CHOICE[3]) #Low-pass (1==Off)
-
-        reverbed = True
-
-        if len(OUR_GRAPH) == 2:
-            OUR_GRAPH.append((reverb, ["my_bass_boost"]))
-        elif len(OUR_GRAPH) == 1:
-            OUR_GRAPH.append((reverb, ["my_playback"]))
+    from .encoder import encodeAudio
+    from .ingest import decodeAudio
+    from .metrics import timer
 
-    #Set soft clipper and its parameters
-    if SOFT_CLIPPER_CHOICE != False:
-        soft_clipper = engine.make_plugin_processor("my_soft_clipper", path.dirname(__file__)+conjoiner+'Plugins'+conjoiner+'Initial Clipper.dll')
-        soft_clipper.set_parameter(0, SOFT_CLIPPER_CHOICE[0]) #Threshold
-        soft_clipper.set_parameter(1, SOFT_CLIPPER_CHOICE[1]) #Input gain
-        soft_clipper.set_parameter(2, SOFT_CLIPPER_CHOICE[2]) #Positive saturation
-        soft_clipper.set_parameter(3, SOFT_CLIPPER_CHOICE[3]) #Negative saturation
-        soft_clipper.set_parameter(4, SOFT_CLIPPER_CHOICE[4]) #Saturate (0.0==False, 1.0==True)
+    sampleRate = getProcessingRate(file, sampleRate)
 
-        if len(OUR_GRAPH) == 3:
-            OUR_GRAPH.append((soft_clipper, ["my_reverb"]))
-        elif len(OUR_GRAPH) == 2 and reverbed == True:
-            OUR_GRAPH.append((soft_clipper, ["my_reverb"]))
-        elif len(OUR_GRAPH) == 2 and reverbed != True:
-            OUR_GRAPH.append((soft_clipper, ["my_bass_boost"]))
-        elif len(OUR_GRAPH) == 1:
-            OUR_GRAPH.append((soft_clipper, ["my_playback"]))
+    #What's running everything. A session can be passed in to reuse its engine and plugins across files
+    if session is None or session.sampleRate != sampleRate:
+        session = makeSession(backend, sampleRate=sampleRate)
 
-    #Load graph onto engine
-    engine.load_graph(OUR_GRAPH)
+    #Turn song into understandable language. The file is decoded exactly once
+    song, info = decodeAudio(file, sampleRate, quality=resampleQuality, pool=bufferPool)
 
-    #Render clip
-    durationOfClip = AudioFileClip(file)
-    if lowered == True:
-        durationOfClip = (durationOfClip.duration)*(2**(-tranposeValue/12))
-    else:
-        durationOfClip = durationOfClip.duration
-    engine.render(durationOfClip)
-        
-    #Extract audio from engine
-    audio = engine.get_audio()
+    with timer('render'):
+        audio = session.render(song, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE)
 
-    write(path.dirname(__file__)+conjoiner+'Output'+conjoiner+str(file[file.rfind(conjoiner)+1:]).upper()[:-4]+'.wav', SAMPLE_RATE, audio.transpose())
+    if outputFile is None:
+        outputFile = getOutputFile(file, outputFormat)
+    encodeAudio(outputFile, audio, sampleRate, outputFormat, peaksFile)
+    #Only now, since a render without stages hands back song itself
+    if bufferPool is not None:
+        bufferPool.give(song)
 
-    return True 
+    return info
 
-# TESTING TESTING TESTING
-loadPreset(r'C:\Users\samlb\Documents\DOWNLOAD_YOUTUBE\Output\Star Shopping.mp3', 'Default - Copy (2)')
-# megafyFile(r'C:\Users\samlb\Documents\DOWNLOAD_YOUTUBE\Output\Glaive - 1984 (Directed by Cole Bennett).mp3', PITCH_SHIFT_CHOICE=[3], BASS_BOOST_CHOICE=[0.75,0.272, 0.8, 0.5], SOFT_CLIPPER_CHOICE=[1.0, 0.5, 0.0, 0.0, 1.0])
\ No newline at end of file
+# TESTING TESTING TESTING (run with python -m megafy.megafy_script)
+if __name__ == '__main__':
+    loadPreset(r'C:\Users\samlb\Documents\DOWNLOAD_YOUTUBE\Output\Star Shopping.mp3', 'Default - Copy (2)')
+    # megafyFile(r'C:\Users\samlb\Documents\DOWNLOAD_YOUTUBE\Output\Glaive - 1984 (Directed by Cole Bennett).mp3', PITCH_SHIFT_CHOICE=[3], BASS_BOOST_CHOICE=[0.75,0.272, 0.8, 0.5], SOFT_CLIPPER_CHOICE=[1.0, 0.5, 0.0, 0.0, 1.0])
\ No newline at end of file
@@ -0,0 +1,106 @@
+'''
+Admission control for render workers: every job's peak memory is estimated up front, and a job only starts once its estimate fits in what's
+left of a host-wide budget shared by all the workers, so a burst of long tracks queues instead of getting workers killed by the OOM killer.
+'''
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+from .megafy_script import SAMPLE_RATE, getTimeRatio
+
+BYTES_PER_SAMPLE = 4
+#An engine with every plugin (or native filter) loaded, plus the interpreter and audio libraries. Deliberately generous
+ENGINE_BYTES = 256 * 1024**2
+#A streaming render only ever holds a few blocks, whatever the track's length
+STREAMING_BYTES = 64 * 1024**2
+#Longest tail any stage adds past the input (the reverb)
+TAIL_SECONDS = 5.0
+#How often a job waiting for room in the budget looks again
+ADMISSION_POLL_SECONDS = 0.1
+
+def estimatePeakBytes(info, stages, mode='full', sampleRate=SAMPLE_RATE, segmentWorkers=0):
+    '''
+    Rough upper bound on the memory a render of audio described by info (an ingest.AudioInfo) takes, from its length, channel count and stages
+    (the four stage choices megafyFile takes). mode is the render path: 'full' (megafyFile and megafyFileIncremental), 'streaming' or 'segmented'
+    (with segmentWorkers processes). sampleRate None means the file's own rate.
+    '''
+    rate = sampleRate or info.sampleRate
+    #Stages output stereo whatever goes in
+    channels = max(info.channels, 2)
+    inputBytes = info.duration*rate*channels*BYTES_PER_SAMPLE
+    outputBytes = (info.duration*getTimeRatio(stages[0]) + TAIL_SECONDS)*rate*channels*BYTES_PER_SAMPLE
+    #Decoding at the file's rate and then resampling holds both versions at once
+    decodeBytes = inputBytes + (info.duration*info.sampleRate*channels*BYTES_PER_SAMPLE if rate != info.sampleRate else 0)
+
+    if mode == 'streaming':
+        return int(ENGINE_BYTES + STREAMING_BYTES)
+    if mode == 'segmented':
+        #The shared track, every segment worker's engine and, at worst, every rendered segment waiting to be stitched
+        return int(ENGINE_BYTES*(1 + segmentWorkers) + decodeBytes + inputBytes + outputBytes)
+    #The decoded track, the engine's own copy of it, the engine's output buffer and the copy get_audio returns
+    return int(ENGINE_BYTES + decodeBytes + inputBytes + 2*outputBytes)
+
+class MemoryBudget:
+    '''
+    A byte budget shared by processes: make it in the parent before starting the workers, and give each worker its own slot (an index below slots).
+    Each slot holds at most one reservation, so a dead worker's reservation is released by clearing its slot (see releaseDead).
+
+    The lock is only ever held for a quick look at the reservations, never while waiting for room, and the slot holding it is recorded,
+    so a worker killed while holding it can't lock every other worker out.
+    '''
+    def __init__(self, limit, slots):
+        from multiprocessing import Array, Lock, Value
+
+        self.limit = limit
+        self.reserved = Array('q', slots, lock=False)
+        self.lock = Lock()
+        #Slot holding lock, -1 when nobody does
+        self.holder = Value('i', -1, lock=False)
+
+    def used(self):
+        return sum(self.reserved)
+
+    @contextmanager
+    def locked(self, slot):
+        with self.lock:
+            self.holder.value = slot
+            try:
+                yield
+            finally:
+                self.holder.value = -1
+
+    def tryAcquire(self, slot, amount):
+        '''
+        Reserves amount bytes for slot if they fit in the budget right now. A job bigger than the whole budget is admitted once nothing
+        else is reserved, so it still runs, alone. Returns whether they were reserved.
+        '''
+        with self.locked(slot):
+            used = self.used()
+            if used == 0 or used + amount <= self.limit:
+                self.reserved[slot] = amount
+                return True
+        return False
+
+    def acquire(self, slot, amount, timeout=None):
+        '''
+        tryAcquire, retried every ADMISSION_POLL_SECONDS until it succeeds. Returns False if timeout (seconds) ran out first.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        while not self.tryAcquire(slot, amount):
+            if deadline is not None and monotonic() >= deadline:
+                return False
+            sleep(ADMISSION_POLL_SECONDS if deadline is None else max(0, min(ADMISSION_POLL_SECONDS, deadline - monotonic())))
+        return True
+
+    def release(self, slot):
+        with self.locked(slot):
+            self.reserved[slot] = 0
+
+    def releaseDead(self, slot):
+        '''
+        release for the parent once the worker in slot has died, which also frees the lock if the worker died holding it.
+        Never waits for the lock, since a dead worker would hold it forever.
+        '''
+        if self.holder.value == slot:
+            self.holder.value = -1
+            self.lock.release()
+        self.reserved[slot] = 0
@@ -0,0 +1,200 @@
+'''
+Per-process render metrics: stage timers, counters and histograms, with hooks for anything else that wants to see them.
+
+Each process records into its own in-memory registry. Long-lived processes (the render workers) save it with writeSnapshot into a shared
+directory, and mergeSnapshots adds every process's snapshot up for GET /homepage/metrics/, which serves the total in Prometheus' text format.
+'''
+from contextlib import contextmanager
+from os import getpid, makedirs, path, replace, scandir
+from tempfile import mkstemp
+from threading import Lock
+from time import perf_counter
+import json
+
+#Upper bounds of each histogram's buckets (an implicit +Inf bucket follows)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+HISTOGRAM_BUCKETS = {
+    'megafy_stage_seconds': SECONDS_BUCKETS,
+    'megafy_job_seconds': SECONDS_BUCKETS,
+    'megafy_input_duration_seconds': (5, 15, 30, 60, 120, 180, 240, 300, 450, 600, 900, 1800, 3600),
+    'megafy_realtime_factor': (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 4),
+}
+METRIC_HELP = {
+    'megafy_stage_seconds': 'Wall time spent in each pipeline stage',
+    'megafy_job_seconds': 'Wall time of whole render jobs',
+    'megafy_input_duration_seconds': 'Length of the audio decoded for rendering',
+    'megafy_realtime_factor': 'Render wall time divided by audio length (below 1 is faster than real time)',
+    'megafy_input_bytes_total': 'Bytes of input audio files decoded',
+    'megafy_output_bytes_total': 'Bytes of encoded output written',
+    'megafy_output_frames_total': 'Frames of audio encoded',
+    'megafy_audio_seconds_total': 'Seconds of audio rendered',
+    'megafy_jobs_total': 'Render jobs finished, by outcome',
+    'megafy_render_cache_total': 'Render cache lookups, by result',
+    'megafy_worker_busy_seconds_total': 'Seconds render workers spent rendering jobs',
+}
+
+class Registry:
+    '''
+    Counters and histograms keyed by (name, sorted label pairs). Safe to use from several threads.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, labels=()):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels=()):
+        bounds = HISTOGRAM_BUCKETS.get(name, SECONDS_BUCKETS)
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = {'bounds': list(bounds), 'counts': [0]*len(bounds), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(histogram['bounds']):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        '''
+        Everything recorded so far as JSON-friendly data (see mergeSnapshots)
+        '''
+        with self.lock:
+            return {
+                'pid': getpid(),
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), dict(histogram, counts=list(histogram['counts']))] for (name, labels), histogram in self.histograms.items()],
+            }
+
+registry = Registry()
+#Called as hook(kind, name, value, labels) for every increment ('counter') and observation ('histogram'), e.g. to forward them to StatsD
+hooks = []
+
+def addHook(hook):
+    hooks.append(hook)
+
+def removeHook(hook):
+    hooks.remove(hook)
+
+def labelPairs(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def increment(name, value=1, **labels):
+    pairs = labelPairs(labels)
+    registry.increment(name, value, pairs)
+    for hook in hooks:
+        hook('counter', name, value, dict(pairs))
+
+def observe(name, value, **labels):
+    pairs = labelPairs(labels)
+    registry.observe(name, value, pairs)
+    for hook in hooks:
+        hook('histogram', name, value, dict(pairs))
+
+@contextmanager
+def timer(stage, name='megafy_stage_seconds', **labels):
+    '''
+    Records how long the with block took under stage (also when it raises)
+    '''
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - started, stage=stage, **labels)
+
+def writeSnapshot(directory):
+    '''
+    Atomically saves this process's metrics as <pid>.json in directory. Counters only grow, so a snapshot left behind by a process that has
+    since exited still counts towards the totals.
+    '''
+    directory = str(directory)
+    makedirs(directory, exist_ok=True)
+    handle, temporary = mkstemp(dir=directory, suffix='.part')
+    with open(handle, 'w') as snapshotFile:
+        json.dump(registry.snapshot(), snapshotFile)
+    replace(temporary, path.join(directory, '%d.json' % getpid()))
+
+def mergeSnapshots(directory, extra=()):
+    '''
+    Adds up every snapshot in directory plus the snapshots in extra (a process's own, live one takes the place of its saved file).
+    Returns (counters, histograms) keyed like Registry's.
+    '''
+    snapshots = {snapshot['pid']: snapshot for snapshot in extra}
+    if path.isdir(str(directory)):
+        for entry in scandir(str(directory)):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as snapshotFile:
+                    snapshot = json.load(snapshotFile)
+            except (OSError, ValueError):
+                continue
+            snapshots.setdefault(snapshot.get('pid'), snapshot)
+
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots.values():
+        for name, labels, value in snapshot.get('counters', []):
+            key = (name, labelPairs(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot.get('histograms', []):
+            key = (name, labelPairs(labels))
+            merged = histograms.get(key)
+            if merged is None or merged['bounds'] != histogram['bounds']:
+                #Bucket bounds only change with the code, and the newest snapshot wins then
+                histograms[key] = dict(histogram, counts=list(histogram['counts']))
+                continue
+            merged['counts'] = [left + right for left, right in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+    return counters, histograms
+
+def formatLabels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs)
+
+def formatNumber(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def renderPrometheus(counters, histograms, gauges=()):
+    '''
+    Prometheus text exposition (format 0.0.4) of merged counters and histograms plus gauges, a list of (name, help, labels dict, value)
+    '''
+    lines = []
+    def header(name, kind, helpText=None):
+        lines.append('# HELP %s %s' % (name, helpText or METRIC_HELP.get(name, name)))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    for name in sorted({name for name, _ in counters}):
+        header(name, 'counter')
+        for (counterName, labels), value in sorted(counters.items()):
+            if counterName == name:
+                lines.append('%s%s %s' % (name, formatLabels(labels), formatNumber(value)))
+
+    for name in sorted({name for name, _ in histograms}):
+        header(name, 'histogram')
+        for (histogramName, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            if histogramName != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram['bounds'], histogram['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, formatLabels(labels, le=formatNumber(float(bound))), cumulative))
+            lines.append('%s_bucket%s %d' % (name, formatLabels(labels, le='+Inf'), histogram['count']))
+            lines.append('%s_sum%s %s' % (name, formatLabels(labels), formatNumber(float(histogram['sum']))))
+            lines.append('%s_count%s %d' % (name, formatLabels(labels), histogram['count']))
+
+    seen = set()
+    for name, helpText, labels, value in gauges:
+        if name not in seen:
+            header(name, 'gauge', helpText)
+            seen.add(name)
+        lines.append('%s%s %s' % (name, formatLabels(labelPairs(labels)), formatNumber(value)))
+
+    return '\n'.join(lines) + '\n'
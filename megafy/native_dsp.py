@@ -0,0 +1,243 @@
+'''
+Pure NumPy/SciPy versions of megafy's four stages, for machines that can't load the Windows VST plugins.
+
+Every stage takes the same 0.0 to 1.0 choices documented in megafyFile and maps them onto the same units (dB, Hz, %) the plugins use.
+All processing is vectorized (biquads through sosfilt, reverb through FFT overlap-add convolution), and the effect stages keep their
+filter state and reverb tail between calls to process(), so feeding a track through in blocks gives the same result as feeding it in one go.
+'''
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, oaconvolve, resample_poly, sosfilt
+
+#Largest denominator used when turning a pitch shift's time ratio into an up/down resampling pair
+MAX_RATIO_DENOMINATOR = 256
+#Length of the synthetic reverb impulse response (time for it to decay by 60 dB)
+REVERB_SECONDS = 2.0
+REVERB_PREDELAY_SECONDS = 0.012
+REVERB_SEED = 1984
+
+def decibelsToGain(decibels):
+    return 10**(decibels/20)
+
+def varispeedRatio(PITCH_SHIFT_CHOICE=False):
+    '''
+    The exact (rational) time ratio the native pitch shift applies. Shifting pitch by n semitones while stretching the length by 2**(-n/12),
+    which is what megafyFile asks dawdreamer for, is the same as resampling, so that's all the native pitch shift does.
+    '''
+    if PITCH_SHIFT_CHOICE == False:
+        return Fraction(1)
+    return Fraction(2**(-PITCH_SHIFT_CHOICE[0]/12)).limit_denominator(MAX_RATIO_DENOMINATOR)
+
+def varispeed(audio, PITCH_SHIFT_CHOICE=False):
+    ratio = varispeedRatio(PITCH_SHIFT_CHOICE)
+    if ratio == 1:
+        return audio
+    return resample_poly(audio, ratio.numerator, ratio.denominator, axis=-1).astype(np.float32)
+
+def peakingSection(frequency, gainDb, q, sampleRate):
+    '''
+    RBJ cookbook peaking EQ as one second-order section
+    '''
+    amplitude = 10**(gainDb/40)
+    omega = 2*np.pi*frequency/sampleRate
+    alpha = np.sin(omega)/(2*q)
+    b = [1 + alpha*amplitude, -2*np.cos(omega), 1 - alpha*amplitude]
+    a = [1 + alpha/amplitude, -2*np.cos(omega), 1 - alpha/amplitude]
+    return np.array(b + a)/a[0]
+
+def lowShelfSection(frequency, gainDb, sampleRate):
+    '''
+    RBJ cookbook low shelf (slope 1) as one second-order section
+    '''
+    amplitude = 10**(gainDb/40)
+    omega = 2*np.pi*frequency/sampleRate
+    alpha = np.sin(omega)/np.sqrt(2)
+    cosine = np.cos(omega)
+    root = 2*np.sqrt(amplitude)*alpha
+    b = [amplitude*((amplitude + 1) - (amplitude - 1)*cosine + root), 2*amplitude*((amplitude - 1) - (amplitude + 1)*cosine), amplitude*((amplitude + 1) - (amplitude - 1)*cosine - root)]
+    a = [(amplitude + 1) + (amplitude - 1)*cosine + root, -2*((amplitude - 1) + (amplitude + 1)*cosine), (amplitude + 1) + (amplitude - 1)*cosine - root]
+    return np.array(b + a)/a[0]
+
+class BassBoost:
+    '''
+    BASS_BOOST_CHOICE as a low-shelf/peaking biquad bass boost.
+
+        [0] Output gain: 0.0 to 1.0 -> -20 to +20 dB
+        [1] Frequency:   0.0 to 1.0 -> 10 to 2000 Hz on a cubic curve (0.327654 -> 80 Hz, the plugin's default)
+        [2] Boost:       0.0 to 1.0 -> 0 to +18 dB
+        [3] Mode:        0.0 Classic (peaking bell), 0.5 Passive (low shelf), 1.0 Combo (both, splitting the boost)
+    '''
+    def __init__(self, BASS_BOOST_CHOICE, sampleRate, channels):
+        self.outputGain = decibelsToGain(-20 + 40*BASS_BOOST_CHOICE[0])
+        frequency = min(10 + 1990*BASS_BOOST_CHOICE[1]**3, 0.45*sampleRate)
+        boostDb = 18*BASS_BOOST_CHOICE[2]
+        mode = BASS_BOOST_CHOICE[3]
+
+        if mode < 0.25:
+            sections = [peakingSection(frequency, boostDb, 0.707, sampleRate)]
+        elif mode < 0.75:
+            sections = [lowShelfSection(frequency, boostDb, sampleRate)]
+        else:
+            sections = [peakingSection(frequency, boostDb/2, 0.707, sampleRate), lowShelfSection(frequency, boostDb/2, sampleRate)]
+        self.sos = np.array(sections)
+        self.state = np.zeros((len(sections), channels, 2))
+
+    def process(self, block):
+        out, self.state = sosfilt(self.sos, block, axis=-1, zi=self.state)
+        return out*self.outputGain
+
+@lru_cache(maxsize=8)
+def reverbImpulse(sampleRate, seconds=REVERB_SECONDS):
+    '''
+    Synthetic stereo room: decorrelated noise per channel with an exponential decay reaching -60 dB after seconds, behind a short predelay.
+    Seeded, so every render (and every worker) uses the same room.
+    '''
+    random = np.random.default_rng(REVERB_SEED)
+    frames = int(seconds*sampleRate)
+    predelay = int(REVERB_PREDELAY_SECONDS*sampleRate)
+    decay = np.exp(-6.9077*np.arange(frames)/frames)
+    impulse = np.zeros((2, predelay + frames), dtype=np.float32)
+    impulse[:, predelay:] = random.standard_normal((2, frames))*decay
+    #Unit energy per channel keeps the wet signal at roughly the dry signal's loudness
+    impulse /= np.sqrt(np.sum(impulse**2, axis=1, keepdims=True))
+    impulse.setflags(write=False)
+    return impulse
+
+def stereoWidth(choice):
+    #0.0 -> mono, 0.333333 -> unchanged (100%), 1.0 -> 200%
+    if choice <= 1/3:
+        return 3*choice
+    return 1 + 1.5*(choice - 1/3)
+
+class Reverb:
+    '''
+    REVERB_CHOICE as an FFT overlap-add convolution reverb.
+
+        [0] Reverb:    0.0 to 1.0 -> dry/wet mix (0.0 dry, 1.0 fully wet)
+        [1] Wide:      0.0 to 1.0 -> 0% (mono) to 200% stereo width, 0.333333 unchanged
+        [2] High-pass: 0.0 off, otherwise 20 Hz to 20000 Hz (log scale) on the wet signal
+        [3] Low-pass:  1.0 off, otherwise 20 Hz to 20000 Hz (log scale) on the wet signal
+
+    The part of each block's convolution that rings past the end of the block is kept and added to the next block.
+    '''
+    def __init__(self, REVERB_CHOICE, sampleRate, channels, tailSeconds=REVERB_SECONDS):
+        self.mix = REVERB_CHOICE[0]
+        self.width = stereoWidth(REVERB_CHOICE[1])
+        impulse = reverbImpulse(sampleRate, tailSeconds)
+        self.impulse = impulse[np.arange(channels) % 2]
+        self.tail = np.zeros((channels, self.impulse.shape[1] - 1), dtype=np.float32)
+
+        nyquist = sampleRate/2
+        sections = []
+        if REVERB_CHOICE[2] > 0:
+            sections.append(butter(2, min(20*1000**REVERB_CHOICE[2], 0.95*nyquist), 'highpass', fs=sampleRate, output='sos'))
+        if REVERB_CHOICE[3] < 1:
+            sections.append(butter(2, min(20*1000**REVERB_CHOICE[3], 0.95*nyquist), 'lowpass', fs=sampleRate, output='sos'))
+        self.sos = np.concatenate(sections) if sections else None
+        self.state = np.zeros((len(self.sos), channels, 2)) if sections else None
+
+    def process(self, block):
+        frames = block.shape[-1]
+        wet = oaconvolve(block, self.impulse, axes=-1)
+
+        #Add what earlier blocks are still ringing, then carry this block's own overhang forward
+        overlap = min(frames, self.tail.shape[1])
+        wet[:, :overlap] += self.tail[:, :overlap]
+        carried = np.zeros_like(self.tail)
+        carried[:, :self.tail.shape[1] - overlap] = self.tail[:, overlap:]
+        carried += wet[:, frames:]
+        self.tail = carried
+        wet = wet[:, :frames]
+
+        if self.sos is not None:
+            wet, self.state = sosfilt(self.sos, wet, axis=-1, zi=self.state)
+
+        out = (1 - self.mix)*block + self.mix*wet
+        if out.shape[0] == 2 and self.width != 1:
+            mid = (out[0] + out[1])/2
+            side = (out[0] - out[1])/2*self.width
+            out = np.stack((mid + side, mid - side))
+        return out
+
+def softKnee(level, threshold, saturation):
+    '''
+    Bends levels (>= 0) smoothly towards threshold. Low saturation is close to a hard clip, high saturation bends early and gently.
+    '''
+    sharpness = 2/saturation
+    ratio = np.asarray(level, dtype=np.float64)/threshold
+    return threshold*ratio/(1 + ratio**sharpness)**(1/sharpness)
+
+class SoftClipper:
+    '''
+    SOFT_CLIPPER_CHOICE as a stateless waveshaper.
+
+        [0] Threshold:           0.0 to 1.0 -> -10 to 0 dB
+        [1] Input gain:          0.0 to 1.0 -> -9 to +9 dB
+        [2] Positive saturation: 0.0 to 1.0 -> 0.1 to 2.0 knee softness for the positive half of the wave
+        [3] Negative saturation: 0.0 to 1.0 -> 0.1 to 2.0 knee softness for the negative half of the wave
+        [4] Saturation:          0.0 off, 1.0 adds tanh drive on top (fatter sound)
+    '''
+    def __init__(self, SOFT_CLIPPER_CHOICE, sampleRate=None, channels=None):
+        self.threshold = decibelsToGain(-10 + 10*SOFT_CLIPPER_CHOICE[0])
+        self.inputGain = decibelsToGain(-9 + 18*SOFT_CLIPPER_CHOICE[1])
+        self.positiveSaturation = 0.1 + 1.9*SOFT_CLIPPER_CHOICE[2]
+        self.negativeSaturation = 0.1 + 1.9*SOFT_CLIPPER_CHOICE[3]
+        self.saturate = SOFT_CLIPPER_CHOICE[4] >= 0.5
+
+    def process(self, block):
+        driven = block*self.inputGain
+        out = np.where(
+            driven >= 0,
+            softKnee(np.maximum(driven, 0), self.threshold, self.positiveSaturation),
+            -softKnee(np.maximum(-driven, 0), self.threshold, self.negativeSaturation),
+        )
+        if self.saturate:
+            out = 0.5*out + 0.5*self.threshold*np.tanh(1.5*out/self.threshold)/np.tanh(1.5)
+        return out
+
+class NativeChain:
+    '''
+    The effect stages after the pitch shift (bass boost -> reverb -> soft clipper), each keeping its state between process() calls
+    '''
+    def __init__(self, sampleRate, channels, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, reverbSeconds=REVERB_SECONDS):
+        self.stages = []
+        if BASS_BOOST_CHOICE != False:
+            self.stages.append(BassBoost(BASS_BOOST_CHOICE, sampleRate, channels))
+        if REVERB_CHOICE != False:
+            self.stages.append(Reverb(REVERB_CHOICE, sampleRate, channels, reverbSeconds))
+        if SOFT_CLIPPER_CHOICE != False:
+            self.stages.append(SoftClipper(SOFT_CLIPPER_CHOICE))
+
+    def process(self, block):
+        if block.shape[-1] == 0:
+            return np.asarray(block, dtype=np.float32)
+        for stage in self.stages:
+            block = stage.process(block)
+        return np.asarray(block, dtype=np.float32)
+
+def toStereo(song):
+    #The plugins always output stereo, so mono input is upmixed the same way here
+    song = np.atleast_2d(song)
+    if song.shape[0] == 1:
+        return np.repeat(song, 2, axis=0)
+    return song
+
+class NativeSession:
+    '''
+    Drop-in for RenderSession (same render/timeRatio methods) that runs the native stages instead of dawdreamer and the VST plugins
+    '''
+    def __init__(self, sampleRate, reverbSeconds=REVERB_SECONDS):
+        self.sampleRate = sampleRate
+        self.reverbSeconds = reverbSeconds
+
+    def timeRatio(self, PITCH_SHIFT_CHOICE=False):
+        return float(varispeedRatio(PITCH_SHIFT_CHOICE))
+
+    def makeChain(self, channels, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False):
+        return NativeChain(self.sampleRate, channels, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, self.reverbSeconds)
+
+    def render(self, song, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False):
+        song = varispeed(toStereo(np.asarray(song, dtype=np.float32)), PITCH_SHIFT_CHOICE)
+        return self.makeChain(song.shape[0], BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE).process(song)
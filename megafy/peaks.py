@@ -0,0 +1,151 @@
+'''
+Min/max waveform peaks at every zoom level, so a waveform can be drawn without downloading the audio.
+
+Level 0 has one (min, max) pair per channel for every PEAK_FRAMES frames, and every level above it halves the one below, down to about
+MIN_LEVEL_PEAKS peaks. Renders build them block by block while the output is encoded (see encoder.AudioEncoder) and store them beside the
+result in a .peaks file:
+
+    header      '<4sHHIIIQ': PEAKS_MAGIC, format version, channels, levels, sample rate, PEAK_FRAMES, total frames
+    counts      '<I' per level: how many peaks it has
+    levels      level 0 first, each (count, channels, 2) int8 with min then max, full scale being 127
+'''
+from os import makedirs, path, replace
+from tempfile import mkstemp
+import struct
+
+import numpy as np
+
+PEAKS_MAGIC = b'MGPK'
+PEAKS_VERSION = 1
+PEAKS_HEADER = struct.Struct('<4sHHIIIQ')
+PEAK_FRAMES = 256
+#No level is coarser than this many peaks, about the width of a small waveform
+MIN_LEVEL_PEAKS = 512
+PEAK_SCALE = 127
+
+def getPeaksFile(audioFile):
+    '''
+    Where the peaks of audioFile are kept: beside it, with .peaks appended (so song.mp3 and song.wav don't share one)
+    '''
+    return audioFile + '.peaks'
+
+def getInputPeaksFile(outputFile):
+    '''
+    Where a render job keeps the peaks of its input: beside its result, so nothing is ever written next to the inputs
+    '''
+    return outputFile + '.input.peaks'
+
+def quantizePeaks(mins, maxs):
+    '''
+    (peaks, channels) float mins and maxs as one (peaks, channels, 2) int8 array, rounded outwards so a peak never looks quieter than it is
+    '''
+    return np.clip(np.stack((np.floor(mins*PEAK_SCALE), np.ceil(maxs*PEAK_SCALE)), axis=-1), -PEAK_SCALE, PEAK_SCALE).astype(np.int8)
+
+def halvePeaks(peaks):
+    '''
+    The next level up from peaks: every pair merged into one (an odd last peak is kept as it is)
+    '''
+    if len(peaks) % 2:
+        peaks = np.concatenate((peaks, peaks[-1:]))
+    return np.stack((np.minimum(peaks[0::2, :, 0], peaks[1::2, :, 0]), np.maximum(peaks[0::2, :, 1], peaks[1::2, :, 1])), axis=-1)
+
+class PeakBuilder:
+    '''
+    Collects level 0 peaks from (frames, channels) blocks handed to add in order; finish returns every level
+    '''
+    def __init__(self, channels, sampleRate):
+        self.channels = channels
+        self.sampleRate = sampleRate
+        self.frames = 0
+        self.chunks = []
+        #The frames after the last whole PEAK_FRAMES of everything added so far
+        self.carry = np.empty((0, channels), dtype=np.float32)
+
+    def add(self, block):
+        self.frames += block.shape[0]
+        if len(self.carry):
+            block = np.concatenate((self.carry, block))
+        whole = len(block) - len(block) % PEAK_FRAMES
+        if whole:
+            windows = block[:whole].reshape(-1, PEAK_FRAMES, self.channels)
+            self.chunks.append(quantizePeaks(windows.min(axis=1), windows.max(axis=1)))
+        #Copied, since block is often a buffer the caller reuses
+        self.carry = np.array(block[whole:], dtype=np.float32)
+
+    def finish(self):
+        if len(self.carry):
+            self.chunks.append(quantizePeaks(self.carry.min(axis=0, keepdims=True), self.carry.max(axis=0, keepdims=True)))
+            self.carry = self.carry[:0]
+        levels = [np.concatenate(self.chunks) if self.chunks else np.zeros((0, self.channels, 2), dtype=np.int8)]
+        while len(levels[-1]) > MIN_LEVEL_PEAKS:
+            levels.append(halvePeaks(levels[-1]))
+        return levels
+
+    def write(self, peaksFile):
+        '''
+        finish, then atomically save the result as peaksFile
+        '''
+        levels = self.finish()
+        directory = path.dirname(peaksFile) or '.'
+        makedirs(directory, exist_ok=True)
+        handle, temporary = mkstemp(dir=directory, suffix='.part')
+        with open(handle, 'wb') as output:
+            output.write(PEAKS_HEADER.pack(PEAKS_MAGIC, PEAKS_VERSION, self.channels, len(levels), self.sampleRate, PEAK_FRAMES, self.frames))
+            output.write(struct.pack('<%dI' % len(levels), *[len(level) for level in levels]))
+            for level in levels:
+                output.write(np.ascontiguousarray(level).tobytes())
+        replace(temporary, peaksFile)
+
+def readPeaksIndex(peaksFile):
+    '''
+    The header of a .peaks file as a dict, including every level's peak count and frames per peak. Raises ValueError for anything else.
+    '''
+    with open(peaksFile, 'rb') as source:
+        header = source.read(PEAKS_HEADER.size)
+        if len(header) < PEAKS_HEADER.size:
+            raise ValueError('%s is not a peaks file' % peaksFile)
+        magic, version, channels, levels, sampleRate, peakFrames, frames = PEAKS_HEADER.unpack(header)
+        if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+            raise ValueError('%s is not a version %d peaks file' % (peaksFile, PEAKS_VERSION))
+        counts = struct.unpack('<%dI' % levels, source.read(4*levels))
+    return {
+        'channels': channels,
+        'sampleRate': sampleRate,
+        'frames': frames,
+        'levels': [{'level': level, 'peaks': count, 'framesPerPeak': peakFrames << level} for level, count in enumerate(counts)],
+    }
+
+def readPeaksLevel(peaksFile, level):
+    '''
+    The raw bytes of one level of a .peaks file (see the layout above), read without touching the other levels
+    '''
+    index = readPeaksIndex(peaksFile)
+    if not 0 <= level < len(index['levels']):
+        raise ValueError('Level must be between 0 and %d' % (len(index['levels']) - 1))
+    peakBytes = index['channels']*2
+    offset = PEAKS_HEADER.size + 4*len(index['levels']) + sum(entry['peaks'] for entry in index['levels'][:level])*peakBytes
+    with open(peaksFile, 'rb') as source:
+        source.seek(offset)
+        return source.read(index['levels'][level]['peaks']*peakBytes)
+
+def buildPeaksFile(audioFile, peaksFile=None):
+    '''
+    Reads audioFile front to back (never holding all of it) and writes its peaks to peaksFile (getPeaksFile(audioFile) by default).
+    For files no render wrote peaks for, like inputs. Returns peaksFile.
+    '''
+    from .streaming import BlockReader
+
+    peaksFile = peaksFile or getPeaksFile(audioFile)
+    reader = BlockReader(audioFile)
+    try:
+        builder = PeakBuilder(reader.channels, reader.sampleRate)
+        while True:
+            block = reader.read(1 << 16)
+            if block.shape[1]:
+                builder.add(np.clip(block.T, -1.0, 1.0))
+            if block.shape[1] < 1 << 16:
+                break
+    finally:
+        reader.close()
+    builder.write(peaksFile)
+    return peaksFile
@@ -0,0 +1,212 @@
+'''
+Every preset in megafy/Presets, parsed and validated once into immutable Preset objects.
+
+The registry reads the folder when it's made, and refresh re-reads only files whose mtime changed (and forgets deleted ones). A long-running
+process calls watch to refresh from a background thread, so get and list never touch the disk. A file that fails validation never replaces
+the last good version of its preset; the error is kept in errors instead, and surfaces when the preset is asked for.
+
+Preset files have one line per stage, in the order megafyFile takes them:
+
+    Pitch Shift     False or a whole number of semitones from -12 to 12
+    Bass Boost      False or four numbers from 0.0 to 1.0, the last (mode) being 0.0, 0.5 or 1.0
+    Reverb          False or four numbers from 0.0 to 1.0
+    Soft Clipper    False or five numbers from 0.0 to 1.0, the last (saturate) being 0.0 or 1.0
+'''
+from dataclasses import dataclass, field
+from hashlib import sha256
+from os import path, scandir
+from threading import Event, Lock, Thread
+import json
+
+PRESETS_DIR = path.join(path.dirname(__file__), 'Presets')
+PRESET_EXTENSION = '.txt'
+#(name, how many values, lowest, highest) per line of a preset file
+PRESET_STAGES = [
+    ('pitchShift', 1, -12.0, 12.0),
+    ('bassBoost', 4, 0.0, 1.0),
+    ('reverb', 4, 0.0, 1.0),
+    ('softClipper', 5, 0.0, 1.0),
+]
+#Values that only take a few settings (see the megafyFile docstring), by stage and position: bass boost mode and soft clipper saturation
+PRESET_CHOICES = {
+    ('bassBoost', 3): (0.0, 0.5, 1.0),
+    ('softClipper', 4): (0.0, 1.0),
+}
+
+class PresetError(ValueError):
+    pass
+
+@dataclass(frozen=True)
+class Preset:
+    '''
+    One validated preset. Each stage is False or a tuple of floats.
+    '''
+    name: str
+    pitchShift: object
+    bassBoost: object
+    reverb: object
+    softClipper: object
+    #mtime of the file it was read from
+    modified: float = field(default=0.0, compare=False)
+
+    @property
+    def stages(self):
+        '''
+        The four stage choices as megafyFile takes them (what readPreset returns)
+        '''
+        return [list(choice) if choice is not False else False for choice in (self.pitchShift, self.bassBoost, self.reverb, self.softClipper)]
+
+    @property
+    def stageDict(self):
+        '''
+        The stage choices by name, as render jobs store them
+        '''
+        return dict(zip([stage[0] for stage in PRESET_STAGES], self.stages))
+
+    @property
+    def key(self):
+        '''
+        Stable hash of the preset's values (not its name), so presets that sound the same share cache entries
+        '''
+        from .megafy_script import normalizeStages
+
+        return sha256(json.dumps(normalizeStages(*self.stages), separators=(',', ':')).encode()).hexdigest()
+
+    def info(self):
+        return {'name': self.name, 'key': self.key, **self.stageDict}
+
+def parsePreset(name, text, modified=0.0):
+    '''
+    A Preset from the text of a preset file. Raises PresetError saying which line is wrong.
+    '''
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if len(lines) != len(PRESET_STAGES):
+        raise PresetError('Preset %r has %d lines, expected %d' % (name, len(lines), len(PRESET_STAGES)))
+
+    choices = []
+    for number, (line, (stage, arity, lowest, highest)) in enumerate(zip(lines, PRESET_STAGES), 1):
+        if line == 'False':
+            choices.append(False)
+            continue
+        try:
+            values = tuple(float(value) for value in line.split())
+        except ValueError:
+            raise PresetError('Preset %r line %d (%s) must be False or numbers' % (name, number, stage))
+        if len(values) != arity:
+            raise PresetError('Preset %r line %d (%s) must have %d values, not %d' % (name, number, stage, arity, len(values)))
+        if not all(lowest <= value <= highest for value in values):
+            raise PresetError('Preset %r line %d (%s) values must be between %s and %s' % (name, number, stage, lowest, highest))
+        if stage == 'pitchShift' and not values[0].is_integer():
+            raise PresetError('Preset %r line %d (%s) must be a whole number of semitones' % (name, number, stage))
+        for position, value in enumerate(values):
+            allowed = PRESET_CHOICES.get((stage, position))
+            if allowed is not None and value not in allowed:
+                raise PresetError('Preset %r line %d (%s) value %d must be one of %s' % (name, number, stage, position+1, ', '.join(map(str, allowed))))
+        choices.append(values)
+    return Preset(name, *choices, modified=modified)
+
+class PresetRegistry:
+    def __init__(self, directory=PRESETS_DIR):
+        self.directory = directory
+        self.presets = {}
+        #Why each preset file that doesn't validate was rejected, by name
+        self.errors = {}
+        self.mtimes = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.watcher = None
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Re-reads preset files that are new or whose mtime changed and forgets deleted ones. Returns the names that changed.
+        '''
+        found = {}
+        if path.isdir(self.directory):
+            for entry in scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(PRESET_EXTENSION):
+                    found[entry.name[:-len(PRESET_EXTENSION)]] = (entry.path, entry.stat().st_mtime)
+
+        changed = []
+        for name, (file, modified) in found.items():
+            if self.mtimes.get(name) == modified:
+                continue
+            try:
+                with open(file) as source:
+                    preset = parsePreset(name, source.read(), modified)
+            except (OSError, UnicodeDecodeError, PresetError) as error:
+                with self.lock:
+                    self.errors[name] = str(error)
+            else:
+                with self.lock:
+                    self.presets[name] = preset
+                    self.errors.pop(name, None)
+            self.mtimes[name] = modified
+            changed.append(name)
+
+        with self.lock:
+            for name in set(self.mtimes) - set(found):
+                self.presets.pop(name, None)
+                self.errors.pop(name, None)
+                del self.mtimes[name]
+                changed.append(name)
+        return changed
+
+    def get(self, name):
+        '''
+        The preset called name (its last good version if its file has since been broken). Raises PresetError if there's no such preset
+        or its file has never validated.
+        '''
+        with self.lock:
+            preset = self.presets.get(name)
+            error = self.errors.get(name)
+        if preset is None:
+            raise PresetError(error or 'Unknown preset %r' % name)
+        return preset
+
+    def list(self):
+        '''
+        Every valid preset, by name
+        '''
+        with self.lock:
+            return [self.presets[name] for name in sorted(self.presets)]
+
+    def watch(self, interval):
+        '''
+        Refreshes every interval seconds on a daemon thread until stop. Calling it again while it's watching does nothing.
+        '''
+        if self.watcher is not None:
+            return
+
+        def loop():
+            while not self.stopped.wait(interval):
+                try:
+                    self.refresh()
+                except OSError:
+                    continue
+
+        self.watcher = Thread(target=loop, name='preset-watcher', daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+registry = None
+registryLock = Lock()
+
+def getRegistry():
+    '''
+    This process's registry of the presets in PRESETS_DIR, loaded on first use
+    '''
+    global registry
+    with registryLock:
+        if registry is None:
+            registry = PresetRegistry()
+    return registry
+
+def watchPresets(interval):
+    '''
+    Loads this process's registry and keeps it up to date from a watcher thread. Call it once in every process that uses presets while
+    it runs (the web entry points and render workers), after any fork, since forked children don't inherit the thread.
+    '''
+    getRegistry().watch(interval)
@@ -0,0 +1,89 @@
+from io import BytesIO
+from threading import Lock, Thread
+import traceback
+
+import numpy as np
+import soundfile as sf
+
+from .ingest import decodeAudio, resampleAudio
+from .megafy_script import DEFAULT_BACKEND, SAMPLE_RATE, makeSession, normalizeStages, warmUp
+from .single_flight import SingleFlight
+
+PREVIEW_SECONDS = 15.0
+
+#What each preview tier gives up for speed: internal sample rate, pitch shifter mode (see PITCH_QUALITIES) and native reverb tail length
+QUALITY_TIERS = {
+    'draft': {'sampleRate': 22050, 'pitchQuality': 'speed', 'reverbSeconds': 0.5},
+    'balanced': {'sampleRate': 32000, 'pitchQuality': 'consistency', 'reverbSeconds': 1.0},
+    'full': {'sampleRate': SAMPLE_RATE, 'pitchQuality': 'quality', 'reverbSeconds': None},
+}
+#Resampler (see ingest.RESAMPLE_QUALITIES) each tier decodes with. The lower tiers use the polyphase one, since the others cost more than a short render saves
+RESAMPLE_QUALITIES = {'draft': 'fast', 'balanced': 'fast', 'full': None}
+
+#Building an engine and loading plugins costs more than rendering a short window, so every (backend, tier) keeps one session per process
+previewSessions = {}
+previewLock = Lock()
+#Identical previews requested at the same time (e.g. several people auditioning the same preset) share one render
+previewFlight = SingleFlight()
+
+def getPreviewSession(backend, quality):
+    key = (backend or DEFAULT_BACKEND, quality)
+    if key not in previewSessions:
+        previewSessions[key] = makeSession(key[0], **QUALITY_TIERS[quality])
+    return previewSessions[key]
+
+def warmUpPreviews(backend=None):
+    '''
+    warmUp for the preview path: warms every tier's session and runs each tier's resampler once, which loads librosa (and compiles resampy's filters)
+    before the first preview instead of during it
+    '''
+    for quality, tier in QUALITY_TIERS.items():
+        with previewLock:
+            warmUp(getPreviewSession(backend, quality))
+        #From a rate no tier uses, so every resampler actually runs
+        resampleAudio(np.zeros((2, 4800), dtype=np.float32), 48000, tier['sampleRate'], RESAMPLE_QUALITIES[quality])
+
+def startPreviewWarmUp(backend=None):
+    '''
+    Runs warmUpPreviews on a daemon thread, so a web process can start serving right away. A failure is printed, and the first preview then pays for it.
+    '''
+    def run():
+        try:
+            warmUpPreviews(backend)
+        except Exception:
+            traceback.print_exc()
+
+    thread = Thread(target=run, name='preview-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+def renderPreview(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, offset=0.0, duration=PREVIEW_SECONDS, quality='draft', backend=None):
+    '''
+    Megafies only duration seconds of file starting at offset, at one of the QUALITY_TIERS, for tuning parameters interactively.
+    Only the window is decoded (resampled straight to the tier's rate) and rendered. Stage choices are documented in megafyFile.
+
+    Returns (audio, sampleRate) with audio as (channels, frames).
+    '''
+    if quality not in QUALITY_TIERS:
+        raise ValueError('Unknown preview quality %r (choose from %s)' % (quality, ', '.join(QUALITY_TIERS)))
+    sampleRate = QUALITY_TIERS[quality]['sampleRate']
+
+    song, _ = decodeAudio(file, sampleRate, duration=duration, offset=offset, quality=RESAMPLE_QUALITIES[quality])
+
+    #Sessions aren't thread safe and the web server may preview from several threads
+    with previewLock:
+        audio = getPreviewSession(backend, quality).render(song, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE)
+    return audio, sampleRate
+
+def previewWav(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, offset=0.0, duration=PREVIEW_SECONDS, quality='draft', backend=None):
+    '''
+    renderPreview encoded as the bytes of a 16-bit WAV, ready to send to the browser
+    '''
+    key = (file, normalizeStages(PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE), offset, duration, quality, backend or DEFAULT_BACKEND)
+    return previewFlight.do(key, encodePreview, file, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, offset, duration, quality, backend)
+
+def encodePreview(file, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, offset, duration, quality, backend):
+    audio, sampleRate = renderPreview(file, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, offset, duration, quality, backend)
+    encoded = BytesIO()
+    sf.write(encoded, audio.T, sampleRate, format='WAV', subtype='PCM_16')
+    return encoded.getvalue()
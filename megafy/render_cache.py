@@ -0,0 +1,237 @@
+from functools import lru_cache
+from hashlib import sha256
+from os import close, link, makedirs, path, replace, scandir, stat, unlink, utime
+from shutil import copyfile
+from tempfile import mkstemp
+from threading import Lock
+import json
+
+from .megafy_script import DEFAULT_BACKEND, OUTPUT_FORMATS, SAMPLE_RATE, getOutputFile, megafyFile, normalizeStages
+from .metrics import increment
+
+#Bump whenever a change to the render chain would make old cached renders wrong
+CACHE_VERSION = 1
+HASH_CHUNK_BYTES = 1 << 20
+#Entries keep their output format's extension. Waveform peaks are kept beside their render as <key>.peaks
+PEAKS_EXTENSION = '.peaks'
+#Peaks of an input track, under the hash of the input's contents (evicted like any other .peaks entry)
+INPUT_PEAKS_EXTENSION = '.input' + PEAKS_EXTENSION
+ENTRY_EXTENSIONS = tuple(sorted({settings['extension'] for settings in OUTPUT_FORMATS.values()} | {PEAKS_EXTENSION}))
+
+def hashFile(file):
+    '''
+    sha256 of a file's bytes, read in chunks so big files never sit in memory
+    '''
+    digest = sha256()
+    with open(file, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@lru_cache(maxsize=1024)
+def hashFileVersion(file, size, mtime):
+    return hashFile(file)
+
+def hashFileCached(file):
+    '''
+    hashFile, remembered per (path, size, mtime) so a file that's submitted over and over is only read once per process
+    '''
+    status = stat(file)
+    return hashFileVersion(file, status.st_size, status.st_mtime_ns)
+
+def renderKey(fileHash, stages, backend=None, options=None):
+    '''
+    Content address of a render: the input's hash plus the normalized stage choices (see normalizeStages), the backend that renders them
+    and any other options the render was given (e.g. sampleRate)
+    '''
+    description = json.dumps([CACHE_VERSION, SAMPLE_RATE, fileHash, stages, backend or DEFAULT_BACKEND] + ([options] if options else []), separators=(',', ':'), sort_keys=True)
+    return sha256(description.encode()).hexdigest()
+
+def placeFile(source, destination):
+    '''
+    Atomically makes destination a copy of source. Hard links are used where possible so nothing is actually copied.
+    '''
+    makedirs(path.dirname(destination), exist_ok=True)
+    handle, temporary = mkstemp(dir=path.dirname(destination), suffix='.part')
+    close(handle)
+    try:
+        unlink(temporary)
+        try:
+            link(source, temporary)
+        except OSError:
+            copyfile(source, temporary)
+        replace(temporary, destination)
+    except BaseException:
+        if path.exists(temporary):
+            unlink(temporary)
+        raise
+
+def evictLeastRecentlyUsed(directory, suffix, maxBytes):
+    '''
+    Deletes the least recently used (oldest mtime) files ending in suffix until the ones left in directory fit in maxBytes.
+    Files another process deletes first are skipped. Returns how many files this call deleted.
+    '''
+    entries = []
+    for entry in scandir(directory):
+        if entry.name.endswith(suffix):
+            try:
+                status = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((status.st_mtime, status.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, entryPath in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            unlink(entryPath)
+        except FileNotFoundError:
+            pass
+        else:
+            evicted += 1
+        total -= size
+    return evicted
+
+class RenderCache:
+    '''
+    Content-addressed store of finished renders, one file per render key, kept under maxBytes by evicting the least recently used entries.
+
+    Several worker processes can share one directory: entries are only ever created by renaming a complete temporary file into place,
+    recency is the entry's mtime (touched on every hit), and eviction tolerates entries another process removed first.
+    hits/misses/evictions count this process's lookups only.
+    '''
+    def __init__(self, directory, maxBytes):
+        self.directory = str(directory)
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+        makedirs(self.directory, exist_ok=True)
+
+    def entryPath(self, key, extension='.wav'):
+        return path.join(self.directory, key+extension)
+
+    def touch(self, key, extension='.wav'):
+        '''
+        get without counting a hit or miss, for files that go along with an entry that was already counted (like its peaks)
+        '''
+        entry = self.entryPath(key, extension)
+        try:
+            utime(entry)
+        except FileNotFoundError:
+            return None
+        return entry
+
+    def get(self, key, extension='.wav'):
+        '''
+        Returns the cached file for key (marking it recently used), or None
+        '''
+        entry = self.touch(key, extension)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, renderedFile, extension=None):
+        '''
+        Stores a finished render under key (keeping its extension unless extension is given) and evicts old entries if the cache is now over budget.
+        Returns the entry's path.
+        '''
+        entry = self.entryPath(key, extension or path.splitext(renderedFile)[1])
+        placeFile(renderedFile, entry)
+        self.evict()
+        return entry
+
+    def placeInputPeaks(self, file, peaksFile):
+        '''
+        Puts the waveform peaks (see peaks.py) of the input file at peaksFile, building them only if no earlier job on the same contents cached them.
+        Returns True if they came from the cache.
+        '''
+        from .peaks import buildPeaksFile
+
+        key = hashFileCached(file)
+        entry = self.touch(key, INPUT_PEAKS_EXTENSION)
+        if entry is not None:
+            try:
+                placeFile(entry, peaksFile)
+                return True
+            except FileNotFoundError:
+                pass
+        makedirs(path.dirname(peaksFile), exist_ok=True)
+        buildPeaksFile(file, peaksFile)
+        self.put(key, peaksFile, INPUT_PEAKS_EXTENSION)
+        return False
+
+    def evict(self):
+        evicted = evictLeastRecentlyUsed(self.directory, ENTRY_EXTENSIONS, self.maxBytes)
+        with self.lock:
+            self.evictions += evicted
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def renderFile(self, file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, outputFile=None, render=megafyFile, backend=None, partialFile=None, peaksFile=None, beforeRender=None, **renderOptions):
+        '''
+        megafyFile with a cache in front of it. On a hit the cached file is linked to outputFile without rendering anything;
+        on a miss render (megafyFile or anything with the same signature) writes outputFile with backend and the result is added to the cache.
+        renderOptions (e.g. sampleRate, outputFormat) are passed on to render and are part of the cache key.
+
+        A miss is rendered into partialFile (a temporary file next to outputFile if None) and renamed to outputFile once it's complete,
+        so partialFile can be read while the render is still running.
+
+        With peaksFile the render's waveform peaks (see peaks.py) are written there too, and cached with it; render must then take peaksFile.
+        beforeRender is called (without arguments) on a miss right before rendering, e.g. to wait for memory a hit doesn't need.
+
+        Returns True if the result came from the cache.
+        '''
+        if outputFile is None:
+            outputFile = getOutputFile(file, renderOptions.get('outputFormat'))
+        extension = path.splitext(outputFile)[1]
+        key = renderKey(hashFileCached(file), normalizeStages(PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE), backend, renderOptions)
+
+        entry = self.get(key, extension)
+        #A render cached without peaks counts as a miss when peaks are wanted
+        peaksEntry = self.touch(key, PEAKS_EXTENSION) if entry is not None and peaksFile is not None else None
+        if entry is not None and (peaksFile is None or peaksEntry is not None):
+            try:
+                placeFile(entry, outputFile)
+                if peaksEntry is not None:
+                    placeFile(peaksEntry, peaksFile)
+                increment('megafy_render_cache_total', result='hit')
+                return True
+            except FileNotFoundError:
+                #Evicted by another process between the lookup and the link
+                pass
+
+        increment('megafy_render_cache_total', result='miss')
+        if beforeRender is not None:
+            beforeRender()
+        #Render next to outputFile and rename it into place. Writing straight into outputFile could write through a hard link left by an earlier hit and corrupt the cache entry
+        makedirs(path.dirname(outputFile), exist_ok=True)
+        if partialFile is None:
+            handle, temporary = mkstemp(dir=path.dirname(outputFile), suffix=extension)
+            close(handle)
+        else:
+            temporary = partialFile
+        temporaryPeaks = None
+        if peaksFile is not None:
+            renderOptions['peaksFile'] = temporaryPeaks = temporary + PEAKS_EXTENSION
+        try:
+            render(file, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, outputFile=temporary, backend=backend, **renderOptions)
+            if temporaryPeaks is not None:
+                self.put(key, temporaryPeaks, PEAKS_EXTENSION)
+                replace(temporaryPeaks, peaksFile)
+            self.put(key, temporary)
+            replace(temporary, outputFile)
+        except BaseException:
+            for leftover in (temporary, temporaryPeaks):
+                if leftover is not None and path.exists(leftover):
+                    unlink(leftover)
+            raise
+        return False
@@ -0,0 +1,105 @@
+'''
+Shows what each resampling tier (ingest.RESAMPLE_QUALITIES) costs and how accurate it is.
+
+    python -m megafy.resample_benchmark
+    python -m megafy.resample_benchmark --from-rate 96000 --seconds 60
+    python -m megafy.resample_benchmark song.wav
+
+Every tier resamples the same audio from --from-rate to --to-rate. Without a file the audio is a mix of sines, so the result can be compared
+with the same sines generated directly at the target rate (signal to error in dB) and a tone above the target's Nyquist frequency measures
+how much aliasing leaks through (rejection in dB). With a file, each tier is compared against the 'best' tier instead.
+'''
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+
+from .ingest import RESAMPLE_QUALITIES, decodeAudio, resampleAudio
+from .megafy_script import SAMPLE_RATE
+from .streaming import measureDifference
+
+#Audible test tones (Hz) and their amplitudes, spread over the spectrum below the target's Nyquist frequency
+TEST_TONES = ((55.0, 0.3), (440.0, 0.2), (3520.0, 0.1), (15000.0, 0.05))
+RUNS = 3
+
+def makeTones(tones, sampleRate, frames):
+    '''
+    Stereo mix of (frequency, amplitude) sines as float32 (2, frames)
+    '''
+    time = np.arange(frames)/sampleRate
+    mono = sum(amplitude*np.sin(2*np.pi*frequency*time) for frequency, amplitude in tones)
+    return np.tile(mono.astype(np.float32), (2, 1))
+
+def timeResample(audio, fromRate, toRate, quality, runs=RUNS):
+    '''
+    Returns (fastest wall seconds, result) over runs resamples
+    '''
+    best = None
+    for _ in range(runs):
+        started = perf_counter()
+        result = resampleAudio(audio, fromRate, toRate, quality)
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def trimEdges(audio, toRate):
+    '''
+    Drops the first and last 50 ms, where every resampler's filter runs off the end of the signal
+    '''
+    edge = toRate//20
+    return audio[:, edge:-edge]
+
+def benchmarkTones(fromRate, toRate, seconds, runs=RUNS):
+    frames = int(seconds*fromRate)
+    audio = makeTones(TEST_TONES, fromRate, frames)
+    expected = trimEdges(makeTones(TEST_TONES, toRate, round(frames*toRate/fromRate)), toRate)
+
+    #When downsampling, a full scale tone between the two Nyquist frequencies should come out as (near) silence
+    aliasTone = makeTones((((toRate + fromRate)/4, 1.0),), fromRate, frames) if fromRate > toRate else None
+
+    results = []
+    for quality in RESAMPLE_QUALITIES:
+        wall, resampled = timeResample(audio, fromRate, toRate, quality, runs)
+        row = {'quality': quality, 'seconds': wall, 'realtime': seconds/wall, **measureDifference(expected, trimEdges(resampled, toRate))}
+        if aliasTone is not None:
+            leaked = trimEdges(resampleAudio(aliasTone, fromRate, toRate, quality), toRate)
+            row['rejection'] = float(-10*np.log10(max(np.mean(leaked.astype(np.float64)**2)/0.5, 1e-30)))
+        results.append(row)
+    return results
+
+def benchmarkFile(file, toRate, seconds, runs=RUNS):
+    audio, info = decodeAudio(file, None, duration=seconds)
+    fromRate, seconds = info.sampleRate, info.duration
+
+    results = []
+    reference = None
+    for quality in reversed(RESAMPLE_QUALITIES):
+        wall, resampled = timeResample(audio, fromRate, toRate, quality, runs)
+        if reference is None:
+            reference = resampled
+        results.append({'quality': quality, 'seconds': wall, 'realtime': seconds/wall, **measureDifference(reference, resampled)})
+    return results[::-1]
+
+def main(argv=None):
+    parser = ArgumentParser(description='Time and compare the resampling tiers.')
+    parser.add_argument('file', nargs='?', help='Audio file to resample (default: synthetic test tones)')
+    parser.add_argument('--from-rate', type=int, default=48000, help='Rate the test tones start at (default: %(default)s). A file starts at its own rate')
+    parser.add_argument('--to-rate', type=int, default=SAMPLE_RATE, help='Rate it is resampled to (default: %(default)s)')
+    parser.add_argument('--seconds', type=float, default=30.0, help='Seconds of audio to resample (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=RUNS, help='Runs per tier, the fastest counts (default: %(default)s)')
+    arguments = parser.parse_args(argv)
+
+    if arguments.file:
+        results = benchmarkFile(arguments.file, arguments.to_rate, arguments.seconds, arguments.runs)
+        print('Compared against the best tier')
+    else:
+        results = benchmarkTones(arguments.from_rate, arguments.to_rate, arguments.seconds, arguments.runs)
+        print('Compared against test tones generated at %d Hz' % arguments.to_rate)
+
+    print('%-10s %10s %10s %14s %12s' % ('tier', 'seconds', 'realtime', 'signal/error', 'rejection'))
+    for row in results:
+        rejection = '%.1f dB' % row['rejection'] if 'rejection' in row else '-'
+        print('%-10s %10.3f %9.0fx %11.1f dB %12s' % (row['quality'], row['seconds'], row['realtime'], row['snr'], rejection))
+
+if __name__ == '__main__':
+    main()
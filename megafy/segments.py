@@ -0,0 +1,244 @@
+'''
+Renders one long track on several cores by cutting it into segments, rendering every segment in its own worker process and crossfading them back together.
+
+Each segment is rendered with a preroll of the audio before it, so filters and the reverb tail are warmed up by the time the segment's own
+audio starts, and the neighbouring segments overlap by a short linear crossfade. With a pitch shift every boundary is mapped through the
+shift's time ratio. The track and every rendered segment travel between the processes through shared memory (see shared_audio.py), not pipes. Compare against a serial render (and time both) with:
+
+    python -m megafy.segments song.mp3 --preset Default --workers 8
+'''
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fractions import Fraction
+from math import gcd
+from os import _exit, cpu_count, getppid
+from threading import Thread
+from time import perf_counter, sleep
+
+import numpy as np
+
+from .encoder import AudioEncoder
+from .ingest import decodeAudio
+from .megafy_script import DEFAULT_BACKEND, SAMPLE_RATE, getOutputFile, getProcessingRate, getTimeRatio, makeSession, readPreset, warmUp
+from .native_dsp import REVERB_SECONDS, varispeedRatio
+from .shared_audio import SharedAudio, sweepOrphans
+from .streaming import alignUp, measureDifference
+
+SEGMENT_SECONDS = 30.0
+#At least as long as the reverb tail, so every segment's reverb has built up before its own audio starts
+SEGMENT_PREROLL_SECONDS = REVERB_SECONDS + 1.0
+#Rendered after each segment so the pitch shifter doesn't treat the segment's end as the end of the song
+SEGMENT_LOOKAHEAD_SECONDS = 0.5
+CROSSFADE_SECONDS = 0.05
+
+#Each segment worker process keeps one session for every segment it renders
+segmentSession = None
+segmentPools = {}
+
+def watchParent(parentPid):
+    #A segment worker outlives a render worker killed outright (e.g. by the OOM killer), and would wait for segments forever
+    while getppid() == parentPid:
+        sleep(1)
+    _exit(1)
+
+def initSegmentWorker(backend, sampleRate=SAMPLE_RATE):
+    global segmentSession
+    Thread(target=watchParent, args=(getppid(),), daemon=True).start()
+    segmentSession = warmUp(makeSession(backend, sampleRate=sampleRate))
+
+def renderSegment(handle, renderStart, renderEnd, stages):
+    '''
+    Renders frames [renderStart, renderEnd) of the shared track behind handle and returns the handle of the result, which the caller takes over
+    '''
+    with SharedAudio.attach(handle) as song:
+        #Always copied: a slice that's already contiguous would otherwise still point into the mapping release closes
+        audio = np.array(song.array[:, renderStart:renderEnd])
+    rendered = np.asarray(segmentSession.render(audio, *stages), dtype=np.float32)
+    return SharedAudio.fromArray(rendered, ownerPid=getppid()).handOff()
+
+def discardSegment(future):
+    '''
+    Frees the result of a renderSegment call that won't be used
+    '''
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        SharedAudio.attach(future.result(), owner=True).release()
+    except FileNotFoundError:
+        pass
+
+def getSegmentPool(workers, backend, sampleRate=SAMPLE_RATE):
+    '''
+    Segment worker pools live as long as the process, so engines and plugins are only set up once
+    '''
+    key = (workers, backend or DEFAULT_BACKEND, sampleRate)
+    if key not in segmentPools:
+        segmentPools[key] = ProcessPoolExecutor(max_workers=workers, initializer=initSegmentWorker, initargs=key[1:])
+    return segmentPools[key]
+
+def shutdownSegmentPools():
+    '''
+    Stops every segment worker pool this process started, cancelling segments that haven't started yet
+    '''
+    while segmentPools:
+        segmentPools.popitem()[1].shutdown(cancel_futures=True)
+
+def getStretch(PITCH_SHIFT_CHOICE, backend):
+    '''
+    Exact ratio between rendered and input length on backend
+    '''
+    if (backend or DEFAULT_BACKEND) == 'native':
+        return varispeedRatio(PITCH_SHIFT_CHOICE)
+    return Fraction(getTimeRatio(PITCH_SHIFT_CHOICE))
+
+def planSegments(frames, segmentFrames, prerollFrames, lookaheadFrames):
+    '''
+    Splits frames input frames into (renderStart, keepStart, keepEnd, renderEnd) tuples: each segment keeps [keepStart, keepEnd) of the result
+    but renders [renderStart, renderEnd) to warm up before it and let the pitch shifter see past its end
+    '''
+    segments = []
+    for keepStart in range(0, frames, segmentFrames):
+        keepEnd = min(frames, keepStart + segmentFrames)
+        segments.append((max(0, keepStart - prerollFrames), keepStart, keepEnd, min(frames, keepEnd + lookaheadFrames)))
+    return segments
+
+def iterSegmented(song, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, workers=None, backend=None, segmentSeconds=SEGMENT_SECONDS, prerollSeconds=SEGMENT_PREROLL_SECONDS, crossfadeSeconds=CROSSFADE_SECONDS, sampleRate=SAMPLE_RATE):
+    '''
+    Runs song (channels, frames at sampleRate) through the chosen stages in parallel segments and yields the stitched result front to back,
+    each piece as soon as the segments it depends on are done. Stage choices are documented in megafyFile.
+    A piece may be a view of shared memory that's freed once the next piece is asked for, so copy any piece that has to be kept.
+    '''
+    stages = (PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE)
+    stretch = getStretch(PITCH_SHIFT_CHOICE, backend)
+    frames = song.shape[-1]
+    totalOut = round(frames*stretch)
+
+    #Segment edges sit on multiples of the stretch's denominator so a resampling pitch shift puts every segment on the same output sample grid
+    alignment = stretch.denominator//gcd(stretch.numerator, stretch.denominator)
+    crossfadeOut = int(crossfadeSeconds*sampleRate*stretch)
+    segmentFrames = alignUp(int(segmentSeconds*sampleRate), alignment)
+    prerollFrames = alignUp(int(prerollSeconds*sampleRate) + int(crossfadeSeconds*sampleRate) + 1, alignment)
+    lookaheadFrames = int(SEGMENT_LOOKAHEAD_SECONDS*sampleRate)
+    segments = planSegments(frames, segmentFrames, prerollFrames, lookaheadFrames)
+
+    poolKey = (workers or cpu_count(), backend, sampleRate)
+    pool = getSegmentPool(*poolKey)
+
+    #Segment workers read their slices straight out of the shared track, and each hands its result back the same way
+    with SharedAudio.fromArray(np.asarray(song, dtype=np.float32)) as shared:
+        handles = [pool.submit(renderSegment, shared.handle, renderStart, renderEnd, stages) for renderStart, _, _, renderEnd in segments]
+        #The previous segment's output, held back until the next segment has crossfaded into its end
+        pending = None
+        previous = None
+        attached = 0
+        try:
+            for (renderStart, keepStart, keepEnd, _), future in zip(segments, handles):
+                current = SharedAudio.attach(future.result(), owner=True)
+                attached += 1
+                #Everything below is in output frames
+                base = round(renderStart*stretch)
+                start = round(keepStart*stretch)
+                end = min(round(keepEnd*stretch), totalOut)
+                fadeStart = max(0, start - crossfadeOut) if keepStart > 0 else start
+
+                piece = current.array[:, fadeStart - base:end - base]
+                if piece.shape[1] < end - fadeStart:
+                    piece = np.pad(piece, ((0, 0), (0, end - fadeStart - piece.shape[1])))
+
+                #Both sides of a crossfade are renders of the same audio, so a linear (equal gain) fade keeps the level constant
+                fade = start - fadeStart
+                if pending is not None:
+                    yield pending[:, :pending.shape[1] - fade]
+                    if fade:
+                        ramp = np.linspace(0, 1, fade, endpoint=False, dtype=np.float32)
+                        yield pending[:, pending.shape[1] - fade:]*(1 - ramp) + piece[:, :fade]*ramp
+                pending = piece[:, fade:]
+                if previous is not None:
+                    previous.release()
+                previous, piece = current, None
+
+            if pending is not None:
+                yield pending
+        except BrokenProcessPool:
+            #A segment worker died; drop the pool so the next render starts a fresh one, and free whatever the dead worker left behind
+            segmentPools.pop((poolKey[0], backend or DEFAULT_BACKEND, sampleRate), None)
+            sweepOrphans()
+            raise
+        finally:
+            pending = None
+            if previous is not None:
+                previous.release()
+            #Results nobody attached to (the render stopped early) are unlinked as soon as they're done, if they ever run
+            for future in handles[attached:]:
+                future.cancel()
+                future.add_done_callback(discardSegment)
+
+def renderSegmented(song, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, **options):
+    '''
+    iterSegmented's whole result as one (channels, frames) array. options are iterSegmented's keyword arguments.
+    '''
+    return np.concatenate([np.array(piece) for piece in iterSegmented(song, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, **options)], axis=1)
+
+def megafyFileSegmented(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, outputFile=None, workers=None, backend=None, sampleRate=SAMPLE_RATE, resampleQuality=None, outputFormat=None, peaksFile=None, bufferPool=None):
+    '''
+    Same as megafyFile, but renders the track in parallel segments across workers processes (one per core by default), see iterSegmented.
+    Each stitched piece is encoded as soon as it's ready. sampleRate, resampleQuality, outputFormat, peaksFile and bufferPool work as in megafyFile.
+
+    Returns True if everything works.
+    '''
+    sampleRate = getProcessingRate(file, sampleRate)
+    song, _ = decodeAudio(file, sampleRate, quality=resampleQuality, pool=bufferPool)
+
+    if outputFile is None:
+        outputFile = getOutputFile(file, outputFormat)
+
+    #Opened on the first piece since the stages decide how many channels come out
+    encoder = None
+    try:
+        for piece in iterSegmented(song, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, workers=workers, backend=backend, sampleRate=sampleRate):
+            if encoder is None:
+                encoder = AudioEncoder(outputFile, sampleRate, piece.shape[0], outputFormat, peaksFile)
+            encoder.write(piece)
+    finally:
+        if encoder is not None:
+            encoder.close()
+        if bufferPool is not None:
+            bufferPool.give(song)
+
+    return True
+
+def compareWithSerial(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, workers=None, backend=None):
+    '''
+    Renders file serially and in segments and returns both wall times plus measureDifference between the two renders
+    '''
+    stages = (PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE)
+    song, _ = decodeAudio(file, SAMPLE_RATE)
+
+    #Warm the pool up first so process startup and plugin loading aren't counted against the segmented render
+    getSegmentPool(workers or cpu_count(), backend).submit(int).result()
+
+    started = perf_counter()
+    serial = makeSession(backend).render(song, *stages)
+    serialSeconds = perf_counter() - started
+
+    started = perf_counter()
+    segmented = renderSegmented(song, *stages, workers=workers, backend=backend)
+    segmentedSeconds = perf_counter() - started
+
+    return {'serialSeconds': serialSeconds, 'segmentedSeconds': segmentedSeconds, **measureDifference(serial, segmented)}
+
+def main(argv=None):
+    parser = ArgumentParser(description='Time a segmented render against a serial one and measure how far apart they are.')
+    parser.add_argument('file', help='.mp3/.wav file to render')
+    parser.add_argument('--preset', default='Default', help='Preset name from megafy/Presets (default: Default)')
+    parser.add_argument('--workers', type=int, default=None, help='Segment worker processes (default: one per core)')
+    parser.add_argument('--backend', default=None, help='Render backend (default: MEGAFY_BACKEND or dawdreamer)')
+    arguments = parser.parse_args(argv)
+
+    report = compareWithSerial(arguments.file, *readPreset(arguments.preset), workers=arguments.workers, backend=arguments.backend)
+    print('Serial: %.2fs  Segmented: %.2fs  Speedup: %.2fx' % (report['serialSeconds'], report['segmentedSeconds'], report['serialSeconds']/report['segmentedSeconds']))
+    print('Max abs difference: %.6f  Signal to difference: %.1f dB' % (report['maxAbs'], report['snr']))
+
+if __name__ == '__main__':
+    main()
@@ -137,4 +137,83 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "megafy-frontend/build/static"),
-]
\ No newline at end of file
+]
+
+# Render job queue (see homepage/workers.py and `manage.py renderworkers`)
+
+RENDER_WORKERS = int(os.environ.get('MEGAFY_RENDER_WORKERS', os.cpu_count() or 1))
+
+#Submitting a job while this many jobs are already queued is rejected with 429
+RENDER_QUEUE_LIMIT = int(os.environ.get('MEGAFY_RENDER_QUEUE_LIMIT', 32))
+
+RENDER_POLL_INTERVAL = 0.5
+
+#'dawdreamer' (the VST plugins, Windows only) or 'native' (NumPy/SciPy, see megafy/native_dsp.py)
+RENDER_BACKEND = os.environ.get('MEGAFY_BACKEND', 'dawdreamer')
+
+#Rate jobs are rendered at. None renders each track at its own rate when the stages support it (megafy_script.PROCESSING_RATES), skipping resampling
+RENDER_SAMPLE_RATE = None if os.environ.get('MEGAFY_NATIVE_RATE') else 44100
+
+#Resampler for tracks that still need one: 'fast', 'balanced' or 'best' (megafy/ingest.py)
+RENDER_RESAMPLE_QUALITY = os.environ.get('MEGAFY_RESAMPLE_QUALITY', 'best')
+
+#How finished renders are encoded: 'wav16', 'wav24', 'flac' or 'ogg' (megafy_script.OUTPUT_FORMATS)
+RENDER_OUTPUT_FORMAT = os.environ.get('MEGAFY_OUTPUT_FORMAT', 'wav24')
+
+#Seconds GET /homepage/jobs/<id>/stream/ waits between checks for more audio while the job is still rendering
+RENDER_STREAM_POLL_INTERVAL = 0.25
+
+#Seconds between checks of megafy/Presets for changed preset files (megafy/presets.py)
+PRESET_RELOAD_INTERVAL = float(os.environ.get('MEGAFY_PRESET_RELOAD_INTERVAL', 2.0))
+
+#Seconds job event streams and GET /homepage/jobs/<id>/wait/ wait between checks on the job (homepage/events.py)
+RENDER_EVENTS_POLL_INTERVAL = 0.5
+
+#Clients one web process lets wait on jobs (event streams and waits) at once; past that they get 503 with Retry-After
+RENDER_MAX_WAITERS = int(os.environ.get('MEGAFY_RENDER_MAX_WAITERS', 1000))
+
+#Longest a single GET /homepage/jobs/<id>/wait/ waits before answering that the job is still going
+RENDER_WAIT_MAX_SECONDS = 60
+
+#Seconds between a worker's updates of a rendering job's progress
+RENDER_PROGRESS_INTERVAL = 0.5
+
+#Render jobs block by block (megafy/streaming.py) instead of decoding whole tracks into memory
+RENDER_STREAMING = True
+
+#Render tracks (those past RENDER_INCREMENTAL_MAX_SECONDS, when that's set) in parallel segments across this many processes per job worker (megafy/segments.py). 0 disables it
+RENDER_SEGMENT_WORKERS = int(os.environ.get('MEGAFY_RENDER_SEGMENT_WORKERS', 0))
+
+#Bytes of estimated peak memory all render workers together may use at once (megafy/memory_budget.py); jobs that don't fit wait. 0 disables it.
+#Defaults to three quarters of the machine's RAM where that can be read
+try:
+    PHYSICAL_MEMORY = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+except (AttributeError, ValueError, OSError):
+    PHYSICAL_MEMORY = 0
+RENDER_MEMORY_BUDGET = int(os.environ.get('MEGAFY_RENDER_MEMORY_BUDGET', PHYSICAL_MEMORY * 3 // 4))
+
+#Free decode buffers each render worker keeps for its next job (megafy/buffer_pool.py)
+RENDER_BUFFER_POOL_BYTES = int(os.environ.get('MEGAFY_RENDER_BUFFER_POOL_BYTES', 512 * 1024**2))
+
+#Longest window POST /homepage/preview/ will render in the request
+PREVIEW_MAX_SECONDS = 30
+
+#Jobs may only render files from inside this directory
+RENDER_INPUT_DIR = BASE_DIR / 'megafy' / 'Input'
+
+#POST /homepage/uploads/ streams uploads into RENDER_INPUT_DIR. Bigger bodies get 413, and a client with this many uploads already running gets 429
+UPLOAD_MAX_BYTES = int(os.environ.get('MEGAFY_UPLOAD_MAX_BYTES', 512 * 1024**2))
+UPLOAD_MAX_CONCURRENT = int(os.environ.get('MEGAFY_UPLOAD_MAX_CONCURRENT', 2))
+
+#Finished renders keyed by input hash + stage parameters (megafy/render_cache.py), least recently used evicted past the byte budget
+RENDER_CACHE_DIR = BASE_DIR / 'megafy' / 'Cache' / 'renders'
+RENDER_CACHE_BYTES = int(os.environ.get('MEGAFY_RENDER_CACHE_BYTES', 2 * 1024**3))
+
+#Tracks up to this long are rendered stage by stage with every stage's output kept (megafy/incremental.py), so a tweak only re-renders the stages after it.
+#Off (0) by default: it renders whole tracks in memory and writes every stage's output to disk, which only pays off where the same tracks get re-rendered with tweaks
+RENDER_INCREMENTAL_MAX_SECONDS = float(os.environ.get('MEGAFY_RENDER_INCREMENTAL_MAX_SECONDS', 0))
+RENDER_STAGE_CACHE_DIR = BASE_DIR / 'megafy' / 'Cache' / 'stages'
+RENDER_STAGE_CACHE_BYTES = int(os.environ.get('MEGAFY_RENDER_STAGE_CACHE_BYTES', 8 * 1024**3))
+
+#Each render worker saves its metrics here after every job (megafy/metrics.py), GET /homepage/metrics/ adds them up
+RENDER_METRICS_DIR = BASE_DIR / 'megafy' / 'Cache' / 'metrics'
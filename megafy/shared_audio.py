@@ -0,0 +1,151 @@
+'''
+Hands audio buffers between processes through shared memory instead of pickling them, so a long track is never copied through a pipe.
+
+The process with the audio puts it in a SharedAudio and passes its handle (a name and a shape, cheap to pickle) along; the other side
+attaches to the handle and gets a NumPy view of the same memory. Exactly one side owns a segment and unlinks it: the creator, until it hands
+the segment off with handOff, after which whoever attaches with owner=True does. Owners unlink as soon as they attach, so the memory is freed
+the moment the last view of it goes away, whatever happens to the processes afterwards.
+
+Segment names carry the owner's and the creator's pids, and sweepOrphans unlinks any segment either of them died holding (e.g. a worker that
+crashed mid-render). Windows frees shared memory with its last handle, so nothing can be orphaned there.
+'''
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from os import getpid, kill, path, scandir, unlink
+from secrets import token_hex
+import sys
+
+import numpy as np
+
+SHARED_PREFIX = 'megafy'
+#Where POSIX shared memory segments show up as files (Linux)
+SHARED_MEMORY_DIR = '/dev/shm'
+
+@dataclass(frozen=True)
+class AudioHandle:
+    '''
+    Everything another process needs to attach to a SharedAudio
+    '''
+    name: str
+    shape: tuple
+    dtype: str = 'float32'
+
+def openSegment(name, create=False, size=0):
+    '''
+    Opens (or creates) a shared memory segment that multiprocessing's resource tracker doesn't know about. The tracker would otherwise
+    unlink segments when the process that opened them exits, even after handing them to another process; lifetimes are managed here instead.
+    '''
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, create, size, track=False)
+    memory = SharedMemory(name, create, size)
+    if hasattr(memory, '_name') and sys.platform != 'win32':
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory
+
+def unlinkSegment(memory):
+    if sys.platform == 'win32':
+        return
+    if sys.version_info < (3, 13):
+        #unlink tells the tracker to forget the segment, which it was never told about (see openSegment)
+        resource_tracker.register(memory._name, 'shared_memory')
+    memory.unlink()
+
+class SharedAudio:
+    '''
+    A NumPy array (array) living in a shared memory segment. Use create/fromArray to make one and attach to open one from another process.
+    Views of array are only valid until release.
+    '''
+    def __init__(self, memory, shape, dtype, owner):
+        self.memory = memory
+        self.owner = owner
+        self.array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+    @classmethod
+    def create(cls, shape, dtype=np.float32, ownerPid=None):
+        '''
+        A new zeroed segment for an array of shape, to be unlinked by ownerPid (this process by default) if it dies holding it
+        '''
+        shape = tuple(int(size) for size in shape)
+        name = '%s_%d_%d_%s' % (SHARED_PREFIX, ownerPid or getpid(), getpid(), token_hex(8))
+        #Zero-size segments aren't allowed
+        size = max(1, int(np.prod(shape, dtype=np.int64))*np.dtype(dtype).itemsize)
+        return cls(openSegment(name, create=True, size=size), shape, dtype, owner=True)
+
+    @classmethod
+    def fromArray(cls, array, ownerPid=None):
+        shared = cls.create(array.shape, array.dtype, ownerPid)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, handle, owner=False):
+        '''
+        Opens the segment behind handle. With owner, this process takes over unlinking it, and does so straight away.
+        '''
+        memory = openSegment(handle.name)
+        if owner:
+            unlinkSegment(memory)
+        #Nothing is left to unlink on release
+        return cls(memory, handle.shape, handle.dtype, owner=False)
+
+    @property
+    def handle(self):
+        return AudioHandle(self.memory.name, self.array.shape, self.array.dtype.str)
+
+    def handOff(self):
+        '''
+        Releases this process's view without unlinking the segment and returns the handle, for a process that will attach with owner=True
+        '''
+        handle = self.handle
+        self.owner = False
+        self.release()
+        return handle
+
+    def release(self):
+        '''
+        Closes this process's mapping, unlinking the segment first if this process still owns it
+        '''
+        if self.memory is None:
+            return
+        if self.owner:
+            unlinkSegment(self.memory)
+        self.array = None
+        self.memory.close()
+        self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def isAlive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def sweepOrphans(directory=SHARED_MEMORY_DIR):
+    '''
+    Unlinks the shared memory segments of SharedAudio owners or creators that have died. Returns how many were removed.
+    Only possible where segments can be listed (Linux); elsewhere this does nothing.
+    '''
+    if not path.isdir(directory):
+        return 0
+    removed = 0
+    for entry in scandir(directory):
+        parts = entry.name.split('_')
+        if len(parts) != 4 or parts[0] != SHARED_PREFIX or not (parts[1].isdigit() and parts[2].isdigit()):
+            continue
+        if isAlive(int(parts[1])) and isAlive(int(parts[2])):
+            continue
+        try:
+            unlink(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,40 @@
+from threading import Event, Lock
+
+class SingleFlight:
+    '''
+    Coalesces identical calls made at the same time within one process: the first call for a key runs, and every call for that key that arrives
+    while it's running waits for it and gets the same result (or the same exception) instead of doing the work again.
+    Nothing is cached once the call finishes. Across processes the job queue does the same thing (see homepage.workers).
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, function, *args, **kwargs):
+        '''
+        Returns function(*args, **kwargs), sharing one call between everyone asking for key at the same time
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call['result'] = function(*args, **kwargs)
+            except BaseException as error:
+                call['error'] = error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call['done'].set()
+        else:
+            call['done'].wait()
+
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
@@ -0,0 +1,205 @@
+from fractions import Fraction
+from math import gcd
+
+import audioread
+import numpy as np
+import soundfile as sf
+
+from .encoder import AudioEncoder
+from .ingest import resampleAudio
+from .megafy_script import BUFFER_SIZE, PROCESSING_RATES, SAMPLE_RATE, buildGraph, getOutputFile, makeSession
+from .native_dsp import NativeSession, toStereo, varispeed, varispeedRatio
+
+BLOCK_SECONDS = 10.0
+#Audio rendered before each block so filters and the reverb tail are warmed up by the time the block itself starts
+PREROLL_SECONDS = 4.0
+#The native backend carries effect state itself, so its preroll only has to cover the resampling filters
+NATIVE_PREROLL_SECONDS = 0.1
+#Audio rendered after each block so the pitch shifter never sees the block's end as the end of the song
+LOOKAHEAD_SECONDS = 0.5
+
+class BlockReader:
+    '''
+    Reads an audio file front to back as float32 (channels, frames) blocks without ever holding the whole file.
+    Uses soundfile when libsndfile can decode the file and falls back to audioread (ffmpeg and friends) otherwise.
+    '''
+    def __init__(self, file):
+        try:
+            self.soundFile = sf.SoundFile(file)
+        except RuntimeError:
+            self.soundFile = None
+
+        if self.soundFile is not None:
+            self.sampleRate = self.soundFile.samplerate
+            self.channels = self.soundFile.channels
+        else:
+            self.decoder = audioread.audio_open(file)
+            self.sampleRate = self.decoder.samplerate
+            self.channels = self.decoder.channels
+            self.chunks = iter(self.decoder)
+            self.pending = np.empty((self.channels, 0), dtype=np.float32)
+
+    def read(self, frames):
+        '''
+        Returns the next (up to) frames frames. Fewer frames than asked for means the file has ended.
+        '''
+        if self.soundFile is not None:
+            return self.soundFile.read(frames, dtype='float32', always_2d=True).T
+
+        #audioread hands out interleaved 16-bit chunks of whatever size the decoder likes
+        while self.pending.shape[1] < frames:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            samples = np.frombuffer(chunk, dtype='<i2').astype(np.float32) / 32768
+            self.pending = np.concatenate((self.pending, samples.reshape(-1, self.channels).T), axis=1)
+
+        block, self.pending = self.pending[:, :frames], self.pending[:, frames:]
+        return block
+
+    def close(self):
+        if self.soundFile is not None:
+            self.soundFile.close()
+        else:
+            self.decoder.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def alignUp(frames, multiple):
+    return -(-frames // multiple) * multiple
+
+def megafyFileStreaming(file, PITCH_SHIFT_CHOICE=False, BASS_BOOST_CHOICE=False, REVERB_CHOICE=False, SOFT_CLIPPER_CHOICE=False, outputFile=None, blockSeconds=BLOCK_SECONDS, prerollSeconds=None, backend=None, sampleRate=SAMPLE_RATE, outputFormat=None, peaksFile=None, session=None, resampleQuality=None, bufferPool=None):
+    '''
+    Same as megafyFile (same parameters, same output file), but decodes, renders and writes the audio blockSeconds at a time.
+    Peak memory depends on blockSeconds and prerollSeconds only, not on how long the file is.
+    Every block is encoded (in outputFormat, see megafyFile) and flushed as soon as it's rendered, so the output can be played while it's still being written.
+
+    dawdreamer resets its processors on every render, so with the 'dawdreamer' backend processor state is carried across block boundaries
+    by rendering each block together with the prerollSeconds of audio before it (and LOOKAHEAD_SECONDS after it) and only keeping the block's
+    own part of the result. prerollSeconds (PREROLL_SECONDS by default) should then be at least as long as the reverb tail.
+    The 'native' backend's effect stages keep their state between blocks themselves, so only the pitch shift's resampler needs a short preroll.
+    Use measureDifference to check a streamed render against a full one.
+
+    sampleRate, resampleQuality and session work as in megafyFile: blocks that need resampling go through the same resampler a full render would use,
+    and since every window starts on the same sample grid the resampled blocks line up with the full render's samples.
+    With bufferPool (a buffer_pool.BufferPool) the window of source audio kept around each block is taken from it and given back at the end.
+
+    Returns True if everything works.
+    '''
+    if outputFile is None:
+        outputFile = getOutputFile(file, outputFormat)
+
+    playback_processor = None
+    chain = None
+    output = None
+
+    with BlockReader(file) as reader:
+        if sampleRate is None:
+            sampleRate = reader.sampleRate if reader.sampleRate in PROCESSING_RATES else SAMPLE_RATE
+
+        if session is None or session.sampleRate != sampleRate:
+            session = makeSession(backend, sampleRate=sampleRate)
+        native = isinstance(session, NativeSession)
+        if prerollSeconds is None:
+            prerollSeconds = NATIVE_PREROLL_SECONDS if native else PREROLL_SECONDS
+        #Exact ratio between rendered and input length, so block edges land on the same output frames a full render would use.
+        #The native one comes straight from varispeedRatio: timeRatio's float would turn into a fraction with a huge denominator and one block the size of the song
+        stretch = varispeedRatio(PITCH_SHIFT_CHOICE) if native else Fraction(session.timeRatio(PITCH_SHIFT_CHOICE))
+
+        #Blocks are resampled to sampleRate one at a time. Keeping window edges on multiples of `alignment` source frames puts every block on the same
+        #sample grid, both after resampling to sampleRate and (native backend) after the pitch shift's own resampling
+        resampleRatio = Fraction(sampleRate, reader.sampleRate)
+        up, down = resampleRatio.numerator, resampleRatio.denominator
+        alignment = down*stretch.denominator//gcd(up, stretch.denominator) if native else down
+        blockFrames = alignUp(int(blockSeconds*reader.sampleRate), alignment)
+        prerollFrames = alignUp(int(prerollSeconds*reader.sampleRate), alignment)
+        lookaheadFrames = alignUp(int(LOOKAHEAD_SECONDS*reader.sampleRate), alignment)
+
+        #The window holds source frames [windowStart, windowStart + windowFrames): the current block plus its preroll and lookahead.
+        #It lives at the start of one buffer that's big enough for the longest window, so nothing is allocated per block
+        capacity = prerollFrames + blockFrames + lookaheadFrames
+        buffer = bufferPool.take(reader.channels, capacity) if bufferPool is not None else np.empty((reader.channels, capacity), dtype=np.float32)
+        windowStart = 0
+        windowFrames = 0
+        blockStart = 0
+        exhausted = False
+
+        try:
+            while True:
+                wanted = blockStart + blockFrames + lookaheadFrames - (windowStart + windowFrames)
+                if wanted > 0 and not exhausted:
+                    fresh = reader.read(wanted)
+                    exhausted = fresh.shape[1] < wanted
+                    buffer[:, windowFrames:windowFrames + fresh.shape[1]] = fresh
+                    windowFrames += fresh.shape[1]
+
+                windowEnd = windowStart + windowFrames
+                if blockStart >= windowEnd:
+                    break
+                blockEnd = min(blockStart + blockFrames, windowEnd)
+
+                context = resampleAudio(buffer[:, :windowFrames], reader.sampleRate, sampleRate, resampleQuality)
+                if native:
+                    audio = varispeed(toStereo(context), PITCH_SHIFT_CHOICE)
+                else:
+                    if playback_processor is None:
+                        OUR_GRAPH = buildGraph(session.engine, context, PITCH_SHIFT_CHOICE, BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE, processors=session.processors)
+                        session.engine.load_graph(OUR_GRAPH)
+                        playback_processor = OUR_GRAPH[0][0]
+                    else:
+                        playback_processor.set_data(context)
+
+                    session.engine.render(float(context.shape[1]*stretch + BUFFER_SIZE)/sampleRate)
+                    audio = session.engine.get_audio()
+
+                #Map the block's edges to output frames through absolute positions so rounding never drifts from block to block
+                contextOut = round(Fraction(windowStart*up, down)*stretch)
+                startOut = round(Fraction(blockStart*up, down)*stretch) - contextOut
+                endOut = round(Fraction(blockEnd*up, down)*stretch) - contextOut
+                piece = audio[:, startOut:endOut]
+                if piece.shape[1] < endOut - startOut:
+                    piece = np.pad(piece, ((0, 0), (0, endOut - startOut - piece.shape[1])))
+
+                if native:
+                    if chain is None:
+                        chain = session.makeChain(piece.shape[0], BASS_BOOST_CHOICE, REVERB_CHOICE, SOFT_CLIPPER_CHOICE)
+                    piece = chain.process(piece)
+
+                if output is None:
+                    output = AudioEncoder(outputFile, sampleRate, piece.shape[0], outputFormat, peaksFile)
+                output.write(piece)
+
+                blockStart = blockEnd
+                nextWindowStart = max(0, blockStart - prerollFrames)
+                kept = windowEnd - nextWindowStart
+                buffer[:, :kept] = buffer[:, nextWindowStart - windowStart:windowFrames]
+                windowStart = nextWindowStart
+                windowFrames = kept
+        finally:
+            if output is not None:
+                output.close()
+            if bufferPool is not None:
+                bufferPool.give(buffer)
+
+    return True
+
+def measureDifference(reference, candidate):
+    '''
+    Compares two renders given as (channels, frames) arrays, e.g. a full-buffer render and a streamed one.
+    Returns the largest absolute sample difference and the signal-to-difference ratio in dB over their common length.
+    '''
+    frames = min(reference.shape[-1], candidate.shape[-1])
+    reference = np.asarray(reference[..., :frames], dtype=np.float64)
+    difference = reference - np.asarray(candidate[..., :frames], dtype=np.float64)
+
+    noise = np.sum(difference**2)
+    signal = np.sum(reference**2)
+    return {
+        'maxAbs': float(np.max(np.abs(difference))) if frames else 0.0,
+        'snr': float('inf') if noise == 0 else float(10*np.log10(signal/noise)),
+        'frames': frames,
+    }
@@ -0,0 +1,108 @@
+'''
+Renders one input under several stage configurations (e.g. presets for an A/B comparison) in a single call.
+
+The file is decoded once and the variants are arranged as a tree of shared stage prefixes, so a stage that several variants run with the
+same choice (and everything before it) is rendered once for all of them. As soon as a branch only leads to one distinct configuration its
+remaining stages are rendered in one pass. Time it against separate renders with:
+
+    python -m megafy.variants song.mp3 --preset Default --preset "Default - Copy" --compare
+'''
+from argparse import ArgumentParser
+from os import path
+from time import perf_counter
+
+import numpy as np
+
+from .encoder import encodeAudio
+from .incremental import renderStage
+from .ingest import decodeAudio
+from .megafy_script import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, SAMPLE_RATE, getOutputFile, getProcessingRate, makeSession, megafyFile, normalizeStages, readPreset
+from .render_cache import placeFile
+
+def renderVariantTree(session, audio, level, variants, emit):
+    '''
+    Renders audio (the result of the first level stages) through what's left of every variant and calls emit(result, variant indexes) once per distinct configuration.
+    variants is a list of (index, normalized stages).
+    '''
+    remaining = {stages[level:] for _, stages in variants}
+    if len(remaining) == 1:
+        suffix = remaining.pop()
+        if any(choice is not False for choice in suffix):
+            audio = session.render(audio, *([False]*level + [False if choice is False else list(choice) for choice in suffix]))
+        emit(audio, [index for index, _ in variants])
+        return
+
+    #Variants that agree on this stage share its output
+    branches = {}
+    for index, stages in variants:
+        branches.setdefault(stages[level], []).append((index, stages))
+    for choice, branch in branches.items():
+        child = audio if choice is False else renderStage(session, level, audio, choice)
+        renderVariantTree(session, np.ascontiguousarray(child, dtype=np.float32), level + 1, branch, emit)
+
+def megafyVariants(file, variants, outputFiles, session=None, backend=None, sampleRate=SAMPLE_RATE, resampleQuality=None, outputFormat=None):
+    '''
+    Megafies file once per entry of variants (each a list of the four stage choices megafyFile takes, e.g. from readPreset) into the matching entry of outputFiles.
+    Decoding, engine setup and every stage prefix the variants share happen once. session, backend, sampleRate, resampleQuality and outputFormat work as in megafyFile.
+
+    Returns outputFiles.
+    '''
+    if len(outputFiles) != len(variants):
+        raise ValueError('Got %d variants but %d output files' % (len(variants), len(outputFiles)))
+
+    sampleRate = getProcessingRate(file, sampleRate)
+    if session is None or session.sampleRate != sampleRate:
+        session = makeSession(backend, sampleRate=sampleRate)
+    song, _ = decodeAudio(file, sampleRate, quality=resampleQuality)
+
+    def emit(audio, indexes):
+        #Variants with identical settings get copies (hard links where possible) of one encode
+        encodeAudio(outputFiles[indexes[0]], audio, sampleRate, outputFormat)
+        for index in indexes[1:]:
+            placeFile(outputFiles[indexes[0]], outputFiles[index])
+
+    renderVariantTree(session, np.ascontiguousarray(song, dtype=np.float32), 0, [(index, normalizeStages(*stages)) for index, stages in enumerate(variants)], emit)
+    return outputFiles
+
+def getPresetOutputFile(file, presetOption, outputFormat=None):
+    '''
+    Default output path for file rendered with one of several presets: getOutputFile's name with the preset's name appended
+    '''
+    root = path.splitext(getOutputFile(file, outputFormat))[0]
+    return '%s (%s)%s' % (root, presetOption.upper(), OUTPUT_FORMATS[outputFormat or DEFAULT_OUTPUT_FORMAT]['extension'])
+
+def megafyPresets(file, presetOptions, outputFiles=None, session=None, backend=None, outputFormat=None):
+    '''
+    megafyVariants for a list of preset names (see readPreset). outputFiles defaults to getPresetOutputFile for each preset.
+
+    Returns the output files.
+    '''
+    if outputFiles is None:
+        outputFiles = [getPresetOutputFile(file, presetOption, outputFormat) for presetOption in presetOptions]
+    return megafyVariants(file, [readPreset(presetOption) for presetOption in presetOptions], outputFiles, session=session, backend=backend, outputFormat=outputFormat)
+
+def main(argv=None):
+    parser = ArgumentParser(description='Megafy one file with several presets in a single pass.')
+    parser.add_argument('file', help='.mp3/.wav file to render')
+    parser.add_argument('--preset', action='append', required=True, help='Preset name from megafy/Presets, once per variant')
+    parser.add_argument('--backend', default=None, help='Render backend (default: MEGAFY_BACKEND or dawdreamer)')
+    parser.add_argument('--compare', action='store_true', help='Also time one separate megafyFile call per preset')
+    arguments = parser.parse_args(argv)
+
+    session = makeSession(arguments.backend)
+    started = perf_counter()
+    outputFiles = megafyPresets(arguments.file, arguments.preset, session=session)
+    fanOutSeconds = perf_counter() - started
+    for outputFile in outputFiles:
+        print(outputFile)
+    print('%d variant(s) in %.2fs' % (len(outputFiles), fanOutSeconds))
+
+    if arguments.compare:
+        started = perf_counter()
+        for presetOption, outputFile in zip(arguments.preset, outputFiles):
+            megafyFile(arguments.file, *readPreset(presetOption), outputFile=outputFile, backend=arguments.backend)
+        separateSeconds = perf_counter() - started
+        print('Separate renders: %.2fs (%.2fx the fan-out time)' % (separateSeconds, separateSeconds/fanOutSeconds))
+
+if __name__ == '__main__':
+    main()
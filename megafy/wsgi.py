@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'megafy.settings')
 
 application = get_wsgi_application()
+
+#Presets are read now, and re-read off the request path when their files change, so requests never wait on the Presets folder
+from django.conf import settings
+from megafy.preview import startPreviewWarmUp
+from megafy.presets import watchPresets
+
+watchPresets(settings.PRESET_RELOAD_INTERVAL)
+#Previews render in this process, so their sessions and audio libraries are loaded in the background now rather than by the first preview
+startPreviewWarmUp(settings.RENDER_BACKEND)